@@ -0,0 +1,99 @@
+"""
+Measures Marta's cold start: each run is a fresh Python process that
+imports `marta_core.agent`, builds the agent and asks one question, timing
+
+    import          import marta_core.agent (LangChain, Vertex AI SDK, tools)
+    init            _initialize_agent_components(): LLM, prompt, agent, executor
+    first answer    the first ask_marta() call
+    second answer   a second call in the same session, with everything warm
+
+time-to-first-answer is the sum of the first three. --hub also times
+hub.pull("hwchase17/structured-chat-agent"), which init used to do before
+the prompt was vendored in marta_core/prompts.py:
+
+    python benchmarks/bench_agent_startup.py --runs 5
+    python benchmarks/bench_agent_startup.py --runs 3 --no-answer --hub
+
+Needs the same GOOGLE_CLOUD_* configuration and credentials as the webapp;
+--no-answer skips the LLM calls and measures import and init only.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def child(question, answer, hub):
+    sys.path.insert(0, project_root)
+    timings = {}
+
+    start = time.perf_counter()
+    from marta_core import agent
+    timings["import"] = time.perf_counter() - start
+
+    if hub:
+        from langchain import hub as langchain_hub
+
+        start = time.perf_counter()
+        langchain_hub.pull("hwchase17/structured-chat-agent")
+        timings["hub.pull"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if agent._initialize_agent_components() is None:
+        raise SystemExit("agent initialization failed")
+    timings["init"] = time.perf_counter() - start
+
+    if answer:
+        for name in ("first answer", "second answer"):
+            start = time.perf_counter()
+            agent.ask_marta(question, session_id="bench-agent-startup")
+            timings[name] = time.perf_counter() - start
+        timings["time-to-first-answer"] = timings["import"] + timings["init"] + timings["first answer"]
+
+    print(json.dumps(timings))
+
+
+def run_once(args):
+    command = [sys.executable, os.path.abspath(__file__), "--child", "--question", args.question]
+    if args.no_answer:
+        command.append("--no-answer")
+    if args.hub:
+        command.append("--hub")
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    # The agent prints progress to stdout; the timings are the last line.
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--question", default="Hola Marta, ¿qué servicios ofrece datanalisis.io?")
+    parser.add_argument("--no-answer", action="store_true", help="Skip the ask_marta() calls")
+    parser.add_argument("--hub", action="store_true", help="Also time a hub.pull of the structured-chat prompt")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.question, not args.no_answer, args.hub)
+        return
+
+    samples = {}
+    for i in range(args.runs):
+        for name, seconds in run_once(args).items():
+            samples.setdefault(name, []).append(seconds)
+        print(f"run {i + 1}/{args.runs} done", file=sys.stderr)
+
+    print(f"{'phase':<24}{'runs':>6}{'mean s':>10}{'min s':>10}{'max s':>10}")
+    for name, values in samples.items():
+        print(f"{name:<24}{len(values):>6}{sum(values) / len(values):>10.3f}{min(values):>10.3f}{max(values):>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
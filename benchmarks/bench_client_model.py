@@ -0,0 +1,102 @@
+"""
+Compares the legacy `Client` object with the tuple-backed `ClientRecord`.
+
+Reports memory per N clients and build/serialization throughput using
+synthetic cursor rows, so no database is needed:
+
+    python benchmarks/bench_client_model.py --count 100000
+"""
+import argparse
+import datetime
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from marta_core.crm import Client, ClientRecord, to_dicts
+
+
+def make_rows(count):
+    now = datetime.datetime(2025, 7, 1, 12, 0, 0)
+    return [
+        (
+            i, f"Nombre{i}", f"Apellido{i}", "Gerente", f"cliente{i}@example.com",
+            f"+507 6000-{i % 10000:04d}", f"Empresa {i % 500}", "Notas de seguimiento",
+            now if i % 2 else None, "Email", {"priority": "medium"}, now, 1,
+        )
+        for i in range(count)
+    ]
+
+
+def build_legacy(rows):
+    clients = []
+    for row in rows:
+        client = Client(id=row[0], first_name=row[1], last_name=row[2], position=row[3], email=row[4], phone_number=row[5], company=row[6])
+        client.notes = row[7]
+        client.last_contact = row[8]
+        client.last_contact_source = row[9]
+        client.ai_insights = row[10]
+        clients.append(client)
+    return clients
+
+
+def build_records(rows):
+    return list(map(ClientRecord._make, rows))
+
+
+def measure_memory(build, rows):
+    gc.collect()
+    tracemalloc.start()
+    objects = build(rows)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return size
+
+
+def measure_time(func, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = make_rows(args.count)
+    legacy = build_legacy(rows)
+    records = build_records(rows)
+
+    results = {
+        "Client (legacy)": {
+            "memory": measure_memory(build_legacy, rows),
+            "build": measure_time(lambda: build_legacy(rows), args.repeat),
+            "serialize": measure_time(lambda: [client.to_dict() for client in legacy], args.repeat),
+        },
+        "ClientRecord": {
+            "memory": measure_memory(build_records, rows),
+            "build": measure_time(lambda: build_records(rows), args.repeat),
+            "serialize": measure_time(lambda: to_dicts(records), args.repeat),
+        },
+    }
+
+    print(f"{args.count:,} clients (best of {args.repeat})")
+    print(f"{'representation':<18}{'memory MiB':>12}{'build rows/s':>16}{'to_dict rows/s':>16}")
+    for name, r in results.items():
+        print(
+            f"{name:<18}{r['memory'] / 2**20:>12.1f}"
+            f"{args.count / r['build']:>16,.0f}{args.count / r['serialize']:>16,.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Compares the Postgres and SQLite CRM backends on the core operations.
+
+Each backend gets the same synthetic clients (backend-bench<i>@example.com)
+and funnel entries and then runs the same seeded sequence of calls with the
+client cache disabled, so every call reaches the database. Reports the
+mean, p95 and throughput per operation:
+
+    python benchmarks/bench_crm_backends.py --count 20000
+    python benchmarks/bench_crm_backends.py --backends sqlite --sqlite-path /tmp/bench.sqlite3
+
+Postgres is the database named by the POSTGRES_* variables, migrated to the
+latest version; the benchmark rows are deleted again at the end. SQLite
+uses a fresh file in a temporary directory unless --sqlite-path is given.
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from marta_core.cache import LRUCache
+
+FIRST_NAMES = ["Ana", "Luis", "María", "Carlos", "Sofía", "Jorge", "Lucía", "Pedro", "Elena", "Diego"]
+LAST_NAMES = ["González", "Rodríguez", "Pérez", "Sánchez", "Ramírez", "Torres", "Flores", "Díaz", "Castillo", "Vargas"]
+SEARCHES = ["Ana", "Rodríguez", "vacunas", "Gonzales", "Empresa 42", "Lucia Torres"]
+STAGES = ["Lead", "Contacted", "Proposal", "Negotiation", "Won", "Lost"]
+
+
+def synthetic_client(i):
+    return {
+        "first_name": FIRST_NAMES[i % len(FIRST_NAMES)],
+        "last_name": f"{LAST_NAMES[i // len(FIRST_NAMES) % len(LAST_NAMES)]} {i}",
+        "position": "Gerente" if i % 3 else "Director",
+        "email": f"backend-bench{i}@example.com",
+        "phone_number": f"+507 6{i % 1000:03d}-{i % 10000:04d}",
+        "company": f"Empresa {i % 5000}",
+        "notes": "Cliente interesado en alimento premium y vacunas" if i % 2 else "Seguimiento trimestral",
+        "last_contact_source": "Email",
+        "ai_insights": {"priority": ["low", "medium", "high"][i % 3]},
+    }
+
+
+def open_postgres():
+    from marta_core.crm import CRM
+    from marta_core.migrations import migrate
+
+    migrate(log=lambda message: None)
+    return CRM(client_cache=LRUCache(maxsize=0))
+
+
+def cleanup_postgres(crm):
+    with crm.pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM clients WHERE email LIKE 'backend-bench%%@example.com';")
+        conn.commit()
+
+
+def open_sqlite(path):
+    from marta_core.crm_sqlite import SQLiteCRM
+
+    return SQLiteCRM(path, client_cache=LRUCache(maxsize=0))
+
+
+def timed(results, name, func, *args, **kwargs):
+    start = time.perf_counter()
+    value = func(*args, **kwargs)
+    results.setdefault(name, []).append(time.perf_counter() - start)
+    return value
+
+
+def run_backend(crm, count, repeat, seed):
+    rng = random.Random(seed)
+    results = {}
+    email = lambda: f"backend-bench{rng.randrange(count)}@example.com"
+
+    timed(results, "add_clients_bulk", crm.add_clients_bulk, (synthetic_client(i) for i in range(count)))
+    ids = [client.id for client in crm.get_clients([f"backend-bench{i}@example.com" for i in range(0, count, 10)]).values()]
+    for client_id in ids:
+        timed(results, "add_sales_funnel_entry", crm.add_sales_funnel_entry, {
+            "client_id": client_id, "stage": rng.choice(STAGES), "status": "Open",
+            "notes": "Benchmark", "estimated_value": rng.randrange(100, 50000),
+        })
+
+    for _ in range(repeat):
+        timed(results, "get_client", crm.get_client, email())
+    for _ in range(max(1, repeat // 10)):
+        timed(results, "get_clients (50)", crm.get_clients, [email() for _ in range(50)])
+        timed(results, "search_clients", crm.search_clients, rng.choice(SEARCHES), 20)
+        timed(results, "iter_clients (page of 100)", lambda: list(crm.iter_clients(after_id=rng.randrange(count), limit=100)))
+    for _ in range(max(1, repeat // 5)):
+        timed(results, "update_client", crm.update_client, email(), {"notes": f"Actualizado {rng.random()}"})
+        timed(results, "update_sales_funnel_entry", crm.update_sales_funnel_entry, rng.choice(ids), {"stage": rng.choice(STAGES)})
+        timed(results, "get_change_versions", crm.get_change_versions)
+    for _ in range(max(1, repeat // 50)):
+        timed(results, "get_sales_funnel_summary", crm.get_sales_funnel_summary)
+        end = datetime.datetime.now() + datetime.timedelta(days=1)
+        timed(results, "get_stage_conversion_rates", crm.get_stage_conversion_rates, end - datetime.timedelta(days=90), end)
+    timed(results, "get_all_clients", crm.get_all_clients)
+    return results
+
+
+def report(backend, results):
+    print(f"\n{backend}")
+    print(f"{'operation':<32}{'calls':>7}{'mean ms':>10}{'p95 ms':>10}{'ops/s':>10}")
+    for name, samples in results.items():
+        samples = sorted(samples)
+        total = sum(samples)
+        p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+        print(f"{name:<32}{len(samples):>7}{total / len(samples) * 1000:>10.2f}{p95 * 1000:>10.2f}{len(samples) / total:>10.1f}")
+
+
+def main():
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", default="postgres,sqlite")
+    parser.add_argument("--count", type=int, default=20000, help="Synthetic clients to load")
+    parser.add_argument("--repeat", type=int, default=2000, help="get_client calls; other operations scale from it")
+    parser.add_argument("--sqlite-path")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for backend in args.backends.split(","):
+        if backend == "postgres":
+            crm = open_postgres()
+            try:
+                report(backend, run_backend(crm, args.count, args.repeat, args.seed))
+            finally:
+                cleanup_postgres(crm)
+                crm.pool.closeall()
+        elif backend == "sqlite":
+            with tempfile.TemporaryDirectory() as tmp:
+                crm = open_sqlite(args.sqlite_path or os.path.join(tmp, "crm.sqlite3"))
+                try:
+                    report(backend, run_backend(crm, args.count, args.repeat, args.seed))
+                finally:
+                    crm.pool.closeall()
+        else:
+            parser.error(f"unknown backend {backend!r}")
+
+
+if __name__ == "__main__":
+    main()
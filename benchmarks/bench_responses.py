@@ -0,0 +1,108 @@
+"""
+Compares Flask's stdlib `jsonify` with the orjson + compression layer in
+`marta_core.responses`.
+
+Serves synthetic payloads shaped like crm_api's `/clients` and the
+dashboard's `/api/data` from two throwaway Flask apps and reports, per
+payload, the time per response and the bytes on the wire for identity,
+gzip and zstd (when zstandard is installed). No database is needed:
+
+    python benchmarks/bench_responses.py --count 20000
+"""
+import argparse
+import datetime
+import decimal
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask, jsonify
+
+from marta_core import responses
+from marta_core.crm import ClientRecord, to_dicts
+
+
+def make_clients(count):
+    now = datetime.datetime(2025, 7, 1, 12, 0, 0)
+    return to_dicts(
+        ClientRecord(
+            i, f"Nombre{i}", f"Apellido{i}", "Gerente", f"cliente{i}@example.com",
+            f"+507 6000-{i % 10000:04d}", f"Empresa {i % 500}", "Notas de seguimiento",
+            now if i % 2 else None, "Email", {"priority": "medium"}, now, 1,
+        )
+        for i in range(count)
+    )
+
+
+def make_api_data(count):
+    start = datetime.date(2025, 1, 1)
+    provincias = ["Panamá", "Chiriquí", "Coclé", "Veraguas", "Herrera"]
+    data = [
+        {
+            "Invoice/CM #": f"F-{100000 + i}",
+            "Date": datetime.datetime.combine(start + datetime.timedelta(days=i % 180), datetime.time()),
+            "Customer ID": f"C{i % 900:04d}",
+            "Name": f"Veterinaria {i % 900}",
+            "Qty": decimal.Decimal(i % 12 + 1),
+            "Item Description": f"Alimento premium {i % 40} kg",
+            "Unit Price": decimal.Decimal("12.50") + i % 30,
+            "Vendedor": f"Vendedor {i % 15}",
+            "Provincia": provincias[i % len(provincias)],
+            "Ruta": f"Ruta {i % 25}",
+            "Tipo Cliente": "Clínica" if i % 3 else "Agropecuaria",
+            "Tipo": "Alimento",
+            "Total": (decimal.Decimal("12.50") + i % 30) * (i % 12 + 1),
+        }
+        for i in range(count)
+    ]
+    return {
+        "total_ventas": 1234567.89, "cantidad_facturas": count, "cantidad_clientes": 900,
+        "ticket_promedio": 137.2,
+        "filter_options": {"provincia": provincias, "ruta": [f"Ruta {i}" for i in range(25)]},
+        "data": data, "view_data": [], "message": f"Datos filtrados: {count} registros",
+    }
+
+
+def make_app(payloads, fast):
+    app = Flask(__name__)
+    if fast:
+        responses.init_app(app)
+    for name, payload in payloads.items():
+        app.add_url_rule(f"/{name}", name, lambda payload=payload: jsonify(payload))
+    return app
+
+
+def measure(client, path, accept_encoding, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.get(path, headers={"Accept-Encoding": accept_encoding})
+        size = len(response.get_data())
+        best = min(best, time.perf_counter() - start)
+    return best, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=20_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    payloads = {"clients": make_clients(args.count), "api_data": make_api_data(args.count)}
+    variants = [("stdlib jsonify", False, "identity")]
+    encodings = ["identity", "gzip"] + (["zstd"] if responses.zstandard is not None else [])
+    variants += [(f"orjson {encoding}", True, encoding) for encoding in encodings]
+
+    print(f"{args.count:,} rows per payload (best of {args.repeat})")
+    print(f"{'payload':<10}{'variant':<18}{'ms/response':>12}{'wire KiB':>12}")
+    for name in payloads:
+        for label, fast, encoding in variants:
+            client = make_app(payloads, fast).test_client()
+            seconds, size = measure(client, f"/{name}", encoding, args.repeat)
+            print(f"{name:<10}{label:<18}{seconds * 1000:>12.1f}{size / 1024:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
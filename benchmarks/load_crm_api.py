@@ -0,0 +1,294 @@
+"""
+Load test for crm_api against a local Postgres.
+
+`seed` fills the database named by the POSTGRES_* variables with synthetic
+clients (bench<i>@example.com) and one sales funnel entry per client, for
+a scale of 10k, 100k or 1M. It applies pending migrations first and can be
+re-run: clients that already exist are left alone.
+
+    python benchmarks/load_crm_api.py seed --scale 100k
+
+`run` drives a running crm_api (python -m marta_core.serve crm_api) with
+concurrent virtual users. Each user keeps one keep-alive session and picks
+routes from a weighted mix. The run reports throughput and p50/p95/p99
+latency per endpoint and writes them, along with the run parameters and
+git commit, to a JSON file for comparing builds:
+
+    python benchmarks/load_crm_api.py run --scale 100k --users 32 --duration 60 \\
+        --url http://127.0.0.1:5000 --output results/crm_api-100k.json
+
+/marta (LLM calls) and DELETE /sales_funnel (destructive) are not driven.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SCALES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+STAGES = ["Lead", "Contacted", "Proposal", "Negotiation", "Won", "Lost"]
+FIRST_NAMES = ["Ana", "Luis", "María", "Carlos", "Sofía", "Jorge", "Lucía", "Pedro", "Elena", "Diego"]
+LAST_NAMES = ["González", "Rodríguez", "Pérez", "Sánchez", "Ramírez", "Torres", "Flores", "Díaz", "Castillo", "Vargas"]
+
+
+def synthetic_client(i):
+    return {
+        "first_name": FIRST_NAMES[i % len(FIRST_NAMES)],
+        "last_name": f"{LAST_NAMES[i // len(FIRST_NAMES) % len(LAST_NAMES)]} {i}",
+        "position": "Gerente" if i % 3 else "Director",
+        "email": f"bench{i}@example.com",
+        "phone_number": f"+507 6{i % 1000:03d}-{i % 10000:04d}",
+        "company": f"Empresa {i % 5000}",
+        "notes": "Cliente interesado en alimento premium y vacunas" if i % 2 else "Seguimiento trimestral",
+        "last_contact": None,
+        "last_contact_source": "Email",
+        "ai_insights": {"priority": ["low", "medium", "high"][i % 3]},
+    }
+
+
+def seed(args):
+    from marta_core.crm import CRM
+    from marta_core.migrations import migrate
+
+    count = SCALES[args.scale]
+    migrate()
+    crm = CRM()
+
+    start = time.perf_counter()
+    result = crm.add_clients_bulk(synthetic_client(i) for i in range(count))
+    print(f"clients: {result} in {time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    with crm.pool.connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO sales_funnel (client_id, stage, status, notes, estimated_value, close_date)
+            SELECT c.id,
+                   (%(stages)s::text[])[1 + c.id %% cardinality(%(stages)s::text[])],
+                   'Open', 'Synthetic entry', (c.id %% 5000) * 10.0,
+                   CURRENT_DATE + (c.id %% 120)::int
+            FROM clients c
+            WHERE c.email LIKE 'bench%%@example.com'
+              AND NOT EXISTS (SELECT 1 FROM sales_funnel sf WHERE sf.client_id = c.id);
+            """,
+            {"stages": STAGES},
+        )
+        inserted = cur.rowcount
+        cur.execute("ANALYZE clients; ANALYZE sales_funnel;")
+        conn.commit()
+    print(f"sales_funnel: {inserted} inserted in {time.perf_counter() - start:.1f}s")
+
+
+class VirtualUser:
+    """Picks routes from the weighted mix and records (endpoint, seconds, ok) samples."""
+
+    def __init__(self, base_url, count, rng):
+        self.base_url = base_url.rstrip("/")
+        self.count = count
+        self.rng = rng
+        self.session = requests.Session()
+        self.samples = []
+        self.routes = [
+            ("GET /clients?limit", 10, self.clients_page),
+            ("GET /client/<email>", 25, self.get_client),
+            ("POST /clients/batch", 10, self.clients_batch),
+            ("GET /clients/search", 10, self.search),
+            ("PUT /client/<email>", 5, self.update_client),
+            ("POST /client", 3, self.add_client),
+            ("POST /clients/bulk", 1, self.bulk),
+            ("GET /sales_funnel", 1, self.sales_funnel),
+            ("GET /sales_funnel/summary", 10, self.summary),
+            ("GET /sales_funnel/analytics/conversion", 3, self.conversion),
+            ("GET /sales_funnel/analytics/time_in_stage", 3, self.time_in_stage),
+            ("GET /sales_funnel/<company>", 5, self.funnel_entry),
+            ("POST /sales_funnel", 2, self.add_funnel_entry),
+            ("PUT /sales_funnel/<client_id>", 2, self.update_funnel_entry),
+            ("GET /cache/stats", 1, self.cache_stats),
+        ]
+        self.weights = [weight for _, weight, _ in self.routes]
+
+    def email(self):
+        return f"bench{self.rng.randrange(self.count)}@example.com"
+
+    def request(self, method, path, **kwargs):
+        return self.session.request(method, self.base_url + path, timeout=60, **kwargs)
+
+    def clients_page(self):
+        return self.request("GET", "/clients", params={"limit": 100, "after": self.rng.randrange(self.count)})
+
+    def get_client(self):
+        return self.request("GET", f"/client/{self.email()}")
+
+    def clients_batch(self):
+        return self.request("POST", "/clients/batch", json={"emails": [self.email() for _ in range(50)]})
+
+    def search(self):
+        q = self.rng.choice([self.rng.choice(FIRST_NAMES), self.rng.choice(LAST_NAMES), "vacunas", "Gonzales"])
+        return self.request("GET", "/clients/search", params={"q": q, "limit": 20})
+
+    def update_client(self):
+        return self.request("PUT", f"/client/{self.email()}", json={"notes": f"Actualizado {time.time()}"})
+
+    def add_client(self):
+        i = self.rng.randrange(10**9)
+        return self.request("POST", "/client", json={
+            "first_name": "Nuevo", "last_name": f"Cliente {i}", "email": f"bench-new{i}@example.com",
+            "phone_number": "+507 6000-0000", "company": f"Empresa {i % 5000}",
+        })
+
+    def bulk(self):
+        lines = "\n".join(json.dumps(synthetic_client(self.rng.randrange(self.count))) for _ in range(100))
+        return self.request("POST", "/clients/bulk", params={"on_conflict": "update"}, data=lines.encode())
+
+    def sales_funnel(self):
+        return self.request("GET", "/sales_funnel")
+
+    def summary(self):
+        return self.request("GET", "/sales_funnel/summary")
+
+    def conversion(self):
+        return self.request("GET", "/sales_funnel/analytics/conversion")
+
+    def time_in_stage(self):
+        return self.request("GET", "/sales_funnel/analytics/time_in_stage")
+
+    def funnel_entry(self):
+        return self.request("GET", f"/sales_funnel/Empresa {self.rng.randrange(5000)}")
+
+    def add_funnel_entry(self):
+        return self.request("POST", "/sales_funnel", json={
+            "company": f"Empresa {self.rng.randrange(5000)}", "stage": "Lead", "status": "Open",
+            "notes": "Load test", "estimated_value": 100,
+        })
+
+    def update_funnel_entry(self):
+        return self.request("PUT", f"/sales_funnel/{self.rng.randrange(1, self.count)}", json={"stage": self.rng.choice(STAGES)})
+
+    def cache_stats(self):
+        return self.request("GET", "/cache/stats")
+
+    def run(self, deadline, record_after):
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                return
+            name, _, route = self.rng.choices(self.routes, self.weights)[0]
+            start = time.perf_counter()
+            try:
+                # 404s for random companies without an entry are expected answers.
+                ok = route().status_code < 500
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+            if start >= record_after:
+                self.samples.append((name, elapsed, ok))
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples, duration):
+    latencies = sorted(elapsed for _, elapsed, ok in samples if ok)
+    return {
+        "requests": len(samples),
+        "errors": sum(1 for _, _, ok in samples if not ok),
+        "throughput_rps": round(len(samples) / duration, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2) if latencies else None,
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    count = SCALES[args.scale]
+    users = [VirtualUser(args.url, count, random.Random(args.seed + i)) for i in range(args.users)]
+    start = time.perf_counter()
+    record_after = start + args.warmup
+    deadline = record_after + args.duration
+    threads = [threading.Thread(target=user.run, args=(deadline, record_after), daemon=True) for user in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    samples = [sample for user in users for sample in user.samples]
+    by_endpoint = {}
+    for sample in samples:
+        by_endpoint.setdefault(sample[0], []).append(sample)
+
+    report = {
+        "meta": {
+            "url": args.url,
+            "scale": args.scale,
+            "users": args.users,
+            "duration_s": args.duration,
+            "warmup_s": args.warmup,
+            "seed": args.seed,
+            "git_commit": git_commit(),
+            "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        },
+        "total": summarize(samples, args.duration),
+        "endpoints": {name: summarize(by_endpoint[name], args.duration) for name in sorted(by_endpoint)},
+    }
+
+    print(f"{'endpoint':<42}{'req':>8}{'err':>6}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for name, r in [*report["endpoints"].items(), ("TOTAL", report["total"])]:
+        print(f"{name:<42}{r['requests']:>8}{r['errors']:>6}{r['throughput_rps']:>9.1f}"
+              f"{r['p50_ms'] or 0:>9.1f}{r['p95_ms'] or 0:>9.1f}{r['p99_ms'] or 0:>9.1f}")
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.output}")
+
+
+def main():
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = commands.add_parser("seed", help="Load synthetic clients and funnel entries")
+    seed_parser.add_argument("--scale", choices=SCALES, default="10k")
+
+    run_parser = commands.add_parser("run", help="Drive a running crm_api and report latencies")
+    run_parser.add_argument("--url", default="http://127.0.0.1:5000")
+    run_parser.add_argument("--scale", choices=SCALES, default="10k", help="Scale the database was seeded with")
+    run_parser.add_argument("--users", type=int, default=16)
+    run_parser.add_argument("--duration", type=float, default=30.0)
+    run_parser.add_argument("--warmup", type=float, default=5.0)
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--output", help="JSON report path")
+
+    args = parser.parse_args()
+    if args.command == "seed":
+        seed(args)
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
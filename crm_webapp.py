@@ -1,9 +1,10 @@
 
 import os
-import requests
-from flask import Flask, render_template, flash
+from flask import Flask, render_template, flash, request
 from datetime import datetime
 
+from marta_core.crm_client import CRMClientError, client_from_env
+
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
 
@@ -11,27 +12,27 @@ app.secret_key = os.urandom(24)
 def inject_now():
     return {'now': datetime.utcnow()}
 
-# The base URL for the CRM API
-CRM_API_URL = "http://127.0.0.1:5000"
+# Talks to the CRM API at CRM_API_URL (default http://127.0.0.1:5000), or to the
+# database in-process when CRM_API_MODE=local.
+crm_client = client_from_env()
+
+CLIENTS_PAGE_SIZE = 100
 
 @app.route('/')
 def client_list():
+    after = request.args.get('after', type=int)
     try:
-        response = requests.get(f"{CRM_API_URL}/clients")
-        response.raise_for_status()  # Raise an exception for bad status codes
-        clients = response.json()
-    except requests.exceptions.RequestException as e:
+        clients, next_after = crm_client.get_clients_page(after=after, limit=CLIENTS_PAGE_SIZE)
+    except CRMClientError as e:
         flash(f"Error fetching clients: {e}", "danger")
-        clients = []
-    return render_template('crm_clients.html', clients=clients)
+        clients, next_after = [], None
+    return render_template('crm_clients.html', clients=clients, next_after=next_after)
 
 @app.route('/client/<email>')
 def client_profile(email):
     try:
-        response = requests.get(f"{CRM_API_URL}/client/{email}")
-        response.raise_for_status()
-        client = response.json()
-    except requests.exceptions.RequestException as e:
+        client = crm_client.get_client(email)
+    except CRMClientError as e:
         flash(f"Error fetching client details: {e}", "danger")
         client = None
     return render_template('crm_client_profile.html', client=client)
@@ -9,6 +9,7 @@ from google.cloud.sql.connector import Connector # Corrected import
 import logging
 import pandas as pd
 import io
+import sys
 from datetime import datetime, timedelta # timedelta was in your new simple_dashboard.py
 import secrets
 import re
@@ -235,6 +236,23 @@ if os.environ.get('GOOGLE_CLOUD_PROJECT'):
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', secrets.token_hex(32))
 app.config['JSON_AS_ASCII'] = False
 
+# orjson + gzip/zstd responses and Prometheus metrics shared with the Marta apps,
+# when the repo root is importable.
+_repo_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+if _repo_root not in sys.path:
+    sys.path.insert(0, _repo_root)
+try:
+    from marta_core.responses import init_app as init_responses
+    from marta_core import metrics
+    from marta_core.admission import llm_admission
+    init_responses(app)
+    metrics.init_app(app, "dashboard")
+    limit_llm = llm_admission.limit
+except ImportError as e:
+    metrics = None
+    limit_llm = lambda view: view
+    logger.warning(f"marta_core not available ({e}); using Flask's default JSON responses, no /metrics and no LLM admission control.")
+
 # Force HTTPS for redirects in production
 if os.environ.get('GOOGLE_CLOUD_PROJECT'):
     app.config['PREFERRED_URL_SCHEME'] = 'https'
@@ -432,6 +450,23 @@ def ensure_admin_user():
         logger.error(f"Error ensuring admin user: {e}")
         if 'conn' in locals() and conn: conn.close()
 
+def generate_content(prompt):
+    """gemini_model.generate_content, with latency and token metrics when marta_core is available."""
+    if metrics is None:
+        return gemini_model.generate_content(prompt)
+    model_name = os.environ.get("GEMINI_MODEL_NAME", "gemini-2.0-flash-001")
+    return metrics.generate_content(gemini_model, prompt, source="dashboard", model_name=model_name)
+
+# One Cloud SQL Connector per process: it owns a background refresh thread and
+# cached certificates, so it is created lazily (after fork under marta_core.serve).
+_cloud_sql_connector = None
+
+def get_cloud_sql_connector():
+    global _cloud_sql_connector
+    if _cloud_sql_connector is None:
+        _cloud_sql_connector = Connector()
+    return _cloud_sql_connector
+
 def get_db_connection():
     try:
         # Get environment variables
@@ -452,7 +487,7 @@ def get_db_connection():
         # Try Cloud SQL Connector first
         try:
             logger.info("[DB_CONNECTION] Attempting Cloud SQL Connector connection")
-            connector = Connector()
+            connector = get_cloud_sql_connector()
             conn = connector.connect(
                 db_instance_connection_name,
                 "pg8000",
@@ -460,6 +495,8 @@ def get_db_connection():
                 password=db_password,
                 db=db_name,
             )
+            if metrics:
+                conn = metrics.instrument_connection(conn)
             logger.info("[DB_CONNECTION] Cloud SQL Connector connection successful")
             return conn, "Conexión exitosa con Cloud SQL Connector"
         except Exception as cloud_sql_error:
@@ -479,6 +516,8 @@ def get_db_connection():
                     user=db_user,
                     password=db_password
                 )
+                if metrics:
+                    conn = metrics.instrument_connection(conn)
                 logger.info("[DB_CONNECTION] Direct psycopg2 connection successful")
                 return conn, "Conexión exitosa con conexión directa"
             except Exception as direct_error:
@@ -1091,6 +1130,7 @@ def api_db_status():
 # --- AI Assistant Endpoint (Integrated) ---
 @app.route('/api/ai/analytics_assistant', methods=['POST'])
 @login_required
+@limit_llm
 def api_ai_analytics_assistant():
     import uuid
     request_id = str(uuid.uuid4())[:8]
@@ -1645,7 +1685,7 @@ Respuesta como Ariadna Neuman:
         # Call Gemini model (your existing logic)
         try:
             logger.info("Calling Gemini model...")
-            response = gemini_model.generate_content(prompt)
+            response = generate_content(prompt)
             logger.info("Gemini model responded successfully")
         except Exception as gemini_error:
             logger.error(f"Error calling Gemini model: {str(gemini_error)}", exc_info=True)
@@ -2215,7 +2255,7 @@ def debug_ai():
     if VERTEX_AI_AVAILABLE and gemini_model:
         try:
             # Test a simple prompt
-            test_response = gemini_model.generate_content("Responde con: 'Test exitoso'")
+            test_response = generate_content("Responde con: 'Test exitoso'")
             if test_response.candidates and test_response.candidates[0].content.parts:
                 debug_info["test_result"] = "SUCCESS"
                 debug_info["test_response"] = test_response.candidates[0].content.parts[0].text
@@ -0,0 +1,257 @@
+"""
+Admission control for LLM-backed endpoints.
+
+At most `max_in_flight` LLM calls run at once across every process that
+shares the slot file (LLM_ADMISSION_LOCK_FILE; by default one file in the
+temp directory, so all workers and apps on the host or container). Each
+slot is an fcntl lock on one byte of that file, which the kernel drops if
+the holding process dies.
+
+Further callers wait for up to `queue_timeout` seconds, in a FIFO queue of
+at most `max_queue` entries per process. A waiting caller blocks the thread
+serving it, which under the default sync workers is the whole worker, so
+keep `queue_timeout` short. A caller that finds the queue full, or whose
+wait runs out, gets `AdmissionRejected` with a Retry-After estimate
+straight away instead of piling up behind the LLM.
+
+    @app.route("/marta", methods=["POST"])
+    @llm_admission.limit
+    def marta_endpoint(): ...
+
+Views that stream their answer use `@llm_admission.limit_stream`, which
+keeps the slot until the response is closed. Where a 429 is not the right
+answer:
+
+    try:
+        with llm_admission.slot():
+            ...
+    except AdmissionRejected as e:
+        ...
+
+`acquire()` returns a ticket that must be handed back to `release()`.
+Configured by LLM_MAX_IN_FLIGHT, LLM_MAX_QUEUE, LLM_QUEUE_TIMEOUT and
+LLM_ADMISSION_LOCK_FILE (empty: limit each process on its own).
+"""
+import fcntl
+import functools
+import math
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from flask import jsonify, make_response
+
+from .metrics import LLM_ADMISSION_IN_FLIGHT, LLM_ADMISSION_QUEUE_DEPTH, LLM_ADMISSION_REJECTED, LLM_ADMISSION_WAIT_SECONDS
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(f"LLM admission rejected ({reason}); retry after {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class SlotFile:
+    """
+    Counting semaphore shared between processes: slot i is an exclusive
+    fcntl lock on byte i of `path`. fcntl locks belong to the process, so
+    the slots this process holds are tracked here as well.
+    """
+
+    def __init__(self, path, slots):
+        self.path = path
+        self.slots = slots
+        self._fd = None
+        self._pid = None
+        self._held = set()
+        self._lock = threading.Lock()
+
+    def _file(self):
+        # Locks are not inherited through fork(): a child starts with none.
+        if self._fd is None or self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            self._pid = os.getpid()
+            self._held = set()
+        return self._fd
+
+    def try_acquire(self):
+        """The index of a slot now held by the caller, or None if all are taken."""
+        with self._lock:
+            fd = self._file()
+            for slot in range(self.slots):
+                if slot in self._held:
+                    continue
+                try:
+                    fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, slot)
+                except OSError:
+                    continue
+                self._held.add(slot)
+                return slot
+        return None
+
+    def release(self, slot):
+        with self._lock:
+            if slot in self._held:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, slot)
+                self._held.discard(slot)
+
+
+class LLMAdmission:
+    # How often a caller waiting for a slot held by another process retries.
+    poll_interval = 0.05
+
+    def __init__(self, max_in_flight=4, max_queue=16, queue_timeout=10.0, name="llm", lock_file=None):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.name = name
+        self.slot_file = SlotFile(lock_file, max_in_flight) if lock_file else None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiters = deque()  # threading.Event per queued caller, oldest first
+        # Moving average of how long a call holds its slot, for Retry-After.
+        self._avg_hold = queue_timeout
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_in_flight=int(os.environ.get("LLM_MAX_IN_FLIGHT", "4")),
+            max_queue=int(os.environ.get("LLM_MAX_QUEUE", "16")),
+            queue_timeout=float(os.environ.get("LLM_QUEUE_TIMEOUT", "10")),
+            lock_file=os.environ.get(
+                "LLM_ADMISSION_LOCK_FILE", os.path.join(tempfile.gettempdir(), f"marta-llm-admission-{os.getuid()}.lock"),
+            ),
+        )
+
+    def _retry_after(self):
+        # Time for everything ahead of the caller to drain through the slots.
+        return max(1, math.ceil(self._avg_hold * (len(self._waiters) + 1) / self.max_in_flight))
+
+    def _reject(self, reason):
+        LLM_ADMISSION_REJECTED.labels(self.name, reason).inc()
+        return AdmissionRejected(reason, self._retry_after())
+
+    def acquire(self):
+        """Waits for a slot and returns its ticket for `release()`; raises AdmissionRejected."""
+        start = time.perf_counter()
+        self._acquire_local()
+        if self.slot_file is None:
+            LLM_ADMISSION_WAIT_SECONDS.labels(self.name).observe(time.perf_counter() - start)
+            return None
+        # Our turn in this process; now a slot no other process holds.
+        deadline = start + self.queue_timeout
+        while True:
+            ticket = self.slot_file.try_acquire()
+            if ticket is not None:
+                LLM_ADMISSION_WAIT_SECONDS.labels(self.name).observe(time.perf_counter() - start)
+                return ticket
+            if time.perf_counter() >= deadline:
+                self._release_local()
+                with self._lock:
+                    raise self._reject("timeout")
+            time.sleep(self.poll_interval)
+
+    def _acquire_local(self):
+        with self._lock:
+            if self._in_flight < self.max_in_flight and not self._waiters:
+                self._in_flight += 1
+                LLM_ADMISSION_IN_FLIGHT.labels(self.name).inc()
+                return
+            if len(self._waiters) >= self.max_queue:
+                raise self._reject("queue_full")
+            admitted = threading.Event()
+            self._waiters.append(admitted)
+            LLM_ADMISSION_QUEUE_DEPTH.labels(self.name).inc()
+
+        # _release_local() hands its slot straight to the oldest waiter, so
+        # _in_flight is already counted for us when the event is set.
+        admitted.wait(self.queue_timeout)
+        with self._lock:
+            if not admitted.is_set():
+                self._waiters.remove(admitted)
+                LLM_ADMISSION_QUEUE_DEPTH.labels(self.name).dec()
+                raise self._reject("timeout")
+
+    def release(self, ticket, held=None):
+        if ticket is not None:
+            self.slot_file.release(ticket)
+        self._release_local(held)
+
+    def _release_local(self, held=None):
+        with self._lock:
+            if held is not None:
+                self._avg_hold += 0.2 * (held - self._avg_hold)
+            if self._waiters:
+                self._waiters.popleft().set()
+                LLM_ADMISSION_QUEUE_DEPTH.labels(self.name).dec()
+            else:
+                self._in_flight -= 1
+                LLM_ADMISSION_IN_FLIGHT.labels(self.name).dec()
+
+    @contextmanager
+    def slot(self):
+        ticket = self.acquire()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(ticket, time.perf_counter() - start)
+
+    def limit(self, view):
+        """Flask view decorator: runs the view inside a slot, or answers 429 with Retry-After."""
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                with self.slot():
+                    return view(*args, **kwargs)
+            except AdmissionRejected as e:
+                return too_many_requests(e)
+        return wrapper
+
+    def limit_stream(self, view):
+        """
+        Like `limit`, for views that return a streamed response: the slot is
+        held until the response has been sent (or the client went away) and
+        the server closes it, not just until the view returns.
+        """
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                ticket = self.acquire()
+            except AdmissionRejected as e:
+                return too_many_requests(e)
+            start = time.perf_counter()
+            try:
+                response = make_response(view(*args, **kwargs))
+            except BaseException:
+                self.release(ticket, time.perf_counter() - start)
+                raise
+            response.call_on_close(lambda: self.release(ticket, time.perf_counter() - start))
+            return response
+        return wrapper
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": self._in_flight,
+                "queued": len(self._waiters),
+                "max_in_flight": self.max_in_flight,
+                "max_queue": self.max_queue,
+                "queue_timeout": self.queue_timeout,
+            }
+
+
+def too_many_requests(rejection):
+    response = jsonify({
+        "error": "Marta está atendiendo demasiadas solicitudes; inténtalo de nuevo en unos segundos.",
+        "retry_after": rejection.retry_after,
+    })
+    response.status_code = 429
+    response.headers["Retry-After"] = str(rejection.retry_after)
+    return response
+
+
+llm_admission = LLMAdmission.from_env()
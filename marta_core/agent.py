@@ -1,23 +1,32 @@
 # marta_core/agent.py
 
+import asyncio
+import json
 import os
+import queue
+import re
+import threading
 from datetime import datetime
 import pytz 
 
 from langchain_google_vertexai import ChatVertexAI
+from langchain_google_vertexai.embeddings import VertexAIEmbeddings
 from langchain.agents import AgentExecutor, create_structured_chat_agent
 from langchain.memory import ConversationBufferWindowMemory
+from langchain_core.callbacks import BaseCallbackHandler, UsageMetadataCallbackHandler
 from langchain_core.chat_history import BaseChatMessageHistory
 from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_core.prompts import (
-    ChatPromptTemplate, 
-    SystemMessagePromptTemplate, 
-    MessagesPlaceholder, 
-    HumanMessagePromptTemplate
-)
-from langchain_core.messages import SystemMessage 
-from langchain import hub 
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage 
 
+from . import metrics
+from .answer_cache import READ_ONLY_TOOLS, answer_cache_from_env
+from .history import history_store_from_env
+from .prompts import (
+    STRUCTURED_CHAT_HUMAN_TEMPLATE,
+    STRUCTURED_CHAT_PROMPT_VERSION,
+    STRUCTURED_CHAT_SYSTEM_TEMPLATE,
+)
 from .tools import available_tools 
 from dotenv import load_dotenv
 
@@ -28,20 +37,74 @@ GOOGLE_CLOUD_PROJECT = os.getenv('GOOGLE_CLOUD_PROJECT')
 raw_region_agent = os.getenv('GOOGLE_CLOUD_REGION', 'us-central1') 
 GOOGLE_CLOUD_REGION = raw_region_agent.split('#')[0].strip() 
 MODEL_NAME = os.getenv('GEMINI_CHAT_MODEL', "gemini-2.0-flash-001") 
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', "text-embedding-004")
 
 # --- Variables Globales para el Agente (se inicializarán de forma perezosa) ---
 llm_instance = None
 prompt_instance = None
 agent_instance = None
 agent_executor_instance = None
+runnable_with_history_instance = None
+_init_lock = threading.Lock()
 
-# This dictionary will store message histories for different sessions
-store = {}
+# Historiales por sesión, acotados en memoria y opcionalmente persistidos (ver marta_core/history.py).
+history_store = history_store_from_env()
 
 def get_session_history(session_id: str) -> BaseChatMessageHistory:
-    if session_id not in store:
-        store[session_id] = BaseChatMessageHistory()
-    return store[session_id]
+    return history_store.get(session_id)
+
+
+# --- Caché semántica de respuestas (opcional, MARTA_ANSWER_CACHE=1; ver marta_core/answer_cache.py) ---
+embeddings_instance = None
+
+def _embed_question(text):
+    global embeddings_instance
+    if embeddings_instance is None:
+        embeddings_instance = VertexAIEmbeddings(model_name=EMBEDDING_MODEL, project=GOOGLE_CLOUD_PROJECT, location=GOOGLE_CLOUD_REGION)
+    return embeddings_instance.embed_query(text)
+
+answer_cache = answer_cache_from_env(_embed_question)
+
+
+class _ToolRecorder(BaseCallbackHandler):
+    """Anota qué herramientas usó el agente en el turno."""
+
+    def __init__(self):
+        self.tools = set()
+
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        self.tools.add(kwargs.get("name") or (serialized or {}).get("name"))
+
+
+def _lookup_answer(user_input, session_id):
+    """
+    Retorna (respuesta, vector, cacheable). Solo se consulta y se guarda el
+    primer turno de una sesión: con conversación previa la pregunta puede
+    depender del contexto ("¿y cuánto cuesta?") y la misma frase significa
+    otra cosa en otra sesión. Un acierto queda en el historial como si Marta
+    hubiera respondido.
+    """
+    if answer_cache is None:
+        return None, None, False
+    history = get_session_history(session_id)
+    if history.messages:
+        return None, None, False
+    answer, vector = answer_cache.lookup(user_input)
+    if answer is not None:
+        history.add_messages([HumanMessage(content=user_input), AIMessage(content=answer)])
+    return answer, vector, True
+
+
+def _remember_answer(user_input, answer, vector, tools_used):
+    # Solo respuestas sacadas de la base de conocimiento: sin herramientas la
+    # respuesta viene del contexto (la conversación, la hora actual: "¿qué día
+    # es hoy?"). Nada de turnos que enviaron correos, crearon eventos o leyeron
+    # la bandeja (un error de formato también cuenta como herramienta,
+    # "_Exception"), ni el aviso de AgentExecutor al agotar max_iterations.
+    if answer_cache is None or not answer or answer.startswith("Agent stopped"):
+        return
+    if tools_used and tools_used <= READ_ONLY_TOOLS:
+        answer_cache.store(user_input, answer, vector)
 
 
 def get_current_time_in_panama():
@@ -54,9 +117,8 @@ def get_current_time_in_panama():
         now_utc = datetime.now(pytz.utc)
         return now_utc.strftime('%A, %d de %B de %Y, %H:%M:%S %Z')
 
-CURRENT_TIME = get_current_time_in_panama()
-
-MARTA_PREAMBLE = f"""
+# {current_time} se resuelve en cada llamada (ver _build_prompt), no al importar el módulo.
+MARTA_PREAMBLE = """
 Eres Marta Maria Mendez (mmendez@datanalisis.io), una asistente de IA altamente competente,
 profesional y amable, diseñada para datanalisis.io. Tu objetivo es ayudar a los usuarios
 a ser más productivos, gestionar su agenda y sus comunicaciones.
@@ -86,7 +148,7 @@ Tus capacidades (Herramientas):
   suficiente información, PREGUNTA al usuario antes de intentar usar la herramienta.
 - Para agendar citas, SIEMPRE debes confirmar la fecha y hora EXACTA en formato<y_bin_46>-MM-DDTHH:MM:SS.
   Si el usuario dice "mañana", debes calcular la fecha correcta.
-- La fecha y hora actual es: {CURRENT_TIME}. Usa esto como referencia para fechas relativas.
+- La fecha y hora actual es: {current_time}. Usa esto como referencia para fechas relativas.
 
 Instrucciones de conversación:
 - Responde SIEMPRE en Español.
@@ -104,110 +166,329 @@ Instrucciones Específicas para Correos:
 Ahora, ¡comienza a conversar y a ayudar!
 """
 
+def _build_prompt():
+    """Prompt del agente a partir de la plantilla local (marta_core/prompts.py), sin consultar el hub."""
+    system_template = (
+        MARTA_PREAMBLE
+        + "\n--- INSTRUCCIONES DEL AGENTE (BASADAS EN PLANTILLA ESTÁNDAR) ---\n"
+        + STRUCTURED_CHAT_SYSTEM_TEMPLATE
+    )
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", system_template),
+        MessagesPlaceholder(variable_name="chat_history"),
+        ("human", STRUCTURED_CHAT_HUMAN_TEMPLATE),
+    ])
+    return prompt.partial(current_time=get_current_time_in_panama)
+
+
 def _initialize_agent_components():
-    """Inicializa llm, prompt, agent y agent_executor si no están ya inicializados."""
-    global llm_instance, prompt_instance, agent_instance, agent_executor_instance, memory_instance
+    """
+    Construye una sola vez por proceso llm, prompt, agent, agent_executor y el
+    runnable con historial que usa ask_marta. Retorna el AgentExecutor, o None
+    si algo falla (el siguiente llamado lo vuelve a intentar).
+    """
+    global llm_instance, prompt_instance, agent_instance, agent_executor_instance, runnable_with_history_instance
 
-    if agent_executor_instance is not None:
-        print("--- AGENT (Getter): AgentExecutor ya inicializado. ---")
+    if runnable_with_history_instance is not None:
         return agent_executor_instance
 
-    print("--- AGENT (Getter): Intentando inicializar componentes del agente... ---")
-
-    # 1. Inicializar LLM
-    if llm_instance is None:
-        print(f"--- AGENT (Getter): REGIÓN PARA CHAT LLM: {GOOGLE_CLOUD_REGION} ---")
-        print(f"--- AGENT (Getter): Intentando cargar el modelo de chat: {MODEL_NAME} ---")
-        try:
-            llm_instance = ChatVertexAI(
-                model_name=MODEL_NAME, 
-                project=GOOGLE_CLOUD_PROJECT,
-                location=GOOGLE_CLOUD_REGION, 
-                temperature=0.3, 
-            )
-            print(f"--- AGENT (Getter): Modelo {MODEL_NAME} cargado exitosamente. ---")
-        except Exception as e:
-            print(f"--- AGENT (Getter): Error al cargar el modelo Gemini ({MODEL_NAME}): {e} ---")
-            return None # No se puede continuar sin LLM
-
-    # 2. Crear Prompt
-    if prompt_instance is None and llm_instance is not None:
-        try:
-            pulled_prompt: ChatPromptTemplate = hub.pull("hwchase17/structured-chat-agent")
-            if not (isinstance(pulled_prompt.messages[0], SystemMessagePromptTemplate) and 
-                    hasattr(pulled_prompt.messages[0].prompt, 'template')):
-                raise ValueError("La estructura del prompt del hub no es la esperada para SystemMessage.")
-            original_system_template_str = pulled_prompt.messages[0].prompt.template
-            final_system_content = MARTA_PREAMBLE + "\n--- INSTRUCCIONES DEL AGENTE (BASADAS EN PLANTILLA ESTÁNDAR) ---\n" + original_system_template_str
-            new_system_message_prompt = SystemMessagePromptTemplate.from_template(final_system_content)
-            new_messages_list = [new_system_message_prompt] 
-            for i in range(1, len(pulled_prompt.messages)):
-                msg_template = pulled_prompt.messages[i]
-                if isinstance(msg_template, MessagesPlaceholder) and hasattr(msg_template, 'variable_name'):
-                    new_messages_list.append(MessagesPlaceholder(variable_name=msg_template.variable_name))
-                elif isinstance(msg_template, HumanMessagePromptTemplate) and hasattr(msg_template.prompt, 'template'):
-                     new_messages_list.append(HumanMessagePromptTemplate.from_template(msg_template.prompt.template))
-            prompt_instance = ChatPromptTemplate.from_messages(new_messages_list)
-            print("--- AGENT (Getter): Prompt personalizado creado. ---")
-        except Exception as e:
-            print(f"--- AGENT (Getter): Error al crear el prompt: {e} ---")
-            return None # No se puede continuar sin Prompt
-
-    # 3. Crear Agente
-    if agent_instance is None and llm_instance is not None and prompt_instance is not None:
-        try:
-            print(f"--- AGENT (Getter DEBUG): available_tools: {[tool.name for tool in available_tools if hasattr(tool, 'name')]} ---")
-            agent_instance = create_structured_chat_agent(llm=llm_instance, tools=available_tools, prompt=prompt_instance)
-            print("--- AGENT (Getter): Agente de Langchain creado. ---")
-        except Exception as e:
-            print(f"--- AGENT (Getter): Error al crear el agente: {e} ---")
-            return None # No se puede continuar sin Agente
-
-    # 4. Crear AgentExecutor
-    if agent_executor_instance is None and agent_instance is not None:
-        try:
-            agent_executor_instance = AgentExecutor(
-                agent=agent_instance, 
-                tools=available_tools, 
-                verbose=True, 
-                handle_parsing_errors=True, 
-                max_iterations=7, 
-            )
-            print(f"--- AGENT (Getter): AgentExecutor creado. Marta está lista. agent_executor: {agent_executor_instance!r} ---")
-        except Exception as e:
-            print(f"--- AGENT (Getter): Error al crear el AgentExecutor: {e} ---")
-            return None
-            
+    with _init_lock:
+        # Otro hilo pudo terminar la inicialización mientras esperábamos el lock.
+        if runnable_with_history_instance is not None:
+            return agent_executor_instance
+
+        print("--- AGENT (Getter): Intentando inicializar componentes del agente... ---")
+
+        # 1. Inicializar LLM
+        if llm_instance is None:
+            print(f"--- AGENT (Getter): REGIÓN PARA CHAT LLM: {GOOGLE_CLOUD_REGION} ---")
+            print(f"--- AGENT (Getter): Intentando cargar el modelo de chat: {MODEL_NAME} ---")
+            try:
+                llm_instance = ChatVertexAI(
+                    model_name=MODEL_NAME, 
+                    project=GOOGLE_CLOUD_PROJECT,
+                    location=GOOGLE_CLOUD_REGION, 
+                    temperature=0.3, 
+                )
+                print(f"--- AGENT (Getter): Modelo {MODEL_NAME} cargado exitosamente. ---")
+            except Exception as e:
+                print(f"--- AGENT (Getter): Error al cargar el modelo Gemini ({MODEL_NAME}): {e} ---")
+                return None # No se puede continuar sin LLM
+
+        # 2. Crear Prompt
+        if prompt_instance is None:
+            try:
+                prompt_instance = _build_prompt()
+                print(f"--- AGENT (Getter): Prompt personalizado creado ({STRUCTURED_CHAT_PROMPT_VERSION}). ---")
+            except Exception as e:
+                print(f"--- AGENT (Getter): Error al crear el prompt: {e} ---")
+                return None # No se puede continuar sin Prompt
+
+        # 3. Crear Agente
+        if agent_instance is None:
+            try:
+                print(f"--- AGENT (Getter DEBUG): available_tools: {[tool.name for tool in available_tools if hasattr(tool, 'name')]} ---")
+                agent_instance = create_structured_chat_agent(llm=llm_instance, tools=available_tools, prompt=prompt_instance)
+                print("--- AGENT (Getter): Agente de Langchain creado. ---")
+            except Exception as e:
+                print(f"--- AGENT (Getter): Error al crear el agente: {e} ---")
+                return None # No se puede continuar sin Agente
+
+        # 4. Crear AgentExecutor
+        if agent_executor_instance is None:
+            try:
+                agent_executor_instance = AgentExecutor(
+                    agent=agent_instance, 
+                    tools=available_tools, 
+                    verbose=True, 
+                    handle_parsing_errors=True, 
+                    max_iterations=7, 
+                )
+                print(f"--- AGENT (Getter): AgentExecutor creado. agent_executor: {agent_executor_instance!r} ---")
+            except Exception as e:
+                print(f"--- AGENT (Getter): Error al crear el AgentExecutor: {e} ---")
+                return None
+
+        # 5. Envolver el executor con el historial de la sesión
+        runnable_with_history_instance = RunnableWithMessageHistory(
+            agent_executor_instance,
+            get_session_history,
+            input_messages_key="input",
+            history_messages_key="chat_history",
+        )
+        print("--- AGENT (Getter): Marta está lista. ---")
+
     return agent_executor_instance
 
 # Intento de inicialización temprana al cargar el módulo (puede o no funcionar en todos los contextos de Flask)
 # _initialize_agent_components() # Comentado para forzar la inicialización solo a través de ask_marta
 
-def ask_marta(user_input: str, session_id: str = "default_session") -> str:
+def ask_marta(user_input: str, session_id: str = "default_session", use_cache: bool = True) -> str:
     """
     Envía una pregunta o instrucción a Marta y retorna su respuesta.
+    use_cache=False para prompts armados a partir de datos de un tercero (el
+    cuerpo de un correo): uno parecido no debe recibir la respuesta escrita
+    para otro.
     """
-    agent_executor = _initialize_agent_components() # Asegura que esté inicializado
+    cached, vector, cacheable = _lookup_answer(user_input, session_id) if use_cache else (None, None, False)
+    if cached is not None:
+        return cached
 
-    if not agent_executor:
+    if not _initialize_agent_components(): # Asegura que esté inicializado
         return "Lo siento, no estoy operativa en este momento debido a un error de configuración con el agente o el LLM."
 
-    # Create a new runnable with message history
-    runnable_with_history = RunnableWithMessageHistory(
-        agent_executor,
-        get_session_history,
-        input_messages_key="input",
-        history_messages_key="chat_history",
-    )
-
     try:
-        response_dict = runnable_with_history.invoke(
-            {"input": user_input},
-            config={"configurable": {"session_id": session_id}},
-        )
-        return response_dict.get('output', "No pude generar una respuesta clara.")
+        # Suma los tokens de todas las llamadas al LLM que hace el agente en este turno.
+        usage = UsageMetadataCallbackHandler()
+        tools = _ToolRecorder()
+        with metrics.llm_timer("ask_marta", MODEL_NAME) as call:
+            response_dict = runnable_with_history_instance.invoke(
+                {"input": user_input},
+                config={"configurable": {"session_id": session_id}, "callbacks": [usage, tools]},
+            )
+            call.tokens(
+                sum(u.get("input_tokens", 0) for u in usage.usage_metadata.values()),
+                sum(u.get("output_tokens", 0) for u in usage.usage_metadata.values()),
+            )
+        output = response_dict.get('output')
+        if cacheable:
+            _remember_answer(user_input, output, vector, tools.tools)
+        return output or "No pude generar una respuesta clara."
     except Exception as e:
         print(f"Error durante la ejecución del agente en ask_marta: {e}")
         import traceback
         print(traceback.format_exc()) 
-        return f"Lo siento, ocurrió un error inesperado al procesar tu solicitud: {str(e)}"
\ No newline at end of file
+        return f"Lo siento, ocurrió un error inesperado al procesar tu solicitud: {str(e)}"
+
+
+# --- Streaming ---
+
+_JSON_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class FinalAnswerStream:
+    """
+    Extrae, a medida que llegan los tokens, el texto de la respuesta final del
+    blob JSON del agente estructurado ({"action": "Final Answer", "action_input": "..."}).
+    `feed()` recibe cada fragmento del modelo y retorna el texto nuevo de la respuesta.
+    """
+    _START = re.compile(r'"action"\s*:\s*"Final Answer"\s*,\s*"action_input"\s*:\s*"')
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = None  # siguiente carácter por decodificar de action_input
+        self._done = False
+
+    def feed(self, text):
+        if self._done:
+            return ""
+        self._buffer += text
+        if self._pos is None:
+            match = self._START.search(self._buffer)
+            if not match:
+                return ""
+            self._pos = match.end()
+        buf, i, out = self._buffer, self._pos, []
+        while i < len(buf):
+            ch = buf[i]
+            if ch == '"':
+                self._done = True
+                break
+            if ch != "\\":
+                out.append(ch)
+                i += 1
+                continue
+            # Secuencia de escape: si llegó incompleta, se espera al siguiente fragmento.
+            if i + 1 >= len(buf):
+                break
+            if buf[i + 1] != "u":
+                out.append(_JSON_ESCAPES.get(buf[i + 1], buf[i + 1]))
+                i += 2
+                continue
+            end = i + 6
+            try:
+                if end <= len(buf) and 0xD800 <= int(buf[i + 2:end], 16) < 0xDC00:
+                    end += 6  # par sustituto (\ud83d\ude00), se decodifica junto
+                if end > len(buf):
+                    break
+                out.append(json.loads(f'"{buf[i:end]}"'))
+            except ValueError:
+                out.append(buf[i:end])
+            i = end
+        self._pos = i
+        return "".join(out)
+
+
+def _chunk_text(chunk):
+    if isinstance(chunk.content, str):
+        return chunk.content
+    return "".join(part.get("text", "") if isinstance(part, dict) else str(part) for part in chunk.content)
+
+
+async def _astream_marta(user_input, session_id):
+    # El embedding es una llamada de red bloqueante; no debe detener el loop.
+    cached, vector, cacheable = await asyncio.to_thread(_lookup_answer, user_input, session_id)
+    if cached is not None:
+        yield {"type": "final", "output": cached}
+        return
+
+    if not _initialize_agent_components():
+        yield {"type": "error", "message": "Lo siento, no estoy operativa en este momento debido a un error de configuración con el agente o el LLM."}
+        return
+
+    usage = UsageMetadataCallbackHandler()
+    answers = {}  # run_id de cada llamada al modelo -> FinalAnswerStream
+    tools_used = set()
+    root_run_id = output = None
+    try:
+        with metrics.llm_timer("ask_marta_stream", MODEL_NAME) as call:
+            async for event in runnable_with_history_instance.astream_events(
+                {"input": user_input},
+                config={"configurable": {"session_id": session_id}, "callbacks": [usage]},
+                version="v2",
+            ):
+                kind = event["event"]
+                root_run_id = root_run_id or event["run_id"]
+                if kind == "on_chat_model_stream":
+                    answer = answers.setdefault(event["run_id"], FinalAnswerStream())
+                    text = answer.feed(_chunk_text(event["data"]["chunk"]))
+                    if text:
+                        yield {"type": "token", "text": text}
+                elif kind == "on_tool_start":
+                    tools_used.add(event["name"])
+                    yield {"type": "tool_start", "tool": event["name"]}
+                elif kind == "on_tool_end":
+                    yield {"type": "tool_end", "tool": event["name"]}
+                elif kind == "on_chain_end" and event["run_id"] == root_run_id:
+                    output = event["data"]["output"].get("output")
+            call.tokens(
+                sum(u.get("input_tokens", 0) for u in usage.usage_metadata.values()),
+                sum(u.get("output_tokens", 0) for u in usage.usage_metadata.values()),
+            )
+        if output and cacheable:
+            await asyncio.to_thread(_remember_answer, user_input, output, vector, tools_used)
+        yield {"type": "final", "output": output or "No pude generar una respuesta clara."}
+    except Exception as e:
+        print(f"Error durante la ejecución del agente en ask_marta_stream: {e}")
+        import traceback
+        print(traceback.format_exc())
+        yield {"type": "error", "message": f"Lo siento, ocurrió un error inesperado al procesar tu solicitud: {str(e)}"}
+
+
+# Un solo event loop por proceso para las corridas en streaming: los clientes
+# asíncronos de Vertex AI quedan ligados al loop en que se crearon.
+_stream_loop = None
+_stream_loop_pid = None
+_stream_loop_lock = threading.Lock()
+_STREAM_END = object()
+
+
+def _get_stream_loop():
+    global _stream_loop, _stream_loop_pid
+    with _stream_loop_lock:
+        if _stream_loop is None or _stream_loop_pid != os.getpid():
+            _stream_loop = asyncio.new_event_loop()
+            _stream_loop_pid = os.getpid()
+            threading.Thread(target=_stream_loop.run_forever, name="marta-stream-loop", daemon=True).start()
+        return _stream_loop
+
+
+async def _pump(events, user_input, session_id):
+    try:
+        async for event in _astream_marta(user_input, session_id):
+            events.put(event)
+    finally:
+        events.put(_STREAM_END)
+
+
+class _EventStream:
+    """
+    Los eventos de una corrida en el loop de streaming. A diferencia de un
+    generador, close() se puede llamar desde otro hilo mientras uno espera en
+    next() (Starlette lee el stream en su threadpool y lo cierra desde el
+    loop al desconectarse el cliente).
+    """
+
+    def __init__(self, user_input, session_id):
+        self._events = queue.Queue()
+        self._future = asyncio.run_coroutine_threadsafe(_pump(self._events, user_input, session_id), _get_stream_loop())
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._closed:
+            raise StopIteration
+        event = self._events.get()
+        if event is _STREAM_END:
+            self._closed = True
+            raise StopIteration
+        return event
+
+    def close(self):
+        # Cancelar el future cancela la tarea en el hilo del loop. Si aún no
+        # había empezado, _pump no llega a poner _STREAM_END: se pone aquí
+        # para despertar a quien espera en next().
+        self._closed = True
+        self._future.cancel()
+        self._events.put(_STREAM_END)
+
+    def __del__(self):
+        self.close()
+
+
+def ask_marta_stream(user_input: str, session_id: str = "default_session"):
+    """
+    Como ask_marta, pero genera los eventos del turno a medida que ocurren:
+
+        {"type": "tool_start", "tool": "BuscarInformacionDatanalisis"}
+        {"type": "tool_end", "tool": "BuscarInformacionDatanalisis"}
+        {"type": "token", "text": "Datanalisis.io ofrece"}   # fragmentos de la respuesta final
+        {"type": "final", "output": "..."}                   # la respuesta completa, siempre al final
+        {"type": "error", "message": "..."}                  # en lugar de "final"
+
+    Quien consume debe llamar a close() si deja de leer antes del final (el
+    cliente se desconectó): cancela la corrida del agente.
+    """
+    return _EventStream(user_input, session_id)
@@ -0,0 +1,176 @@
+"""
+Semantic answer cache for `ask_marta`.
+
+Many questions Marta gets are the same informational question in different
+words ("¿qué servicios ofrece datanalisis.io?"). `SemanticAnswerCache`
+stores the answers to such turns, keyed by the normalized question and its
+embedding. A later question whose embedding has a cosine similarity of at
+least `threshold` with a stored one gets the stored answer without an agent
+run. An identical normalized question is a hit without an embedding call.
+
+The cache is opt-in (MARTA_ANSWER_CACHE=1), bounded to `maxsize` entries
+(LRU) and `ttl` seconds per entry. Whether a turn may be stored is decided
+by the caller; `agent.ask_marta` only looks up and stores the first turn of
+a session, and only stores successful answers that used READ_ONLY_TOOLS and
+nothing else, since an answer without tools depends on the clock. Prompts
+built from a third party's text (suggested email replies) skip the cache.
+Lookups are counted in the marta_answer_cache_* metrics and in `stats()`.
+"""
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+from .metrics import ANSWER_CACHE_LOOKUPS, ANSWER_CACHE_SIMILARITY
+
+logger = logging.getLogger(__name__)
+
+# Tools whose result does not depend on who asks or when, and that change
+# nothing. Reading the inbox has no side effects, but its answer goes stale.
+READ_ONLY_TOOLS = frozenset({"BuscarInformacionDatanalisis"})
+
+_NON_WORD = re.compile(r"[^\w]+")
+
+
+def normalize_question(text):
+    """Lower-cased, without accents, punctuation or repeated spaces."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return _NON_WORD.sub(" ", text).strip()
+
+
+class SemanticAnswerCache:
+    def __init__(self, embed, threshold=0.92, maxsize=500, ttl=86400.0, clock=time.monotonic):
+        self.embed = embed  # text -> list of floats
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()  # normalized question -> (expires_at, unit vector, answer)
+        self._matrix = None  # stacked vectors of _entries, rebuilt after a change
+        self._keys = []
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _unit(self, text):
+        vector = np.asarray(self.embed(text), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _count(self, result):
+        if result == "miss":
+            self.misses += 1
+        else:
+            self.hits += 1
+        ANSWER_CACHE_LOOKUPS.labels(result).inc()
+
+    def _expire(self):
+        now = self._clock()
+        expired = [key for key, (expires_at, _, _) in self._entries.items() if expires_at <= now]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self.expirations += len(expired)
+            self._matrix = None
+
+    def lookup(self, question):
+        """
+        Returns (answer, vector): the stored answer or None, and the
+        question's embedding (None when it was not needed or could not be
+        computed), to pass on to `store()`.
+        """
+        key = normalize_question(question)
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._count("hit_exact")
+                return entry[2], entry[1]
+            if not self._entries:
+                self._count("miss")
+                return None, None
+
+        try:
+            vector = self._unit(key)
+        except Exception:
+            logger.exception("Could not embed the question; skipping the answer cache")
+            with self._lock:
+                self._count("miss")
+            return None, None
+
+        with self._lock:
+            if self._matrix is None:
+                self._keys = list(self._entries)
+                self._matrix = np.stack([self._entries[k][1] for k in self._keys]) if self._keys else None
+            if self._matrix is None:
+                self._count("miss")
+                return None, vector
+            similarities = self._matrix @ vector
+            best = int(np.argmax(similarities))
+            ANSWER_CACHE_SIMILARITY.observe(float(similarities[best]))
+            if similarities[best] < self.threshold:
+                self._count("miss")
+                return None, vector
+            best_key = self._keys[best]
+            self._entries.move_to_end(best_key)
+            self._count("hit_semantic")
+            return self._entries[best_key][2], vector
+
+    def store(self, question, answer, vector=None):
+        if self.maxsize <= 0:
+            return
+        key = normalize_question(question)
+        if vector is None:
+            try:
+                vector = self._unit(key)
+            except Exception:
+                logger.exception("Could not embed the question; not caching the answer")
+                return
+        with self._lock:
+            self._entries[key] = (self._clock() + self.ttl, vector, answer)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._matrix = None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+def answer_cache_from_env(embed):
+    """The cache configured by MARTA_ANSWER_CACHE_*, or None unless MARTA_ANSWER_CACHE=1."""
+    if os.environ.get("MARTA_ANSWER_CACHE", "0") != "1":
+        return None
+    return SemanticAnswerCache(
+        embed,
+        threshold=float(os.environ.get("MARTA_ANSWER_CACHE_THRESHOLD", "0.92")),
+        maxsize=int(os.environ.get("MARTA_ANSWER_CACHE_SIZE", "500")),
+        ttl=float(os.environ.get("MARTA_ANSWER_CACHE_TTL", "86400")),
+    )
@@ -0,0 +1,101 @@
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Bounded, thread-safe in-process cache with per-entry TTL and LRU eviction.
+
+    Keeps hit/miss/eviction/expiration counters so the size and TTL can be
+    tuned from `stats()`. A `maxsize` of 0 disables caching.
+
+    `generation` counts invalidations. A read-through caller records it
+    before reading the source and stores with `set_if_unchanged()`, so a row
+    read before a concurrent write and its invalidation is not cached.
+    """
+
+    def __init__(self, maxsize=1024, ttl=30.0, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.generation = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= self._clock():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def set_if_unchanged(self, key, value, generation, ttl=None):
+        """Like `set`, unless anything was invalidated since `generation` was read."""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            if self.generation == generation:
+                self._set(key, value, ttl)
+
+    def _set(self, key, value, ttl):
+        self._data[key] = (self._clock() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self.generation += 1
+
+    def invalidate_where(self, predicate):
+        """Drops every entry whose value matches `predicate`; a scan of the whole cache."""
+        with self._lock:
+            for key in [key for key, (_, value) in self._data.items() if predicate(value)]:
+                del self._data[key]
+            self.generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.generation += 1
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
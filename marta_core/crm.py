@@ -1,62 +1,257 @@
-import psycopg2
-import os
 import datetime
+import json
+import os
+from collections import namedtuple
 
-class CRM:
-    def __init__(self):
-        self.conn = psycopg2.connect(
-            dbname=os.environ.get("POSTGRES_DB"),
-            user=os.environ.get("POSTGRES_USER"),
-            password=os.environ.get("POSTGRES_PASSWORD"),
-            host=os.environ.get("POSTGRES_HOST"),
-            port=os.environ.get("POSTGRES_PORT", "5432")
+from psycopg2.extras import Json
+
+from .cache import LRUCache
+from .db import ConnectionPool
+
+CLIENT_COLUMNS = (
+    "id", "first_name", "last_name", "position", "email", "phone_number", "company",
+    "notes", "last_contact", "last_contact_source", "ai_insights", "updated_at", "row_version",
+)
+
+CLIENT_SELECT = f"SELECT {', '.join(CLIENT_COLUMNS)} FROM clients"
+
+_NOT_CACHED = object()
+
+BULK_CLIENT_COLUMNS = (
+    "first_name", "last_name", "position", "email", "phone_number", "company",
+    "notes", "last_contact", "last_contact_source", "ai_insights",
+)
+
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def _copy_value(value):
+    if value is None:
+        return "\\N"
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    elif isinstance(value, (datetime.date, datetime.datetime)):
+        value = value.isoformat()
+    return str(value).translate(_COPY_ESCAPES)
+
+
+class _CopyRowReader:
+    """File-like object that renders rows to COPY text format on demand."""
+
+    def __init__(self, rows):
+        self._lines = ("\t".join(map(_copy_value, row)) + "\n" for row in rows)
+        self._buffer = ""
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer += line
+        if size < 0:
+            size = len(self._buffer)
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+
+SALES_FUNNEL_ENTRIES_SQL = """
+    SELECT sf.id, c.company, sf.stage, sf.status, sf.notes, sf.estimated_value, sf.close_date
+    FROM sales_funnel sf
+    JOIN clients c ON sf.client_id = c.id
+"""
+
+SALES_FUNNEL_SUMMARY_SQL = """
+    SELECT w.stage,
+           COALESCE(s.entry_count, 0),
+           COALESCE(s.total_value, 0),
+           COALESCE(s.total_value, 0) * w.probability,
+           w.probability,
+           CASE WHEN s.aged_count > 0
+                THEN (extract(epoch FROM LOCALTIMESTAMP) - s.created_epoch_sum / s.aged_count) / 86400
+           END
+    FROM sales_funnel_stage_weights w
+    LEFT JOIN sales_funnel_summary s ON s.stage = w.stage
+    ORDER BY w.position;
+"""
+
+STAGE_CONVERSION_SQL = """
+    WITH entered AS (
+        SELECT h.entry_id, h.to_stage AS stage, min(h.changed_at) AS entered_at
+        FROM sales_funnel_history h
+        WHERE h.changed_at >= %(start)s AND h.changed_at < %(end)s
+        GROUP BY h.entry_id, h.to_stage
+    ),
+    outcomes AS (
+        SELECT e.stage,
+               bool_or(w_next.stage <> 'Lost' AND w_next.position > w.position) AS advanced,
+               bool_or(w_next.stage = 'Lost') AS lost
+        FROM entered e
+        JOIN sales_funnel_stage_weights w ON w.stage = e.stage
+        LEFT JOIN sales_funnel_history n
+               ON n.entry_id = e.entry_id AND n.changed_at > e.entered_at
+        LEFT JOIN sales_funnel_stage_weights w_next ON w_next.stage = n.to_stage
+        GROUP BY e.entry_id, e.stage
+    )
+    SELECT w.stage,
+           count(o.stage),
+           count(o.stage) FILTER (WHERE o.advanced),
+           count(o.stage) FILTER (WHERE o.lost)
+    FROM sales_funnel_stage_weights w
+    LEFT JOIN outcomes o ON o.stage = w.stage
+    GROUP BY w.stage, w.position
+    ORDER BY w.position;
+"""
+
+TIME_IN_STAGE_SQL = """
+    WITH stints AS (
+        SELECT h.to_stage AS stage,
+               h.changed_at AS entered_at,
+               lead(h.changed_at) OVER (PARTITION BY h.entry_id ORDER BY h.changed_at, h.id) AS left_at
+        FROM sales_funnel_history h
+        WHERE h.entry_id IN (
+            SELECT entry_id FROM sales_funnel_history
+            WHERE changed_at >= %(start)s AND changed_at < %(end)s
         )
-        self.create_table()
-        self.create_sales_funnel_table()
-
-    def create_table(self):
-        with self.conn.cursor() as cur:
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS clients (
-                id SERIAL PRIMARY KEY,
-                first_name VARCHAR(255) NOT NULL,
-                last_name VARCHAR(255) NOT NULL,
-                position VARCHAR(255),
-                email VARCHAR(255) UNIQUE NOT NULL,
-                phone_number VARCHAR(50),
-                company VARCHAR(255),
-                notes TEXT,
-                last_contact TIMESTAMP,
-                last_contact_source VARCHAR(50),
-                ai_insights JSONB
-            );
-            """)
-            self.conn.commit()
-
-    def create_sales_funnel_table(self):
-        with self.conn.cursor() as cur:
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS sales_funnel (
-                id SERIAL PRIMARY KEY,
-                client_id INTEGER NOT NULL REFERENCES clients(id) ON DELETE CASCADE,
-                stage VARCHAR(255) NOT NULL CHECK (stage IN ('Lead', 'Contacted', 'Proposal', 'Negotiation', 'Won', 'Lost')),
-                status VARCHAR(255) NOT NULL,
-                notes TEXT,
-                estimated_value NUMERIC(10, 2),
-                close_date DATE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-            """)
-            
-            # Remove the unique constraint if it exists
-            cur.execute("""
-            ALTER TABLE sales_funnel DROP CONSTRAINT IF EXISTS sales_funnel_client_id_key;
-            """)
-            self.conn.commit()
+    )
+    SELECT w.stage,
+           count(s.left_at),
+           percentile_cont(0.5) WITHIN GROUP (ORDER BY extract(epoch FROM s.left_at - s.entered_at)) / 86400,
+           avg(extract(epoch FROM s.left_at - s.entered_at)) / 86400
+    FROM sales_funnel_stage_weights w
+    LEFT JOIN stints s
+           ON s.stage = w.stage AND s.left_at IS NOT NULL
+          AND s.entered_at >= %(start)s AND s.entered_at < %(end)s
+    GROUP BY w.stage, w.position
+    ORDER BY w.position;
+"""
+
+
+CHANGE_VERSIONS_SQL = "SELECT resource, version, changed_at FROM crm_change_counters;"
+
+CLIENT_VERSION_SQL = "SELECT id, row_version FROM clients WHERE email = %s;"
+
+# A key whose row has expired is taken over as if it were new, and so is one
+# still in progress after `lease` seconds: the worker that claimed it died.
+CLAIM_IDEMPOTENCY_KEY_SQL = """
+    INSERT INTO idempotency_keys (key, route, request_hash, expires_at)
+    VALUES (%(key)s, %(route)s, %(request_hash)s, now() + make_interval(secs => %(ttl)s))
+    ON CONFLICT (key, route) DO UPDATE
+        SET request_hash = EXCLUDED.request_hash, status_code = NULL, response_body = NULL,
+            created_at = now(), expires_at = EXCLUDED.expires_at
+        WHERE idempotency_keys.expires_at <= now()
+           OR (idempotency_keys.status_code IS NULL
+               AND idempotency_keys.created_at <= now() - make_interval(secs => %(lease)s))
+    RETURNING key;
+"""
+
+IDEMPOTENCY_KEY_SQL = """
+    SELECT request_hash, status_code, response_body FROM idempotency_keys
+    WHERE key = %s AND route = %s AND expires_at > now();
+"""
+
+COMPLETE_IDEMPOTENCY_KEY_SQL = "UPDATE idempotency_keys SET status_code = %s, response_body = %s WHERE key = %s AND route = %s;"
+
+RELEASE_IDEMPOTENCY_KEY_SQL = "DELETE FROM idempotency_keys WHERE key = %s AND route = %s AND status_code IS NULL;"
+
+PURGE_IDEMPOTENCY_KEYS_SQL = "DELETE FROM idempotency_keys WHERE expires_at <= now();"
+
+
+def search_clients_query(q, limit, offset, insights):
+    """Builds the ranked search SQL and its named parameters, or None if there is nothing to match."""
+    conditions = []
+    params = {"q": q, "limit": limit, "offset": offset}
+    rank = "0"
+    if q:
+        conditions.append(
+            "(c.search_vector @@ query"
+            " OR (c.first_name || ' ' || c.last_name) %% %(q)s"
+            " OR c.email %% %(q)s)"
+        )
+        rank = (
+            "ts_rank_cd(c.search_vector, query)"
+            " + greatest(similarity(c.first_name || ' ' || c.last_name, %(q)s), similarity(c.email, %(q)s))"
+        )
+    if insights:
+        conditions.append("c.ai_insights @> %(insights)s")
+        params["insights"] = insights
+    if not conditions:
+        return None
+
+    columns = ", ".join(f"c.{column}" for column in CLIENT_COLUMNS)
+    sql = f"""
+        SELECT {columns}, {rank} AS rank
+        FROM clients c,
+             (SELECT websearch_to_tsquery('simple', %(q)s) || websearch_to_tsquery('spanish', %(q)s) AS query) q
+        WHERE {' AND '.join(conditions)}
+        ORDER BY rank DESC, c.id
+        LIMIT %(limit)s OFFSET %(offset)s;
+    """
+    return sql, params
+
+
+def sales_funnel_entry_to_dict(row):
+    return {
+        "id": row[0],
+        "company": row[1],
+        "stage": row[2],
+        "status": row[3],
+        "notes": row[4],
+        "estimated_value": str(row[5]),
+        "close_date": row[6].isoformat() if row[6] else None,
+    }
+
+
+def summary_row_to_dict(row):
+    return {
+        "stage": row[0],
+        "count": row[1],
+        "total_value": str(row[2]),
+        "weighted_value": str(round(row[3], 2)),
+        "probability": float(row[4]),
+        "average_age_days": round(float(row[5]), 1) if row[5] is not None else None,
+    }
+
+
+def conversion_row_to_dict(row):
+    stage, entered, advanced, lost = row
+    return {
+        "stage": stage,
+        "entered": entered,
+        "advanced": advanced,
+        "lost": lost,
+        "conversion_rate": round(advanced / entered, 4) if entered else None,
+    }
+
+
+def time_in_stage_row_to_dict(row):
+    stage, stints, median, average = row
+    return {
+        "stage": stage,
+        "completed_stints": stints,
+        "median_days": round(float(median), 2) if median is not None else None,
+        "average_days": round(float(average), 2) if average is not None else None,
+    }
+
+
+class CRM:
+    def __init__(self, pool=None, client_cache=None):
+        # Every method borrows a connection from the pool and returns it when
+        # done, so concurrent request threads do not share a single socket.
+        self.pool = pool or ConnectionPool.from_env()
+        # Read-through cache for get_client, keyed by email. Entries are
+        # dropped by the write methods of this process, and by
+        # invalidate_changed_clients for writes seen on the change feed
+        # (other workers); the TTL bounds staleness when neither applies.
+        if client_cache is None:
+            client_cache = LRUCache(
+                maxsize=int(os.environ.get("CRM_CLIENT_CACHE_SIZE", "1024")),
+                ttl=float(os.environ.get("CRM_CLIENT_CACHE_TTL", "30")),
+            )
+        self.client_cache = client_cache
+        # The schema is managed by marta_core.migrations, run once per deploy.
 
     def add_client(self, client):
-        with self.conn.cursor() as cur:
+        with self.pool.connection() as conn, conn.cursor() as cur:
             cur.execute(
                 """
                 INSERT INTO clients (first_name, last_name, position, email, phone_number, company, notes, last_contact, last_contact_source, ai_insights)
@@ -65,83 +260,275 @@ class CRM:
                 """,
                 (client.first_name, client.last_name, client.position, client.email, client.phone_number, client.company, client.notes, client.last_contact, client.last_contact_source, client.ai_insights)
             )
-            self.conn.commit()
+            conn.commit()
+        self.client_cache.invalidate(client.email)
+
+    def add_clients_bulk(self, clients, on_conflict="nothing"):
+        """
+        Inserts many clients in one transaction.
+
+        `clients` is any iterable of `Client` objects or dicts; it is streamed
+        through COPY into a temporary staging table and merged into `clients`
+        with a single INSERT ... ON CONFLICT (email). With on_conflict="update"
+        existing rows get the non-null incoming fields. Rows missing a required
+        field are skipped, as are earlier occurrences of an email repeated
+        within the batch.
+
+        Returns a dict with inserted, updated and skipped counts.
+        """
+        if on_conflict not in ("nothing", "update"):
+            raise ValueError(f"on_conflict must be 'nothing' or 'update', got {on_conflict!r}")
+
+        invalid = [0]
+
+        def rows():
+            for client in clients:
+                if isinstance(client, dict):
+                    row = [client.get(column) for column in BULK_CLIENT_COLUMNS]
+                else:
+                    row = [getattr(client, column, None) for column in BULK_CLIENT_COLUMNS]
+                first_name, last_name, _, email = row[:4]
+                if not (first_name and last_name and email):
+                    invalid[0] += 1
+                    continue
+                yield row
+
+        columns = ", ".join(BULK_CLIENT_COLUMNS)
+        if on_conflict == "update":
+            conflict_action = "DO UPDATE SET " + ", ".join(
+                f"{column} = COALESCE(EXCLUDED.{column}, clients.{column})"
+                for column in BULK_CLIENT_COLUMNS if column != "email"
+            )
+        else:
+            conflict_action = "DO NOTHING"
+
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(f"""
+                CREATE TEMP TABLE clients_staging ON COMMIT DROP AS
+                SELECT {columns} FROM clients WITH NO DATA;
+            """)
+            cur.copy_expert(
+                f"COPY clients_staging ({columns}) FROM STDIN",
+                _CopyRowReader(rows()),
+            )
+            staged = cur.rowcount
+            cur.execute(f"""
+                WITH merged AS (
+                    INSERT INTO clients ({columns})
+                    SELECT DISTINCT ON (email) {columns} FROM clients_staging
+                    -- The staging heap is append-only, so ctid follows input order
+                    -- and the last occurrence of a repeated email wins.
+                    ORDER BY email, ctid DESC
+                    ON CONFLICT (email) {conflict_action}
+                    RETURNING (xmax = 0) AS inserted
+                )
+                SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted)
+                FROM merged;
+            """)
+            inserted, updated = cur.fetchone()
+            conn.commit()
+        if inserted or updated:
+            self.client_cache.clear()
+
+        return {
+            "inserted": inserted,
+            "updated": updated,
+            "skipped": staged - inserted - updated + invalid[0],
+        }
 
     def get_client(self, email):
-        with self.conn.cursor() as cur:
-            cur.execute("SELECT first_name, last_name, position, email, phone_number, company, notes, last_contact, last_contact_source, ai_insights FROM clients WHERE email = %s;", (email,))
+        cached = self.client_cache.get(email, _NOT_CACHED)
+        if cached is not _NOT_CACHED:
+            return cached
+        generation = self.client_cache.generation
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(CLIENT_SELECT + " WHERE email = %s;", (email,))
             row = cur.fetchone()
-            if row:
-                client = Client(first_name=row[0], last_name=row[1], position=row[2], email=row[3], phone_number=row[4], company=row[5])
-                client.notes = row[6]
-                client.last_contact = row[7]
-                client.last_contact_source = row[8]
-                client.ai_insights = row[9]
-                return client
+        # Unknown emails are cached as None too; add_client invalidates them.
+        client = ClientRecord._make(row) if row else None
+        # Not cached if a write invalidated the cache meanwhile: the row may predate it.
+        self.client_cache.set_if_unchanged(email, client, generation)
+        return client
+
+    def get_clients(self, emails):
+        """
+        Resolves many emails at once: {email: ClientRecord or None}. Cached
+        entries are served from the client cache and the rest are read in a
+        single query.
+        """
+        result = {}
+        missing = []
+        for email in dict.fromkeys(emails):
+            cached = self.client_cache.get(email, _NOT_CACHED)
+            if cached is _NOT_CACHED:
+                missing.append(email)
+            else:
+                result[email] = cached
+        if missing:
+            generation = self.client_cache.generation
+            with self.pool.connection() as conn, conn.cursor() as cur:
+                cur.execute(CLIENT_SELECT + " WHERE email = ANY(%s);", (missing,))
+                found = {client.email: client for client in map(ClientRecord._make, cur)}
+            for email in missing:
+                client = found.get(email)
+                self.client_cache.set_if_unchanged(email, client, generation)
+                result[email] = client
+        return result
+
+    def get_client_version(self, email):
+        """(id, row_version) of the client, read uncached, or None if not found."""
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(CLIENT_VERSION_SQL, (email,))
+            return cur.fetchone()
+
+    def get_change_versions(self):
+        """
+        {resource: (version, changed_at)} for "clients" and "sales_funnel".
+        Triggers bump a resource's counter once per statement that writes to
+        its table, in the same transaction, so an unchanged version means the
+        table is unchanged.
+        """
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(CHANGE_VERSIONS_SQL)
+            return {resource: (version, changed_at) for resource, version, changed_at in cur.fetchall()}
+
+    def claim_idempotency_key(self, key, route, request_hash, ttl, lease):
+        """
+        Records `key` for `route` as in progress and returns None, or returns
+        the (request_hash, status_code, response_body) already stored for it.
+        status_code is None while the request that claimed it is running; a
+        claim that is still in progress after `lease` seconds is taken over.
+        That includes a request whose write committed but which died before
+        `complete_idempotency_key`: the write is not atomic with the key.
+        """
+        params = {"key": key, "route": route, "request_hash": request_hash, "ttl": ttl, "lease": lease}
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(CLAIM_IDEMPOTENCY_KEY_SQL, params)
+            claimed = cur.fetchone()
+            if claimed is None:
+                cur.execute(IDEMPOTENCY_KEY_SQL, (key, route))
+                stored = cur.fetchone()
+            conn.commit()
+        if claimed is not None:
             return None
+        # Expired and purged between the two statements: report it as busy.
+        return stored or (request_hash, None, None)
+
+    def complete_idempotency_key(self, key, route, status_code, response_body):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(COMPLETE_IDEMPOTENCY_KEY_SQL, (status_code, response_body, key, route))
+            conn.commit()
+
+    def release_idempotency_key(self, key, route):
+        """Forgets an in-progress key whose request failed, so a retry runs it again."""
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(RELEASE_IDEMPOTENCY_KEY_SQL, (key, route))
+            conn.commit()
+
+    def purge_idempotency_keys(self):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(PURGE_IDEMPOTENCY_KEYS_SQL)
+            conn.commit()
+            return cur.rowcount
 
     def get_all_clients(self):
-        with self.conn.cursor() as cur:
-            cur.execute("SELECT first_name, last_name, position, email, phone_number, company, notes, last_contact, last_contact_source, ai_insights FROM clients;")
-            clients = []
-            for row in cur.fetchall():
-                client = Client(first_name=row[0], last_name=row[1], position=row[2], email=row[3], phone_number=row[4], company=row[5])
-                client.notes = row[6]
-                client.last_contact = row[7]
-                client.last_contact_source = row[8]
-                client.ai_insights = row[9]
-                clients.append(client)
-            return clients
+        return list(self.iter_clients())
+
+    def iter_clients(self, after_id=None, limit=None, batch_size=1000):
+        """
+        Yields `ClientRecord`s ordered by id, starting after `after_id` (keyset
+        pagination). Rows are fetched `batch_size` at a time through a named
+        server-side cursor, so the full table is never held in memory.
+        """
+        with self.pool.connection() as conn:
+            with conn.cursor(name="iter_clients") as cur:
+                cur.itersize = batch_size
+                cur.execute(CLIENT_SELECT + " WHERE id > %s ORDER BY id LIMIT %s;", (after_id or 0, limit))
+                yield from map(ClientRecord._make, cur)
+
+    def search_clients(self, q=None, limit=20, offset=0, insights=None):
+        """
+        Ranked client search. `q` is matched with full-text search over name,
+        company and notes, and by trigram similarity against the full name
+        and email so typos still match. `insights` is a dict that ai_insights
+        must contain. Returns a list of (ClientRecord, rank) pairs, best first.
+        """
+        query = search_clients_query(q, limit, offset, insights)
+        if query is None:
+            return []
+        sql, params = query
+        if "insights" in params:
+            params["insights"] = Json(params["insights"])
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(sql, params)
+            return [(ClientRecord._make(row[:-1]), float(row[-1])) for row in cur.fetchall()]
 
     def update_client(self, email, data):
-        with self.conn.cursor() as cur:
+        """Updates the client and returns the fresh row, or None if not found."""
+        with self.pool.connection() as conn, conn.cursor() as cur:
             fields = []
             values = []
             for key, value in data.items():
                 fields.append(f"{key} = %s")
                 values.append(value)
-            
+
+            fields.append("last_contact = %s")
+            values.append(datetime.datetime.now())
             values.append(email)
 
             cur.execute(
-                f"UPDATE clients SET {', '.join(fields)}, last_contact = %s WHERE email = %s;",
-                values + [datetime.datetime.now()]
+                f"UPDATE clients SET {', '.join(fields)} WHERE email = %s RETURNING {', '.join(CLIENT_COLUMNS)};",
+                values
             )
-            self.conn.commit()
+            row = cur.fetchone()
+            conn.commit()
+
+        client = ClientRecord._make(row) if row else None
+        # Dropped rather than refreshed: a concurrent update may have committed after this one.
+        self.client_cache.invalidate(email)
+        if client is not None and client.email != email:
+            self.client_cache.invalidate(client.email)
+        return client
 
     def get_all_sales_funnel_entries(self):
-        with self.conn.cursor() as cur:
-            cur.execute("""
-                SELECT sf.id, c.company, sf.stage, sf.status, sf.notes, sf.estimated_value, sf.close_date
-                FROM sales_funnel sf
-                JOIN clients c ON sf.client_id = c.id;
-            """)
-            
-            entries = []
-            for row in cur.fetchall():
-                entries.append({
-                    "id": row[0],
-                    "company": row[1],
-                    "stage": row[2],
-                    "status": row[3],
-                    "notes": row[4],
-                    "estimated_value": str(row[5]),
-                    "close_date": row[6].isoformat() if row[6] else None,
-                })
-            return entries
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(SALES_FUNNEL_ENTRIES_SQL + ";")
+            return [sales_funnel_entry_to_dict(row) for row in cur.fetchall()]
+
+    def get_sales_funnel_summary(self):
+        """
+        Per-stage count, total and weighted estimated value, and average age in
+        days, read from the trigger-maintained sales_funnel_summary table.
+        """
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(SALES_FUNNEL_SUMMARY_SQL)
+            return [summary_row_to_dict(row) for row in cur.fetchall()]
+
+    def get_stage_conversion_rates(self, start, end):
+        """
+        For each stage, how many entries entered it within [start, end) and
+        how many of those later reached a further stage or were lost.
+        """
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(STAGE_CONVERSION_SQL, {"start": start, "end": end})
+            return [conversion_row_to_dict(row) for row in cur.fetchall()]
+
+    def get_median_time_in_stage(self, start, end):
+        """
+        Median and average days spent in each stage, over stints that began
+        within [start, end) and have since been left.
+        """
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(TIME_IN_STAGE_SQL, {"start": start, "end": end})
+            return [time_in_stage_row_to_dict(row) for row in cur.fetchall()]
 
     def get_sales_funnel_entry(self, company_name):
-        with self.conn.cursor() as cur:
-            cur.execute("""
-                SELECT sf.id, c.company, sf.stage, sf.status, sf.notes, sf.estimated_value, sf.close_date
-                FROM sales_funnel sf
-                JOIN clients c ON sf.client_id = c.id
-                WHERE c.company = %s;
-            """, (company_name,))
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(SALES_FUNNEL_ENTRIES_SQL + " WHERE c.company = %s;", (company_name,))
             return cur.fetchone()
 
     def add_sales_funnel_entry(self, data):
-        with self.conn.cursor() as cur:
+        with self.pool.connection() as conn, conn.cursor() as cur:
             # If company is provided instead of client_id, find the client_id
             if 'company' in data and 'client_id' not in data:
                 cur.execute("SELECT id FROM clients WHERE company = %s LIMIT 1", (data['company'],))
@@ -155,35 +542,70 @@ class CRM:
             cur.execute(
                 """
                 INSERT INTO sales_funnel (client_id, stage, status, notes, estimated_value, close_date)
-                VALUES (%s, %s, %s, %s, %s, %s);
+                VALUES (%s, %s, %s, %s, %s, %s)
+                RETURNING id;
                 """,
                 (client_id, data['stage'], data['status'], data['notes'], data.get('estimated_value'), data.get('close_date'))
             )
-            self.conn.commit()
+            entry_id = cur.fetchone()[0]
+            conn.commit()
+        return entry_id
 
     def update_sales_funnel_entry(self, client_id, data):
-        with self.conn.cursor() as cur:
+        with self.pool.connection() as conn, conn.cursor() as cur:
             fields = []
             values = []
             for key, value in data.items():
                 fields.append(f"{key} = %s")
                 values.append(value)
             
+            fields.append("updated_at = %s")
+            values.append(datetime.datetime.now())
             values.append(client_id)
 
             cur.execute(
-                f"UPDATE sales_funnel SET {', '.join(fields)}, updated_at = %s WHERE client_id = %s;",
-                values + [datetime.datetime.now()]
+                f"UPDATE sales_funnel SET {', '.join(fields)} WHERE client_id = %s;",
+                values
             )
-            self.conn.commit()
+            conn.commit()
 
     def delete_sales_funnel_entry(self, client_id):
-        with self.conn.cursor() as cur:
+        with self.pool.connection() as conn, conn.cursor() as cur:
             cur.execute("DELETE FROM sales_funnel WHERE client_id = %s;", (client_id,))
-            self.conn.commit()
+            conn.commit()
+
+def invalidate_changed_clients(client_cache, event):
+    """
+    ChangeFeed listener (marta_core.events) that drops the client_cache
+    entries a committed write may have made stale, whichever process wrote.
+    """
+    if event["resource"] == "*" or (event["resource"] == "clients" and "id" not in event):
+        # A resync or a bulk statement: anything may have changed.
+        client_cache.clear()
+    elif event["resource"] == "clients":
+        if "email" in event:
+            client_cache.invalidate(event["email"])
+        # An update may have changed the email the row is cached under.
+        if event["op"] != "insert":
+            client_cache.invalidate_where(lambda client: client is not None and client.id == event["id"])
+
+
+def crm_from_env():
+    """
+    The CRM for the CRM_BACKEND setting: "postgres" (default, POSTGRES_*) or
+    "sqlite" (`marta_core.crm_sqlite`, file at CRM_SQLITE_PATH).
+    """
+    backend = os.environ.get("CRM_BACKEND", "postgres")
+    if backend == "sqlite":
+        from .crm_sqlite import SQLiteCRM
+        return SQLiteCRM.from_env()
+    if backend != "postgres":
+        raise ValueError(f"CRM_BACKEND must be 'postgres' or 'sqlite', got {backend!r}")
+    return CRM()
 
 class Client:
-    def __init__(self, first_name, last_name, email, phone_number, company=None, position=None):
+    def __init__(self, first_name, last_name, email, phone_number, company=None, position=None, id=None):
+        self.id = id
         self.first_name = first_name
         self.last_name = last_name
         self.email = email
@@ -197,6 +619,7 @@ class Client:
 
     def to_dict(self):
         return {
+            "id": self.id,
             "first_name": self.first_name,
             "last_name": self.last_name,
             "email": self.email,
@@ -207,4 +630,38 @@ class Client:
             "last_contact": self.last_contact.isoformat() if self.last_contact else None,
             "last_contact_source": self.last_contact_source,
             "ai_insights": self.ai_insights,
-        }
\ No newline at end of file
+        }
+
+class ClientRecord(namedtuple("ClientRecord", CLIENT_COLUMNS)):
+    """
+    Read-only client row as returned by the CRM queries.
+
+    A tuple subclass without a per-instance __dict__, built directly from a
+    cursor row with `ClientRecord._make(row)`.
+    """
+    __slots__ = ()
+
+    def to_dict(self):
+        data = self._asdict()
+        if self.last_contact is not None:
+            data["last_contact"] = self.last_contact.isoformat()
+        if self.updated_at is not None:
+            data["updated_at"] = self.updated_at.isoformat()
+        return data
+
+
+def to_dicts(records):
+    """Serializes a batch of `ClientRecord`s (or raw client rows) to dicts."""
+    return [
+        {
+            "id": id, "first_name": first_name, "last_name": last_name,
+            "position": position, "email": email, "phone_number": phone_number,
+            "company": company, "notes": notes,
+            "last_contact": last_contact.isoformat() if last_contact is not None else None,
+            "last_contact_source": last_contact_source, "ai_insights": ai_insights,
+            "updated_at": updated_at.isoformat() if updated_at is not None else None,
+            "row_version": row_version,
+        }
+        for (id, first_name, last_name, position, email, phone_number, company,
+             notes, last_contact, last_contact_source, ai_insights, updated_at, row_version) in records
+    ]
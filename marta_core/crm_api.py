@@ -1,6 +1,14 @@
 
 import sys
 import os
+import datetime
+import functools
+import hashlib
+import itertools
+import json
+import threading
+import time
+import zlib
 
 from dotenv import load_dotenv
 
@@ -12,28 +20,146 @@ project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if project_root not in sys.path:
     sys.path.insert(0, project_root)
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
-from marta_core.crm import CRM, Client
-from marta_core.agent import ask_marta
+from werkzeug.http import is_resource_modified
+from marta_core.crm import CRM, Client, crm_from_env, invalidate_changed_clients, sales_funnel_entry_to_dict, to_dicts
+from marta_core.responses import dumps, init_app
+from marta_core import metrics
+from marta_core.admission import llm_admission
+from marta_core.events import change_feed, sse_event, sse_heartbeat, sse_message, wants
+from marta_core.agent import ask_marta, ask_marta_stream, answer_cache, history_store
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "http://localhost:9002"}})
+init_app(app)
+metrics.init_app(app, "crm_api")
 
-crm = CRM()
+crm = crm_from_env()
+# Writes by other workers reach this worker's client cache through the change
+# feed, started per worker by marta_core.serve. SQLite has no LISTEN/NOTIFY.
+if isinstance(crm, CRM):
+    change_feed.add_listener(functools.partial(invalidate_changed_clients, crm.client_cache))
+
+def _collection_etag(name, *versions):
+    # The query string picks the representation (page, stream), so it is part of the tag.
+    return "-".join([name, *map(str, versions), f"{zlib.crc32(request.query_string):08x}"])
+
+def _last_modified(changed_at):
+    # HTTP dates have whole seconds, so a change from the current second is not
+    # advertised: another write within it would pass If-Modified-Since.
+    if datetime.datetime.now(datetime.timezone.utc) - changed_at < datetime.timedelta(seconds=1):
+        return None
+    return changed_at
+
+def _with_validators(response, etag, last_modified=None):
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Clients may keep the body but must revalidate, which is a 304 while unchanged.
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+def _not_modified(etag, last_modified=None):
+    """A 304 response if the request's If-None-Match / If-Modified-Since still match, else None."""
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    return _with_validators(Response(status=304), etag, last_modified)
+
+IDEMPOTENCY_KEY_TTL = float(os.environ.get("IDEMPOTENCY_KEY_TTL", "86400"))
+# A worker is killed after GUNICORN_TIMEOUT, so a key in progress for longer was orphaned.
+IDEMPOTENCY_LEASE = float(os.environ.get("IDEMPOTENCY_LEASE", os.environ.get("GUNICORN_TIMEOUT", "120")))
+IDEMPOTENCY_PURGE_INTERVAL = 300.0
+_idempotency_purged_at = [0.0]
+
+def _replay(stored, request_hash):
+    stored_hash, status_code, body = stored
+    if stored_hash != request_hash:
+        return jsonify({"error": "Idempotency-Key was already used with a different request"}), 422
+    if status_code is None:
+        return jsonify({"error": "A request with this Idempotency-Key is still in progress"}), 409, {"Retry-After": "1"}
+    return Response(body, status=status_code, mimetype="application/json", headers={"Idempotent-Replayed": "true"})
+
+def idempotent(view):
+    """
+    Honours an Idempotency-Key header. The first request with a key runs the
+    view and its response is stored for IDEMPOTENCY_KEY_TTL seconds; a retry
+    with the same key and body gets that response back without writing again.
+    Exceptions and 5xx responses are not stored, so those can be retried.
+    A retry while the first request runs gets a 409, until IDEMPOTENCY_LEASE
+    seconds after the claim, when it takes the key over.
+
+    The view's write and the stored response are separate transactions. If
+    the worker dies after the write commits but before the response is
+    stored, a retry after the lease runs the view again: POST /client is
+    safe (ON CONFLICT (email) DO NOTHING), POST /sales_funnel creates a
+    second entry.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > 255:
+            return jsonify({"error": "Idempotency-Key must be at most 255 characters"}), 400
+
+        if time.monotonic() - _idempotency_purged_at[0] > IDEMPOTENCY_PURGE_INTERVAL:
+            _idempotency_purged_at[0] = time.monotonic()
+            crm.purge_idempotency_keys()
+
+        route = f"{request.method} {request.path}"
+        request_hash = hashlib.sha256(request.get_data()).hexdigest()
+        stored = crm.claim_idempotency_key(key, route, request_hash, IDEMPOTENCY_KEY_TTL, IDEMPOTENCY_LEASE)
+        if stored is not None:
+            return _replay(stored, request_hash)
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except Exception:
+            crm.release_idempotency_key(key, route)
+            raise
+        if response.status_code >= 500:
+            crm.release_idempotency_key(key, route)
+        else:
+            crm.complete_idempotency_key(key, route, response.status_code, response.get_data(as_text=True))
+        return response
+    return wrapper
 
 @app.route("/marta", methods=["POST"])
+@llm_admission.limit
 def marta_endpoint():
     data = request.get_json()
     query = data.get("query")
     if not query:
         return jsonify({"error": "No query provided"}), 400
     
-    response = ask_marta(query)
+    response = ask_marta(query, session_id=data.get("session_id", "default_session"))
     return jsonify({"response": response})
 
+@app.route("/marta/stream", methods=["POST"])
+@llm_admission.limit_stream
+def marta_stream_endpoint():
+    """
+    Same request as /marta, answered as Server-Sent Events while the agent
+    runs: tool_start / tool_end, token (pieces of the final answer), then
+    final with the whole answer, or error (see agent.ask_marta_stream).
+    """
+    data = request.get_json()
+    query = data.get("query")
+    if not query:
+        return jsonify({"error": "No query provided"}), 400
+
+    events = ask_marta_stream(query, session_id=data.get("session_id", "default_session"))
+    response = Response((sse_message(event["type"], event) for event in events), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+    # Cancels the agent's run if the client went away before the end.
+    response.call_on_close(events.close)
+    return response
+
 
 @app.route("/client", methods=["POST"])
+@idempotent
 def add_client():
     data = request.get_json()
     client = Client(
@@ -47,44 +173,299 @@ def add_client():
     crm.add_client(client)
     return jsonify(client.to_dict()), 201
 
+@app.route("/clients/bulk", methods=["POST"])
+def add_clients_bulk():
+    """Accepts newline-delimited JSON (one client object per line)."""
+    on_conflict = request.args.get("on_conflict", "nothing")
+    if on_conflict not in ("nothing", "update"):
+        return jsonify({"error": "on_conflict must be 'nothing' or 'update'"}), 400
+
+    malformed = 0
+
+    def parse_lines():
+        nonlocal malformed
+        for line in request.stream:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                malformed += 1
+                continue
+            if not isinstance(record, dict):
+                malformed += 1
+                continue
+            yield record
+
+    result = crm.add_clients_bulk(parse_lines(), on_conflict=on_conflict)
+    result["skipped"] += malformed
+    return jsonify(result), 200
+
 @app.route("/client/<email>", methods=["GET"])
 def get_client(email):
-    client = crm.get_client(email)
+    if request.if_none_match:
+        version = crm.get_client_version(email)
+        if version is None:
+            return jsonify({"message": "Client not found"}), 404
+        etag = "client-%s-%s" % version
+        not_modified = _not_modified(etag)
+        if not_modified:
+            return not_modified
+        client = crm.get_client(email)
+        if client is None or (client.id, client.row_version) != version:
+            # Written by another worker since it was cached.
+            crm.client_cache.invalidate(email)
+            client = crm.get_client(email)
+    else:
+        client = crm.get_client(email)
     if client:
-        return jsonify(client.to_dict())
+        return _with_validators(jsonify(client.to_dict()), f"client-{client.id}-{client.row_version}")
     return jsonify({"message": "Client not found"}), 404
 
+CLIENTS_BATCH_MAX = 200
+
+@app.route("/clients/batch", methods=["POST"])
+def get_clients_batch():
+    """
+    {"emails": [...]} -> {"clients": {email: client or null}, "missing": [...]},
+    resolved with one query for up to CLIENTS_BATCH_MAX emails.
+    """
+    data = request.get_json(silent=True) or {}
+    emails = data.get("emails")
+    if not isinstance(emails, list) or not all(isinstance(email, str) for email in emails):
+        return jsonify({"error": "emails must be a list of strings"}), 400
+    if len(emails) > CLIENTS_BATCH_MAX:
+        return jsonify({"error": f"At most {CLIENTS_BATCH_MAX} emails per request"}), 400
+
+    clients = crm.get_clients(emails)
+    return jsonify({
+        "clients": {email: client.to_dict() if client else None for email, client in clients.items()},
+        "missing": [email for email, client in clients.items() if client is None],
+    })
+
+CLIENTS_MAX_PAGE_SIZE = 1000
+
 @app.route("/clients", methods=["GET"])
 def get_all_clients():
-    clients = crm.get_all_clients()
-    return jsonify([client.to_dict() for client in clients])
+    """
+    Without parameters returns every client. `?limit=N&after=<id>` returns one
+    keyset page and puts the cursor for the next one in `X-Next-After`.
+    `?stream=1` sends the full list as a chunked JSON array in constant memory.
+    """
+    limit = request.args.get("limit", type=int)
+    after = request.args.get("after", type=int)
+    if limit is not None and not 0 < limit <= CLIENTS_MAX_PAGE_SIZE:
+        return jsonify({"error": f"limit must be between 1 and {CLIENTS_MAX_PAGE_SIZE}"}), 400
+
+    # Read the version before the rows: a write landing in between makes the
+    # tag older than the body, which only costs the next poll a full reply.
+    version, changed_at = crm.get_change_versions()["clients"]
+    etag = _collection_etag("clients", version)
+    changed_at = _last_modified(changed_at)
+    not_modified = _not_modified(etag, changed_at)
+    if not_modified:
+        return not_modified
+
+    if request.args.get("stream") in ("1", "true"):
+        response = Response(_stream_clients(after, limit), mimetype="application/json")
+        return _with_validators(response, etag, changed_at)
+
+    page = to_dicts(crm.iter_clients(after_id=after, limit=limit))
+    response = jsonify(page)
+    if limit is not None and len(page) == limit:
+        response.headers["X-Next-After"] = str(page[-1]["id"])
+    return _with_validators(response, etag, changed_at)
+
+def _stream_clients(after, limit, chunk_size=500):
+    clients = crm.iter_clients(after_id=after, limit=limit, batch_size=chunk_size)
+    separator = "["
+    while True:
+        chunk = to_dicts(itertools.islice(clients, chunk_size))
+        if not chunk:
+            break
+        yield separator + ",".join(map(dumps, chunk))
+        separator = ","
+    yield "]" if separator == "," else "[]"
+
+SEARCH_MAX_PAGE_SIZE = 100
+
+@app.route("/clients/search", methods=["GET"])
+def search_clients():
+    """?q=<text>&limit=&offset=&insights=<json object ai_insights must contain>"""
+    q = request.args.get("q", "").strip()
+    limit = min(request.args.get("limit", 20, type=int), SEARCH_MAX_PAGE_SIZE)
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    insights = request.args.get("insights")
+    if insights:
+        try:
+            insights = json.loads(insights)
+        except ValueError:
+            return jsonify({"error": "insights must be a JSON object"}), 400
+        if not isinstance(insights, dict):
+            return jsonify({"error": "insights must be a JSON object"}), 400
+    if not q and not insights:
+        return jsonify({"error": "Provide q and/or insights"}), 400
+    if limit < 1:
+        return jsonify({"error": "limit must be positive"}), 400
+
+    results = crm.search_clients(q, limit=limit, offset=offset, insights=insights)
+    clients = to_dicts(record for record, _ in results)
+    for client, (_, rank) in zip(clients, results):
+        client["rank"] = round(rank, 4)
+    return jsonify({"results": clients, "limit": limit, "offset": offset})
 
 @app.route("/client/<email>", methods=["PUT"])
 def update_client(email):
     data = request.get_json()
-    crm.update_client(email, data)
-    client = crm.get_client(email)
+    client = crm.update_client(email, data)
     if client:
         return jsonify(client.to_dict())
     return jsonify({"message": "Client not found"}), 404
 
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    return jsonify({
+        "client_cache": crm.client_cache.stats(),
+        "llm_admission": llm_admission.stats(),
+        "chat_history": history_store.stats(),
+        "answer_cache": answer_cache.stats() if answer_cache else None,
+    })
+
+EVENTS_STREAM_SECONDS = float(os.environ.get("EVENTS_STREAM_SECONDS", "55"))
+EVENTS_HEARTBEAT_SECONDS = 15.0
+EVENTS_RETRY_MS = 1000
+# Open /events streams per process. Each one holds a worker thread, so this
+# must stay well below the thread count marta_core.serve gives crm_api (16).
+EVENTS_MAX_STREAMS = int(os.environ.get("EVENTS_MAX_STREAMS", "8"))
+_open_streams = 0
+_open_streams_lock = threading.Lock()
+
+@app.route("/events", methods=["GET"])
+def stream_events():
+    """
+    Server-Sent Events feed of client and sales funnel changes (see
+    marta_core.events); ?resources=clients,sales_funnel narrows it.
+
+    Every open stream holds one worker thread, so marta_core.serve runs
+    crm_api on threaded (gthread) workers and at most EVENTS_MAX_STREAMS
+    streams per process are accepted; further ones get a 503 with
+    Retry-After and the rest of the threads stay free for CRM requests.
+    Each stream also ends after EVENTS_STREAM_SECONDS (below the gunicorn
+    timeout) and EventSource reconnects with Last-Event-ID without losing
+    events. Many long-lived streams are better served by crm_asgi, which
+    holds no thread per stream.
+    """
+    global _open_streams
+    with _open_streams_lock:
+        if _open_streams >= EVENTS_MAX_STREAMS:
+            response = jsonify({"error": "Too many open event streams; use crm_asgi for more."})
+            response.status_code = 503
+            response.headers["Retry-After"] = str(int(EVENTS_STREAM_SECONDS))
+            return response
+        _open_streams += 1
+
+    def close():
+        global _open_streams
+        subscription.close()
+        with _open_streams_lock:
+            _open_streams -= 1
+
+    resources = set(filter(None, request.args.get("resources", "").split(","))) or None
+    try:
+        subscription = change_feed.subscribe(request.headers.get("Last-Event-ID"))
+    except BaseException:
+        with _open_streams_lock:
+            _open_streams -= 1
+        raise
+    deadline = time.monotonic() + EVENTS_STREAM_SECONDS
+
+    def generate():
+        last_event_id = subscription.last_event_id
+        yield f"retry: {EVENTS_RETRY_MS}\n" + sse_heartbeat(last_event_id)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            item = subscription.get(timeout=min(remaining, EVENTS_HEARTBEAT_SECONDS))
+            if item is None:
+                yield sse_heartbeat(last_event_id)
+                continue
+            last_event_id, event = item
+            if wants(event, resources):
+                yield sse_event(last_event_id, event)
+
+    response = Response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        # Keep nginx / Cloud Run front ends from buffering the stream.
+        "X-Accel-Buffering": "no",
+    })
+    # Runs when the server closes the response, even if the stream never started.
+    response.call_on_close(close)
+    return response
+
 @app.route("/sales_funnel", methods=["GET"])
 def get_all_sales_funnel_entries():
+    # Entries carry the client's company, so client writes change the body too.
+    versions = crm.get_change_versions()
+    funnel_version, funnel_changed_at = versions["sales_funnel"]
+    clients_version, clients_changed_at = versions["clients"]
+    etag = _collection_etag("sales_funnel", funnel_version, clients_version)
+    last_modified = _last_modified(max(funnel_changed_at, clients_changed_at))
+    not_modified = _not_modified(etag, last_modified)
+    if not_modified:
+        return not_modified
     entries = crm.get_all_sales_funnel_entries()
-    return jsonify([dict(entry) for entry in entries])
+    return _with_validators(jsonify([dict(entry) for entry in entries]), etag, last_modified)
+
+@app.route("/sales_funnel/summary", methods=["GET"])
+def get_sales_funnel_summary():
+    return jsonify(crm.get_sales_funnel_summary())
+
+def _date_window(default_days=90):
+    """Reads ?start=&end= ISO dates; defaults to the last `default_days` days."""
+    end = request.args.get("end")
+    start = request.args.get("start")
+    end = datetime.date.fromisoformat(end) if end else datetime.date.today() + datetime.timedelta(days=1)
+    start = datetime.date.fromisoformat(start) if start else end - datetime.timedelta(days=default_days)
+    return start, end
+
+@app.route("/sales_funnel/analytics/conversion", methods=["GET"])
+def get_stage_conversion_rates():
+    try:
+        start, end = _date_window()
+    except ValueError:
+        return jsonify({"error": "start and end must be ISO dates (YYYY-MM-DD)"}), 400
+    return jsonify({
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "stages": crm.get_stage_conversion_rates(start, end),
+    })
+
+@app.route("/sales_funnel/analytics/time_in_stage", methods=["GET"])
+def get_median_time_in_stage():
+    try:
+        start, end = _date_window()
+    except ValueError:
+        return jsonify({"error": "start and end must be ISO dates (YYYY-MM-DD)"}), 400
+    return jsonify({
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "stages": crm.get_median_time_in_stage(start, end),
+    })
 
 @app.route("/sales_funnel/<company_name>", methods=["GET"])
 def get_sales_funnel_entry(company_name):
     entry = crm.get_sales_funnel_entry(company_name)
     if entry:
-        return jsonify(dict(entry))
+        return jsonify(sales_funnel_entry_to_dict(entry))
     return jsonify({"message": "Sales funnel entry not found"}), 404
 
 @app.route("/sales_funnel", methods=["POST"])
+@idempotent
 def add_sales_funnel_entry():
     data = request.get_json()
-    crm.add_sales_funnel_entry(data)
-    return jsonify({"message": "Sales funnel entry created"}), 201
+    entry_id = crm.add_sales_funnel_entry(data)
+    return jsonify({"message": "Sales funnel entry created", "id": entry_id}), 201
 
 @app.route("/sales_funnel/<int:client_id>", methods=["PUT"])
 def update_sales_funnel_entry(client_id):
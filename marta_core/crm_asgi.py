@@ -0,0 +1,518 @@
+"""
+ASGI variant of `marta_core.crm_api` backed by `AsyncCRM`.
+
+Exposes the same routes. CRM reads and writes run on the event loop over an
+asyncpg pool; the blocking `ask_marta` call is moved to a worker thread so a
+slow `/marta` request never holds up the loop. Run with:
+
+    uvicorn marta_core.crm_asgi:app --host 0.0.0.0 --port 5001
+"""
+import contextlib
+import datetime
+import functools
+import hashlib
+import json
+import os
+import sys
+import time
+import zlib
+
+import anyio
+from dotenv import load_dotenv
+
+load_dotenv()
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from marta_core.crm import Client, invalidate_changed_clients, sales_funnel_entry_to_dict, to_dicts
+from marta_core.crm_async import AsyncCRM
+from marta_core.admission import AdmissionRejected, llm_admission
+from marta_core.events import AsyncSubscription, change_feed, sse_event, sse_heartbeat, sse_message, wants
+from marta_core.agent import ask_marta, ask_marta_stream, answer_cache, history_store
+
+CLIENTS_MAX_PAGE_SIZE = 1000
+CLIENTS_BATCH_MAX = 200
+SEARCH_MAX_PAGE_SIZE = 100
+
+crm = None
+
+
+def _int_arg(request, name, default=None):
+    try:
+        return int(request.query_params[name])
+    except (KeyError, ValueError):
+        return default
+
+
+def _collection_etag(request, name, *versions):
+    return "-".join([name, *map(str, versions), f"{zlib.crc32(request.url.query.encode()):08x}"])
+
+
+def _etag_matches(request, etag):
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == f'"{etag}"' for tag in header.split(","))
+
+
+def _with_etag(response, etag):
+    response.headers["ETag"] = f'W/"{etag}"'
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+IDEMPOTENCY_KEY_TTL = float(os.environ.get("IDEMPOTENCY_KEY_TTL", "86400"))
+# A worker is killed after GUNICORN_TIMEOUT, so a key in progress for longer was orphaned.
+IDEMPOTENCY_LEASE = float(os.environ.get("IDEMPOTENCY_LEASE", os.environ.get("GUNICORN_TIMEOUT", "120")))
+IDEMPOTENCY_PURGE_INTERVAL = 300.0
+_idempotency_purged_at = [0.0]
+
+
+def _replay(stored, request_hash):
+    stored_hash, status_code, body = stored
+    if stored_hash != request_hash:
+        return JSONResponse({"error": "Idempotency-Key was already used with a different request"}, status_code=422)
+    if status_code is None:
+        return JSONResponse(
+            {"error": "A request with this Idempotency-Key is still in progress"}, status_code=409, headers={"Retry-After": "1"}
+        )
+    return Response(body, status_code=status_code, media_type="application/json", headers={"Idempotent-Replayed": "true"})
+
+
+def idempotent(endpoint):
+    """Same Idempotency-Key handling, lease and crash window as crm_api.idempotent."""
+    @functools.wraps(endpoint)
+    async def wrapper(request):
+        key = request.headers.get("idempotency-key")
+        if not key:
+            return await endpoint(request)
+        if len(key) > 255:
+            return JSONResponse({"error": "Idempotency-Key must be at most 255 characters"}, status_code=400)
+
+        if time.monotonic() - _idempotency_purged_at[0] > IDEMPOTENCY_PURGE_INTERVAL:
+            _idempotency_purged_at[0] = time.monotonic()
+            await crm.purge_idempotency_keys()
+
+        route = f"{request.method} {request.url.path}"
+        # Starlette caches the body, so the endpoint can still read it.
+        request_hash = hashlib.sha256(await request.body()).hexdigest()
+        stored = await crm.claim_idempotency_key(key, route, request_hash, IDEMPOTENCY_KEY_TTL, IDEMPOTENCY_LEASE)
+        if stored is not None:
+            return _replay(stored, request_hash)
+        try:
+            response = await endpoint(request)
+        except Exception:
+            await crm.release_idempotency_key(key, route)
+            raise
+        if response.status_code >= 500:
+            await crm.release_idempotency_key(key, route)
+        else:
+            await crm.complete_idempotency_key(key, route, response.status_code, response.body.decode())
+        return response
+    return wrapper
+
+
+async def marta_endpoint(request):
+    data = await request.json()
+    query = data.get("query")
+    if not query:
+        return JSONResponse({"error": "No query provided"}, status_code=400)
+
+    try:
+        response = await run_in_threadpool(_ask_marta_admitted, query, data.get("session_id", "default_session"))
+    except AdmissionRejected as e:
+        return _too_many_requests(e)
+    return JSONResponse({"response": response})
+
+
+def _ask_marta_admitted(query, session_id):
+    # Queued callers wait on a threadpool thread, never on the event loop.
+    with llm_admission.slot():
+        return ask_marta(query, session_id=session_id)
+
+
+def _too_many_requests(rejection):
+    return JSONResponse(
+        {"error": "Marta está atendiendo demasiadas solicitudes; inténtalo de nuevo en unos segundos.", "retry_after": rejection.retry_after},
+        status_code=429,
+        headers={"Retry-After": str(rejection.retry_after)},
+    )
+
+
+class _ClosingStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that always runs `on_close` once it has been served:
+    after the last chunk, on a disconnect, or when sending fails before the
+    body iterator ever started (when its own `finally` would never run).
+    """
+
+    def __init__(self, content, on_close, **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.on_close()
+
+
+async def marta_stream_endpoint(request):
+    """/marta answered as Server-Sent Events while the agent runs; see crm_api."""
+    data = await request.json()
+    query = data.get("query")
+    if not query:
+        return JSONResponse({"error": "No query provided"}, status_code=400)
+
+    try:
+        ticket = await run_in_threadpool(llm_admission.acquire)
+    except AdmissionRejected as e:
+        return _too_many_requests(e)
+    start = time.perf_counter()
+    events = ask_marta_stream(query, session_id=data.get("session_id", "default_session"))
+
+    async def generate():
+        # On a disconnect Starlette cancels this generator, possibly while a
+        # thread waits for the next event; close() below wakes that thread.
+        while True:
+            event = await anyio.to_thread.run_sync(next, events, None, abandon_on_cancel=True)
+            if event is None:
+                break
+            yield sse_message(event["type"], event)
+
+    def close():
+        # Cancels the agent's run if it is still going, then frees the slot.
+        events.close()
+        llm_admission.release(ticket, time.perf_counter() - start)
+
+    return _ClosingStreamingResponse(generate(), close, media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+
+@idempotent
+async def add_client(request):
+    data = await request.json()
+    client = Client(
+        first_name=data["first_name"],
+        last_name=data["last_name"],
+        email=data["email"],
+        phone_number=data["phone_number"],
+        company=data.get("company"),
+        position=data.get("position"),
+    )
+    await crm.add_client(client)
+    return JSONResponse(client.to_dict(), status_code=201)
+
+
+async def add_clients_bulk(request):
+    on_conflict = request.query_params.get("on_conflict", "nothing")
+    if on_conflict not in ("nothing", "update"):
+        return JSONResponse({"error": "on_conflict must be 'nothing' or 'update'"}, status_code=400)
+
+    malformed = 0
+
+    async def parse_lines():
+        nonlocal malformed
+        buffer = b""
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                record = _parse_ndjson_line(line)
+                if record is _MALFORMED:
+                    malformed += 1
+                elif record is not None:
+                    yield record
+        record = _parse_ndjson_line(buffer)
+        if record is _MALFORMED:
+            malformed += 1
+        elif record is not None:
+            yield record
+
+    result = await crm.add_clients_bulk(parse_lines(), on_conflict=on_conflict)
+    result["skipped"] += malformed
+    return JSONResponse(result)
+
+
+_MALFORMED = object()
+
+
+def _parse_ndjson_line(line):
+    if not line.strip():
+        return None
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return _MALFORMED
+    return record if isinstance(record, dict) else _MALFORMED
+
+
+async def get_client(request):
+    email = request.path_params["email"]
+    if request.headers.get("if-none-match"):
+        version = await crm.get_client_version(email)
+        if version is None:
+            return JSONResponse({"message": "Client not found"}, status_code=404)
+        etag = "client-%s-%s" % version
+        if _etag_matches(request, etag):
+            return _with_etag(Response(status_code=304), etag)
+        client = await crm.get_client(email)
+        if client is None or (client.id, client.row_version) != version:
+            crm.client_cache.invalidate(email)
+            client = await crm.get_client(email)
+    else:
+        client = await crm.get_client(email)
+    if client:
+        return _with_etag(JSONResponse(client.to_dict()), f"client-{client.id}-{client.row_version}")
+    return JSONResponse({"message": "Client not found"}, status_code=404)
+
+
+async def get_clients_batch(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = {}
+    emails = data.get("emails") if isinstance(data, dict) else None
+    if not isinstance(emails, list) or not all(isinstance(email, str) for email in emails):
+        return JSONResponse({"error": "emails must be a list of strings"}, status_code=400)
+    if len(emails) > CLIENTS_BATCH_MAX:
+        return JSONResponse({"error": f"At most {CLIENTS_BATCH_MAX} emails per request"}, status_code=400)
+
+    clients = await crm.get_clients(emails)
+    return JSONResponse({
+        "clients": {email: client.to_dict() if client else None for email, client in clients.items()},
+        "missing": [email for email, client in clients.items() if client is None],
+    })
+
+
+async def get_all_clients(request):
+    limit = _int_arg(request, "limit")
+    after = _int_arg(request, "after")
+    if limit is not None and not 0 < limit <= CLIENTS_MAX_PAGE_SIZE:
+        return JSONResponse({"error": f"limit must be between 1 and {CLIENTS_MAX_PAGE_SIZE}"}, status_code=400)
+
+    version, _ = (await crm.get_change_versions())["clients"]
+    etag = _collection_etag(request, "clients", version)
+    if _etag_matches(request, etag):
+        return _with_etag(Response(status_code=304), etag)
+
+    if request.query_params.get("stream") in ("1", "true"):
+        return _with_etag(StreamingResponse(_stream_clients(after, limit), media_type="application/json"), etag)
+
+    page = to_dicts([client async for client in crm.iter_clients(after_id=after, limit=limit)])
+    response = JSONResponse(page)
+    if limit is not None and len(page) == limit:
+        response.headers["X-Next-After"] = str(page[-1]["id"])
+    return _with_etag(response, etag)
+
+
+async def _stream_clients(after, limit, chunk_size=500):
+    separator = "["
+    chunk = []
+    async for client in crm.iter_clients(after_id=after, limit=limit, batch_size=chunk_size):
+        chunk.append(client)
+        if len(chunk) == chunk_size:
+            yield separator + ",".join(json.dumps(c, default=str) for c in to_dicts(chunk))
+            separator = ","
+            chunk = []
+    if chunk:
+        yield separator + ",".join(json.dumps(c, default=str) for c in to_dicts(chunk))
+        separator = ","
+    yield "]" if separator == "," else "[]"
+
+
+async def search_clients(request):
+    q = request.query_params.get("q", "").strip()
+    limit = min(_int_arg(request, "limit", 20), SEARCH_MAX_PAGE_SIZE)
+    offset = max(_int_arg(request, "offset", 0), 0)
+    insights = request.query_params.get("insights")
+    if insights:
+        try:
+            insights = json.loads(insights)
+        except ValueError:
+            return JSONResponse({"error": "insights must be a JSON object"}, status_code=400)
+        if not isinstance(insights, dict):
+            return JSONResponse({"error": "insights must be a JSON object"}, status_code=400)
+    if not q and not insights:
+        return JSONResponse({"error": "Provide q and/or insights"}, status_code=400)
+    if limit < 1:
+        return JSONResponse({"error": "limit must be positive"}, status_code=400)
+
+    results = await crm.search_clients(q, limit=limit, offset=offset, insights=insights)
+    clients = to_dicts(record for record, _ in results)
+    for client, (_, rank) in zip(clients, results):
+        client["rank"] = round(rank, 4)
+    return JSONResponse({"results": clients, "limit": limit, "offset": offset})
+
+
+async def update_client(request):
+    data = await request.json()
+    client = await crm.update_client(request.path_params["email"], data)
+    if client:
+        return JSONResponse(client.to_dict())
+    return JSONResponse({"message": "Client not found"}, status_code=404)
+
+
+async def cache_stats(request):
+    return JSONResponse({
+        "client_cache": crm.client_cache.stats(),
+        "llm_admission": llm_admission.stats(),
+        "chat_history": history_store.stats(),
+        "answer_cache": answer_cache.stats() if answer_cache else None,
+    })
+
+
+async def get_all_sales_funnel_entries(request):
+    versions = await crm.get_change_versions()
+    etag = _collection_etag(request, "sales_funnel", versions["sales_funnel"][0], versions["clients"][0])
+    if _etag_matches(request, etag):
+        return _with_etag(Response(status_code=304), etag)
+    return _with_etag(JSONResponse(await crm.get_all_sales_funnel_entries()), etag)
+
+
+async def get_sales_funnel_summary(request):
+    return JSONResponse(await crm.get_sales_funnel_summary())
+
+
+def _date_window(request, default_days=90):
+    end = request.query_params.get("end")
+    start = request.query_params.get("start")
+    end = datetime.date.fromisoformat(end) if end else datetime.date.today() + datetime.timedelta(days=1)
+    start = datetime.date.fromisoformat(start) if start else end - datetime.timedelta(days=default_days)
+    return start, end
+
+
+async def get_stage_conversion_rates(request):
+    try:
+        start, end = _date_window(request)
+    except ValueError:
+        return JSONResponse({"error": "start and end must be ISO dates (YYYY-MM-DD)"}, status_code=400)
+    return JSONResponse({
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "stages": await crm.get_stage_conversion_rates(start, end),
+    })
+
+
+async def get_median_time_in_stage(request):
+    try:
+        start, end = _date_window(request)
+    except ValueError:
+        return JSONResponse({"error": "start and end must be ISO dates (YYYY-MM-DD)"}, status_code=400)
+    return JSONResponse({
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "stages": await crm.get_median_time_in_stage(start, end),
+    })
+
+
+EVENTS_HEARTBEAT_SECONDS = 15.0
+EVENTS_RETRY_MS = 1000
+
+
+async def stream_events(request):
+    """Same feed as crm_api's /events, kept open until the client disconnects."""
+    resources = set(filter(None, request.query_params.get("resources", "").split(","))) or None
+    # Waiting for the listener's LISTEN blocks, so it happens off the loop.
+    await run_in_threadpool(change_feed.wait_until_listening)
+    subscription = change_feed.subscribe(request.headers.get("last-event-id"), AsyncSubscription, wait=0)
+
+    async def generate():
+        last_event_id = subscription.last_event_id
+        try:
+            yield f"retry: {EVENTS_RETRY_MS}\n" + sse_heartbeat(last_event_id)
+            while True:
+                item = await subscription.get(timeout=EVENTS_HEARTBEAT_SECONDS)
+                if item is None:
+                    yield sse_heartbeat(last_event_id)
+                    continue
+                last_event_id, event = item
+                if wants(event, resources):
+                    yield sse_event(last_event_id, event)
+        finally:
+            subscription.close()
+
+    return StreamingResponse(generate(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+
+async def get_sales_funnel_entry(request):
+    entry = await crm.get_sales_funnel_entry(request.path_params["company_name"])
+    if entry:
+        return JSONResponse(sales_funnel_entry_to_dict(entry))
+    return JSONResponse({"message": "Sales funnel entry not found"}, status_code=404)
+
+
+@idempotent
+async def add_sales_funnel_entry(request):
+    data = await request.json()
+    entry_id = await crm.add_sales_funnel_entry(data)
+    return JSONResponse({"message": "Sales funnel entry created", "id": entry_id}, status_code=201)
+
+
+async def update_sales_funnel_entry(request):
+    data = await request.json()
+    await crm.update_sales_funnel_entry(request.path_params["client_id"], data)
+    return JSONResponse({"message": "Sales funnel entry updated"})
+
+
+async def delete_sales_funnel_entry(request):
+    await crm.delete_sales_funnel_entry(request.path_params["client_id"])
+    return JSONResponse({"message": "Sales funnel entry deleted"})
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global crm
+    crm = await AsyncCRM.from_env()
+    # Writes by other workers reach the client cache through the change feed.
+    change_feed.add_listener(functools.partial(invalidate_changed_clients, crm.client_cache))
+    await run_in_threadpool(change_feed.wait_until_listening)
+    try:
+        yield
+    finally:
+        await crm.close()
+
+
+routes = [
+    Route("/marta", marta_endpoint, methods=["POST"]),
+    Route("/marta/stream", marta_stream_endpoint, methods=["POST"]),
+    Route("/client", add_client, methods=["POST"]),
+    Route("/clients/bulk", add_clients_bulk, methods=["POST"]),
+    Route("/clients/batch", get_clients_batch, methods=["POST"]),
+    Route("/clients/search", search_clients, methods=["GET"]),
+    Route("/clients", get_all_clients, methods=["GET"]),
+    Route("/client/{email}", get_client, methods=["GET"]),
+    Route("/client/{email}", update_client, methods=["PUT"]),
+    Route("/cache/stats", cache_stats, methods=["GET"]),
+    Route("/sales_funnel", get_all_sales_funnel_entries, methods=["GET"]),
+    Route("/sales_funnel", add_sales_funnel_entry, methods=["POST"]),
+    Route("/events", stream_events, methods=["GET"]),
+    Route("/sales_funnel/summary", get_sales_funnel_summary, methods=["GET"]),
+    Route("/sales_funnel/analytics/conversion", get_stage_conversion_rates, methods=["GET"]),
+    Route("/sales_funnel/analytics/time_in_stage", get_median_time_in_stage, methods=["GET"]),
+    Route("/sales_funnel/{client_id:int}", update_sales_funnel_entry, methods=["PUT"]),
+    Route("/sales_funnel/{client_id:int}", delete_sales_funnel_entry, methods=["DELETE"]),
+    Route("/sales_funnel/{company_name}", get_sales_funnel_entry, methods=["GET"]),
+]
+
+app = Starlette(
+    routes=routes,
+    middleware=[Middleware(CORSMiddleware, allow_origins=["http://localhost:9002"], allow_methods=["*"], allow_headers=["*"])],
+    lifespan=lifespan,
+)
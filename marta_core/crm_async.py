@@ -0,0 +1,338 @@
+"""
+asyncio counterpart of `marta_core.crm.CRM` on an asyncpg pool.
+
+The method surface mirrors `CRM` (every method is a coroutine, `iter_clients`
+is an async generator) and the SQL is shared with it: statements written
+with psycopg2 placeholders are rewritten to asyncpg's `$n` form by
+`to_asyncpg`.
+"""
+import datetime
+import functools
+import json
+import os
+import re
+
+import asyncpg
+
+from .cache import LRUCache
+from .crm import (
+    BULK_CLIENT_COLUMNS, CHANGE_VERSIONS_SQL, CLAIM_IDEMPOTENCY_KEY_SQL, CLIENT_COLUMNS, CLIENT_SELECT,
+    CLIENT_VERSION_SQL, COMPLETE_IDEMPOTENCY_KEY_SQL, IDEMPOTENCY_KEY_SQL, PURGE_IDEMPOTENCY_KEYS_SQL,
+    RELEASE_IDEMPOTENCY_KEY_SQL, SALES_FUNNEL_ENTRIES_SQL,
+    SALES_FUNNEL_SUMMARY_SQL, STAGE_CONVERSION_SQL, TIME_IN_STAGE_SQL, ClientRecord,
+    _copy_value, conversion_row_to_dict, sales_funnel_entry_to_dict, search_clients_query,
+    summary_row_to_dict, time_in_stage_row_to_dict,
+)
+from .db import connection_params_from_env
+
+_PLACEHOLDER = re.compile(r"%\((\w+)\)s|%s|%%")
+
+_NOT_CACHED = object()
+
+_json_dumps = functools.partial(json.dumps, default=str)
+
+
+def to_asyncpg(sql, params=()):
+    """Rewrites %s / %(name)s placeholders to $n and returns (sql, args)."""
+    args = []
+    named = {}
+    positional = iter(params) if not isinstance(params, dict) else None
+
+    def replace(match):
+        if match.group(0) == "%%":
+            return "%"
+        name = match.group(1)
+        if name is None:
+            args.append(next(positional))
+            return f"${len(args)}"
+        if name not in named:
+            args.append(params[name])
+            named[name] = len(args)
+        return f"${named[name]}"
+
+    return _PLACEHOLDER.sub(replace, sql), args
+
+
+def _as_datetime(value):
+    if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        return datetime.datetime.combine(value, datetime.time())
+    return value
+
+
+async def _init_connection(conn):
+    await conn.set_type_codec("jsonb", encoder=_json_dumps, decoder=json.loads, schema="pg_catalog")
+
+
+async def create_pool():
+    params = connection_params_from_env()
+    return await asyncpg.create_pool(
+        database=params["dbname"],
+        user=params["user"],
+        password=params["password"],
+        host=params["host"],
+        port=int(params["port"]),
+        min_size=int(os.environ.get("POSTGRES_POOL_MIN", "1")),
+        max_size=int(os.environ.get("POSTGRES_POOL_MAX", "10")),
+        init=_init_connection,
+    )
+
+
+class AsyncCRM:
+    def __init__(self, pool, client_cache=None):
+        self.pool = pool
+        if client_cache is None:
+            client_cache = LRUCache(
+                maxsize=int(os.environ.get("CRM_CLIENT_CACHE_SIZE", "1024")),
+                ttl=float(os.environ.get("CRM_CLIENT_CACHE_TTL", "30")),
+            )
+        self.client_cache = client_cache
+
+    @classmethod
+    async def from_env(cls):
+        return cls(await create_pool())
+
+    async def close(self):
+        await self.pool.close()
+
+    async def _fetch(self, sql, params=()):
+        sql, args = to_asyncpg(sql, params)
+        async with self.pool.acquire() as conn:
+            return await conn.fetch(sql, *args)
+
+    async def _fetchrow(self, sql, params=()):
+        sql, args = to_asyncpg(sql, params)
+        async with self.pool.acquire() as conn:
+            return await conn.fetchrow(sql, *args)
+
+    async def add_client(self, client):
+        # jsonb_populate_record lets Postgres coerce the values to the column types.
+        columns = ", ".join(BULK_CLIENT_COLUMNS)
+        data = {column: getattr(client, column, None) for column in BULK_CLIENT_COLUMNS}
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                f"""
+                INSERT INTO clients ({columns})
+                SELECT {columns} FROM jsonb_populate_record(NULL::clients, $1::jsonb)
+                ON CONFLICT (email) DO NOTHING;
+                """,
+                data,
+            )
+        self.client_cache.invalidate(client.email)
+
+    async def add_clients_bulk(self, clients, on_conflict="nothing"):
+        """Same contract as `CRM.add_clients_bulk`; `clients` may be a sync or async iterable."""
+        if on_conflict not in ("nothing", "update"):
+            raise ValueError(f"on_conflict must be 'nothing' or 'update', got {on_conflict!r}")
+
+        invalid = 0
+
+        async def lines():
+            nonlocal invalid
+            if hasattr(clients, "__aiter__"):
+                source = clients
+            else:
+                async def source_iter():
+                    for client in clients:
+                        yield client
+                source = source_iter()
+            async for client in source:
+                if isinstance(client, dict):
+                    row = [client.get(column) for column in BULK_CLIENT_COLUMNS]
+                else:
+                    row = [getattr(client, column, None) for column in BULK_CLIENT_COLUMNS]
+                if not (row[0] and row[1] and row[3]):
+                    invalid += 1
+                    continue
+                yield ("\t".join(map(_copy_value, row)) + "\n").encode()
+
+        columns = ", ".join(BULK_CLIENT_COLUMNS)
+        if on_conflict == "update":
+            conflict_action = "DO UPDATE SET " + ", ".join(
+                f"{column} = COALESCE(EXCLUDED.{column}, clients.{column})"
+                for column in BULK_CLIENT_COLUMNS if column != "email"
+            )
+        else:
+            conflict_action = "DO NOTHING"
+
+        async with self.pool.acquire() as conn, conn.transaction():
+            await conn.execute(f"""
+                CREATE TEMP TABLE clients_staging ON COMMIT DROP AS
+                SELECT {columns} FROM clients WITH NO DATA;
+            """)
+            status = await conn.copy_to_table(
+                "clients_staging", source=lines(), columns=list(BULK_CLIENT_COLUMNS), format="text"
+            )
+            staged = int(status.split()[-1])
+            inserted, updated = await conn.fetchrow(f"""
+                WITH merged AS (
+                    INSERT INTO clients ({columns})
+                    SELECT DISTINCT ON (email) {columns} FROM clients_staging
+                    ORDER BY email, ctid DESC
+                    ON CONFLICT (email) {conflict_action}
+                    RETURNING (xmax = 0) AS inserted
+                )
+                SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted)
+                FROM merged;
+            """)
+        if inserted or updated:
+            self.client_cache.clear()
+
+        return {
+            "inserted": inserted,
+            "updated": updated,
+            "skipped": staged - inserted - updated + invalid,
+        }
+
+    async def get_client(self, email):
+        cached = self.client_cache.get(email, _NOT_CACHED)
+        if cached is not _NOT_CACHED:
+            return cached
+        generation = self.client_cache.generation
+        row = await self._fetchrow(CLIENT_SELECT + " WHERE email = %s;", (email,))
+        client = ClientRecord._make(row) if row else None
+        self.client_cache.set_if_unchanged(email, client, generation)
+        return client
+
+    async def get_clients(self, emails):
+        result = {}
+        missing = []
+        for email in dict.fromkeys(emails):
+            cached = self.client_cache.get(email, _NOT_CACHED)
+            if cached is _NOT_CACHED:
+                missing.append(email)
+            else:
+                result[email] = cached
+        if missing:
+            generation = self.client_cache.generation
+            rows = await self._fetch(CLIENT_SELECT + " WHERE email = ANY(%s);", (missing,))
+            found = {client.email: client for client in map(ClientRecord._make, rows)}
+            for email in missing:
+                client = found.get(email)
+                self.client_cache.set_if_unchanged(email, client, generation)
+                result[email] = client
+        return result
+
+    async def get_client_version(self, email):
+        row = await self._fetchrow(CLIENT_VERSION_SQL, (email,))
+        return tuple(row) if row else None
+
+    async def get_change_versions(self):
+        return {resource: (version, changed_at) for resource, version, changed_at in await self._fetch(CHANGE_VERSIONS_SQL)}
+
+    async def claim_idempotency_key(self, key, route, request_hash, ttl, lease):
+        claim_sql, claim_args = to_asyncpg(CLAIM_IDEMPOTENCY_KEY_SQL, {
+            "key": key, "route": route, "request_hash": request_hash, "ttl": float(ttl), "lease": float(lease),
+        })
+        sql, args = to_asyncpg(IDEMPOTENCY_KEY_SQL, (key, route))
+        async with self.pool.acquire() as conn, conn.transaction():
+            if await conn.fetchval(claim_sql, *claim_args) is not None:
+                return None
+            stored = await conn.fetchrow(sql, *args)
+        return tuple(stored) if stored else (request_hash, None, None)
+
+    async def complete_idempotency_key(self, key, route, status_code, response_body):
+        sql, args = to_asyncpg(COMPLETE_IDEMPOTENCY_KEY_SQL, (status_code, response_body, key, route))
+        async with self.pool.acquire() as conn:
+            await conn.execute(sql, *args)
+
+    async def release_idempotency_key(self, key, route):
+        sql, args = to_asyncpg(RELEASE_IDEMPOTENCY_KEY_SQL, (key, route))
+        async with self.pool.acquire() as conn:
+            await conn.execute(sql, *args)
+
+    async def purge_idempotency_keys(self):
+        async with self.pool.acquire() as conn:
+            status = await conn.execute(PURGE_IDEMPOTENCY_KEYS_SQL)
+        return int(status.split()[-1])
+
+    async def get_all_clients(self):
+        return [client async for client in self.iter_clients()]
+
+    async def iter_clients(self, after_id=None, limit=None, batch_size=1000):
+        sql, args = to_asyncpg(CLIENT_SELECT + " WHERE id > %s ORDER BY id LIMIT %s;", (after_id or 0, limit))
+        async with self.pool.acquire() as conn, conn.transaction():
+            async for row in conn.cursor(sql, *args, prefetch=batch_size):
+                yield ClientRecord._make(row)
+
+    async def search_clients(self, q=None, limit=20, offset=0, insights=None):
+        query = search_clients_query(q, limit, offset, insights)
+        if query is None:
+            return []
+        rows = await self._fetch(*query)
+        return [(ClientRecord._make(tuple(row)[:-1]), float(row[-1])) for row in rows]
+
+    async def update_client(self, email, data):
+        assignments = "".join(f"{column} = r.{column}, " for column in data)
+        row = await self._fetchrow(
+            f"""
+            UPDATE clients c SET {assignments}last_contact = %s
+            FROM jsonb_populate_record(NULL::clients, %s::jsonb) r
+            WHERE c.email = %s
+            RETURNING {', '.join(f'c.{column}' for column in CLIENT_COLUMNS)};
+            """,
+            (datetime.datetime.now(), data, email),
+        )
+        client = ClientRecord._make(row) if row else None
+        # Dropped rather than refreshed: a concurrent update may have committed after this one.
+        self.client_cache.invalidate(email)
+        if client is not None and client.email != email:
+            self.client_cache.invalidate(client.email)
+        return client
+
+    async def get_all_sales_funnel_entries(self):
+        return [sales_funnel_entry_to_dict(row) for row in await self._fetch(SALES_FUNNEL_ENTRIES_SQL + ";")]
+
+    async def get_sales_funnel_summary(self):
+        return [summary_row_to_dict(row) for row in await self._fetch(SALES_FUNNEL_SUMMARY_SQL)]
+
+    async def get_stage_conversion_rates(self, start, end):
+        params = {"start": _as_datetime(start), "end": _as_datetime(end)}
+        return [conversion_row_to_dict(tuple(row)) for row in await self._fetch(STAGE_CONVERSION_SQL, params)]
+
+    async def get_median_time_in_stage(self, start, end):
+        params = {"start": _as_datetime(start), "end": _as_datetime(end)}
+        return [time_in_stage_row_to_dict(tuple(row)) for row in await self._fetch(TIME_IN_STAGE_SQL, params)]
+
+    async def get_sales_funnel_entry(self, company_name):
+        row = await self._fetchrow(SALES_FUNNEL_ENTRIES_SQL + " WHERE c.company = %s;", (company_name,))
+        return tuple(row) if row else None
+
+    async def add_sales_funnel_entry(self, data):
+        async with self.pool.acquire() as conn, conn.transaction():
+            if 'company' in data and 'client_id' not in data:
+                client_id = await conn.fetchval("SELECT id FROM clients WHERE company = $1 LIMIT 1", data['company'])
+                if client_id is None:
+                    raise ValueError(f"No client found with company: {data['company']}")
+            else:
+                client_id = data['client_id']
+
+            entry = {
+                "client_id": client_id, "stage": data['stage'], "status": data['status'], "notes": data['notes'],
+                "estimated_value": data.get('estimated_value'), "close_date": data.get('close_date'),
+            }
+            return await conn.fetchval(
+                """
+                INSERT INTO sales_funnel (client_id, stage, status, notes, estimated_value, close_date)
+                SELECT client_id, stage, status, notes, estimated_value, close_date
+                FROM jsonb_populate_record(NULL::sales_funnel, $1::jsonb)
+                RETURNING id;
+                """,
+                entry,
+            )
+
+    async def update_sales_funnel_entry(self, client_id, data):
+        assignments = "".join(f"{column} = r.{column}, " for column in data)
+        sql, args = to_asyncpg(
+            f"""
+            UPDATE sales_funnel sf SET {assignments}updated_at = %s
+            FROM jsonb_populate_record(NULL::sales_funnel, %s::jsonb) r
+            WHERE sf.client_id = %s;
+            """,
+            (datetime.datetime.now(), data, client_id),
+        )
+        async with self.pool.acquire() as conn:
+            await conn.execute(sql, *args)
+
+    async def delete_sales_funnel_entry(self, client_id):
+        async with self.pool.acquire() as conn:
+            await conn.execute("DELETE FROM sales_funnel WHERE client_id = $1;", client_id)
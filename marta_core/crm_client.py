@@ -0,0 +1,153 @@
+"""
+Clients for reading the CRM from another app (crm_webapp).
+
+`HTTPCRMClient` talks to crm_api over a keep-alive `requests.Session` with
+timeouts and a short-TTL response cache; once an entry is older than the
+TTL it is revalidated with If-None-Match, so an unchanged resource costs a
+304. `LocalCRMClient` has the same methods but calls `marta_core.crm.CRM`
+in-process, for deployments where both apps share a process and the HTTP
+hop is pure overhead. Both return the JSON shapes crm_api serves.
+
+`client_from_env()` picks one from CRM_API_MODE ("http" or "local").
+"""
+import os
+import time
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .cache import LRUCache
+from .crm import crm_from_env, to_dicts
+
+DEFAULT_PAGE_SIZE = 200
+BATCH_SIZE = 200  # crm_api's CLIENTS_BATCH_MAX
+
+
+class CRMClientError(Exception):
+    """The CRM API could not be reached or answered with an error."""
+
+
+class HTTPCRMClient:
+    def __init__(self, base_url, timeout=(3.05, 10.0), cache_ttl=5.0, cache_size=256, pool_size=10, retries=2):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        # Entries outlive cache_ttl so their ETag can be used to revalidate them.
+        self.cache = LRUCache(maxsize=cache_size, ttl=max(cache_ttl * 60, 300.0))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=Retry(total=retries, backoff_factor=0.2, allowed_methods=["GET"], status_forcelist=[502, 503, 504]),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _get(self, path, params=None):
+        """GETs `path` and returns (json body, headers); the body is None for a 404."""
+        key = (path, tuple(sorted((params or {}).items())))
+        cached = self.cache.get(key)
+        if cached is not None and time.monotonic() - cached["fetched_at"] < self.cache_ttl:
+            return cached["body"], cached["headers"]
+
+        headers = {"If-None-Match": cached["etag"]} if cached and cached["etag"] else {}
+        try:
+            response = self.session.get(self.base_url + path, params=params, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise CRMClientError(f"CRM API request to {path} failed: {e}") from e
+
+        if response.status_code == 304 and cached is not None:
+            cached["fetched_at"] = time.monotonic()
+            return cached["body"], cached["headers"]
+        if response.status_code == 404:
+            return None, response.headers
+        if not response.ok:
+            raise CRMClientError(f"CRM API {path} returned {response.status_code}: {response.text[:200]}")
+
+        body = response.json()
+        self.cache.set(key, {
+            "fetched_at": time.monotonic(),
+            "etag": response.headers.get("ETag"),
+            "body": body,
+            "headers": {"X-Next-After": response.headers.get("X-Next-After")},
+        })
+        return body, response.headers
+
+    def get_client(self, email):
+        client, _ = self._get(f"/client/{quote(email, safe='@')}")
+        return client
+
+    def get_clients(self, emails):
+        """{email: client or None} through POST /clients/batch (not cached)."""
+        result = {}
+        emails = list(dict.fromkeys(emails))
+        for start in range(0, len(emails), BATCH_SIZE):
+            try:
+                response = self.session.post(
+                    self.base_url + "/clients/batch", json={"emails": emails[start:start + BATCH_SIZE]}, timeout=self.timeout
+                )
+                response.raise_for_status()
+            except requests.RequestException as e:
+                raise CRMClientError(f"CRM API request to /clients/batch failed: {e}") from e
+            result.update(response.json()["clients"])
+        return result
+
+    def get_clients_page(self, after=None, limit=DEFAULT_PAGE_SIZE):
+        """One keyset page: (clients, after id for the next page or None)."""
+        params = {"limit": limit}
+        if after is not None:
+            params["after"] = after
+        clients, headers = self._get("/clients", params)
+        next_after = headers.get("X-Next-After")
+        return clients or [], int(next_after) if next_after else None
+
+    def iter_clients(self, page_size=DEFAULT_PAGE_SIZE):
+        after = None
+        while True:
+            clients, after = self.get_clients_page(after, page_size)
+            yield from clients
+            if after is None:
+                return
+
+    def get_all_clients(self, page_size=DEFAULT_PAGE_SIZE):
+        return list(self.iter_clients(page_size))
+
+    def close(self):
+        self.session.close()
+
+
+class LocalCRMClient:
+    def __init__(self, crm=None):
+        self.crm = crm or crm_from_env()
+
+    def get_client(self, email):
+        client = self.crm.get_client(email)
+        return client.to_dict() if client else None
+
+    def get_clients(self, emails):
+        return {email: client.to_dict() if client else None for email, client in self.crm.get_clients(emails).items()}
+
+    def get_clients_page(self, after=None, limit=DEFAULT_PAGE_SIZE):
+        clients = to_dicts(self.crm.iter_clients(after_id=after, limit=limit))
+        return clients, clients[-1]["id"] if len(clients) == limit else None
+
+    def iter_clients(self, page_size=DEFAULT_PAGE_SIZE):
+        return (client.to_dict() for client in self.crm.iter_clients(batch_size=page_size))
+
+    def get_all_clients(self, page_size=DEFAULT_PAGE_SIZE):
+        return list(self.iter_clients(page_size))
+
+    def close(self):
+        self.crm.pool.closeall()
+
+
+def client_from_env():
+    if os.environ.get("CRM_API_MODE", "http") == "local":
+        return LocalCRMClient()
+    return HTTPCRMClient(
+        os.environ.get("CRM_API_URL", "http://127.0.0.1:5000"),
+        timeout=(3.05, float(os.environ.get("CRM_API_TIMEOUT", "10"))),
+        cache_ttl=float(os.environ.get("CRM_API_CACHE_TTL", "5")),
+    )
@@ -0,0 +1,811 @@
+"""
+SQLite backend for `marta_core.crm`, for local development, CI and offline
+deployments without a Postgres server.
+
+`SQLiteCRM` has the methods and return types of `CRM`. The database is a
+single file in WAL mode, so readers never block the writer or each other;
+ai_insights is stored as JSON text and queried with SQLite's JSON functions.
+The schema mirrors the Postgres migrations, including the triggers that keep
+row versions, change counters, the funnel summary and the stage history, and
+is created when the file is first opened (versioned by PRAGMA user_version).
+
+Where SQLite differs:
+- Search runs on FTS5, a unicode61 index over name, company and notes, plus
+  pg_trgm's similarity over name and email, registered as an SQL function
+  and computed on a scan (as Postgres would without its trigram index), so
+  typos match as they do there. There is no Spanish stemming.
+- `insights` filters match top-level keys of ai_insights by equality rather
+  than full jsonb containment.
+- There is no LISTEN/NOTIFY, so GET /events streams nothing, and a write by
+  another worker reaches this worker's client cache only when the entry
+  expires (CRM_CLIENT_CACHE_TTL; 0 size disables the cache).
+- Writes are serialized by SQLite; bulk loads hold the write lock throughout.
+
+Select it with CRM_BACKEND=sqlite and CRM_SQLITE_PATH (see `crm_from_env`).
+"""
+import datetime
+import decimal
+import functools
+import json
+import os
+import re
+import sqlite3
+import statistics
+import threading
+import time
+from contextlib import contextmanager
+
+from .cache import LRUCache
+from .crm import (
+    BULK_CLIENT_COLUMNS, CLIENT_COLUMNS, CLIENT_SELECT, SALES_FUNNEL_ENTRIES_SQL, ClientRecord,
+    conversion_row_to_dict, sales_funnel_entry_to_dict, summary_row_to_dict, time_in_stage_row_to_dict,
+)
+from .db import PoolTimeout
+
+DEFAULT_PATH = "marta_crm.sqlite3"
+
+SCHEMA_VERSION = 2
+
+_NOT_CACHED = object()
+
+_CENTS = decimal.Decimal("0.01")
+
+# Timestamps are stored as ISO 8601 text. Local time for the columns that are
+# TIMESTAMP in Postgres, UTC for the TIMESTAMPTZ ones.
+LOCAL_NOW = "strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')"
+UTC_NOW = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+
+def _epoch(column):
+    # Seconds since 1970 of a timestamp read as UTC, like Postgres' extract(epoch ...).
+    return f"((julianday({column}) - 2440587.5) * 86400.0)"
+
+
+sqlite3.register_adapter(datetime.datetime, lambda value: value.isoformat(" "))
+sqlite3.register_adapter(datetime.date, lambda value: value.isoformat())
+sqlite3.register_adapter(decimal.Decimal, str)
+sqlite3.register_converter("TIMESTAMP", lambda value: datetime.datetime.fromisoformat(value.decode()))
+sqlite3.register_converter(
+    "TIMESTAMPTZ", lambda value: datetime.datetime.fromisoformat(value.decode()).replace(tzinfo=datetime.timezone.utc)
+)
+sqlite3.register_converter("DATE", lambda value: datetime.date.fromisoformat(value.decode()[:10]))
+sqlite3.register_converter("DECIMAL", lambda value: decimal.Decimal(value.decode()).quantize(_CENTS))
+sqlite3.register_converter("JSON", json.loads)
+
+
+def _summary_apply(row, sign):
+    return f"""
+        INSERT INTO sales_funnel_summary (stage, entry_count, total_cents, aged_count, created_epoch_sum)
+        VALUES (
+            {row}.stage, {sign}, {sign} * CAST(round(COALESCE({row}.estimated_value, 0) * 100) AS INTEGER),
+            CASE WHEN {row}.created_at IS NULL THEN 0 ELSE {sign} END,
+            {sign} * COALESCE({_epoch(f"{row}.created_at")}, 0)
+        )
+        ON CONFLICT (stage) DO UPDATE SET
+            entry_count = entry_count + excluded.entry_count,
+            total_cents = total_cents + excluded.total_cents,
+            aged_count = aged_count + excluded.aged_count,
+            created_epoch_sum = created_epoch_sum + excluded.created_epoch_sum;
+    """
+
+
+def _change_counter_triggers(table):
+    return "".join(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_change_counter_{op.lower()} AFTER {op} ON {table}
+        BEGIN
+            UPDATE crm_change_counters SET version = version + 1, changed_at = {UTC_NOW}
+            WHERE resource = '{table}';
+        END;
+        """
+        for op in ("INSERT", "UPDATE", "DELETE")
+    )
+
+
+SCHEMA = f"""
+    CREATE TABLE IF NOT EXISTS clients (
+        id INTEGER PRIMARY KEY,
+        first_name TEXT NOT NULL,
+        last_name TEXT NOT NULL,
+        position TEXT,
+        email TEXT UNIQUE NOT NULL,
+        phone_number TEXT,
+        company TEXT,
+        notes TEXT,
+        last_contact TIMESTAMP,
+        last_contact_source TEXT,
+        ai_insights JSON CHECK (ai_insights IS NULL OR json_valid(ai_insights)),
+        updated_at TIMESTAMP NOT NULL DEFAULT ({LOCAL_NOW}),
+        row_version INTEGER NOT NULL DEFAULT 1
+    );
+    CREATE INDEX IF NOT EXISTS clients_company_idx ON clients (company);
+
+    CREATE TABLE IF NOT EXISTS sales_funnel (
+        id INTEGER PRIMARY KEY,
+        client_id INTEGER NOT NULL REFERENCES clients(id) ON DELETE CASCADE,
+        stage TEXT NOT NULL CHECK (stage IN ('Lead', 'Contacted', 'Proposal', 'Negotiation', 'Won', 'Lost')),
+        status TEXT NOT NULL,
+        notes TEXT,
+        estimated_value DECIMAL,
+        close_date DATE,
+        created_at TIMESTAMP DEFAULT ({LOCAL_NOW}),
+        updated_at TIMESTAMP DEFAULT ({LOCAL_NOW}),
+        row_version INTEGER NOT NULL DEFAULT 1
+    );
+    CREATE INDEX IF NOT EXISTS sales_funnel_client_id_idx ON sales_funnel (client_id);
+    CREATE INDEX IF NOT EXISTS sales_funnel_stage_idx ON sales_funnel (stage);
+
+    CREATE TRIGGER IF NOT EXISTS clients_bump_row_version AFTER UPDATE ON clients
+    WHEN NEW.row_version = OLD.row_version
+    BEGIN
+        UPDATE clients SET row_version = OLD.row_version + 1, updated_at = {LOCAL_NOW} WHERE id = NEW.id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS sales_funnel_bump_row_version AFTER UPDATE ON sales_funnel
+    WHEN NEW.row_version = OLD.row_version
+    BEGIN
+        UPDATE sales_funnel SET row_version = OLD.row_version + 1, updated_at = {LOCAL_NOW} WHERE id = NEW.id;
+    END;
+
+    -- Probabilities are text so they read back as exact decimals.
+    CREATE TABLE IF NOT EXISTS sales_funnel_stage_weights (
+        stage TEXT PRIMARY KEY,
+        position INTEGER NOT NULL,
+        probability TEXT NOT NULL
+    );
+    INSERT OR IGNORE INTO sales_funnel_stage_weights (stage, position, probability) VALUES
+        ('Lead', 1, '0.100'), ('Contacted', 2, '0.200'), ('Proposal', 3, '0.500'),
+        ('Negotiation', 4, '0.750'), ('Won', 5, '1.000'), ('Lost', 6, '0.000');
+
+    CREATE TABLE IF NOT EXISTS sales_funnel_summary (
+        stage TEXT PRIMARY KEY,
+        entry_count INTEGER NOT NULL DEFAULT 0,
+        total_cents INTEGER NOT NULL DEFAULT 0,
+        aged_count INTEGER NOT NULL DEFAULT 0,
+        created_epoch_sum REAL NOT NULL DEFAULT 0
+    );
+    CREATE TRIGGER IF NOT EXISTS sales_funnel_summary_insert AFTER INSERT ON sales_funnel
+    BEGIN {_summary_apply("NEW", 1)} END;
+    CREATE TRIGGER IF NOT EXISTS sales_funnel_summary_delete AFTER DELETE ON sales_funnel
+    BEGIN {_summary_apply("OLD", -1)} END;
+    CREATE TRIGGER IF NOT EXISTS sales_funnel_summary_update
+    AFTER UPDATE OF stage, estimated_value, created_at ON sales_funnel
+    WHEN NEW.stage IS NOT OLD.stage OR NEW.estimated_value IS NOT OLD.estimated_value
+         OR NEW.created_at IS NOT OLD.created_at
+    BEGIN {_summary_apply("OLD", -1)} {_summary_apply("NEW", 1)} END;
+
+    CREATE TABLE IF NOT EXISTS sales_funnel_history (
+        id INTEGER PRIMARY KEY,
+        entry_id INTEGER NOT NULL,
+        client_id INTEGER NOT NULL,
+        from_stage TEXT,
+        to_stage TEXT NOT NULL,
+        changed_at TIMESTAMP NOT NULL DEFAULT ({LOCAL_NOW})
+    );
+    CREATE INDEX IF NOT EXISTS sales_funnel_history_changed_at_idx ON sales_funnel_history (changed_at);
+    CREATE INDEX IF NOT EXISTS sales_funnel_history_entry_idx ON sales_funnel_history (entry_id, changed_at);
+    CREATE TRIGGER IF NOT EXISTS sales_funnel_history_insert AFTER INSERT ON sales_funnel
+    BEGIN
+        INSERT INTO sales_funnel_history (entry_id, client_id, from_stage, to_stage)
+        VALUES (NEW.id, NEW.client_id, NULL, NEW.stage);
+    END;
+    CREATE TRIGGER IF NOT EXISTS sales_funnel_history_update AFTER UPDATE OF stage ON sales_funnel
+    WHEN NEW.stage IS NOT OLD.stage
+    BEGIN
+        INSERT INTO sales_funnel_history (entry_id, client_id, from_stage, to_stage)
+        VALUES (NEW.id, NEW.client_id, OLD.stage, NEW.stage);
+    END;
+
+    CREATE TABLE IF NOT EXISTS crm_change_counters (
+        resource TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 1,
+        changed_at TIMESTAMPTZ NOT NULL DEFAULT ({UTC_NOW})
+    );
+    INSERT OR IGNORE INTO crm_change_counters (resource) VALUES ('clients'), ('sales_funnel');
+    {_change_counter_triggers("clients")}
+    {_change_counter_triggers("sales_funnel")}
+
+    CREATE VIRTUAL TABLE IF NOT EXISTS clients_fts USING fts5(
+        first_name, last_name, company, notes,
+        content='clients', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    );
+    -- Version 1 also kept an FTS5 trigram index of name and email.
+    DROP TRIGGER IF EXISTS clients_search_insert;
+    DROP TRIGGER IF EXISTS clients_search_delete;
+    DROP TRIGGER IF EXISTS clients_search_update;
+    DROP TABLE IF EXISTS clients_trgm;
+    CREATE TRIGGER IF NOT EXISTS clients_search_insert AFTER INSERT ON clients
+    BEGIN
+        INSERT INTO clients_fts (rowid, first_name, last_name, company, notes)
+        VALUES (NEW.id, NEW.first_name, NEW.last_name, NEW.company, NEW.notes);
+    END;
+    CREATE TRIGGER IF NOT EXISTS clients_search_delete AFTER DELETE ON clients
+    BEGIN
+        INSERT INTO clients_fts (clients_fts, rowid, first_name, last_name, company, notes)
+        VALUES ('delete', OLD.id, OLD.first_name, OLD.last_name, OLD.company, OLD.notes);
+    END;
+    CREATE TRIGGER IF NOT EXISTS clients_search_update
+    AFTER UPDATE OF first_name, last_name, company, notes ON clients
+    BEGIN
+        INSERT INTO clients_fts (clients_fts, rowid, first_name, last_name, company, notes)
+        VALUES ('delete', OLD.id, OLD.first_name, OLD.last_name, OLD.company, OLD.notes);
+        INSERT INTO clients_fts (rowid, first_name, last_name, company, notes)
+        VALUES (NEW.id, NEW.first_name, NEW.last_name, NEW.company, NEW.notes);
+    END;
+
+    CREATE TABLE IF NOT EXISTS idempotency_keys (
+        key TEXT NOT NULL,
+        route TEXT NOT NULL,
+        request_hash TEXT NOT NULL,
+        status_code INTEGER,
+        response_body TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT ({UTC_NOW}),
+        expires_at TIMESTAMPTZ NOT NULL,
+        PRIMARY KEY (key, route)
+    );
+    CREATE INDEX IF NOT EXISTS idempotency_keys_expires_at_idx ON idempotency_keys (expires_at);
+"""
+
+SALES_FUNNEL_SUMMARY_SQL = f"""
+    SELECT w.stage,
+           COALESCE(s.entry_count, 0),
+           COALESCE(s.total_cents, 0),
+           w.probability,
+           CASE WHEN s.aged_count > 0
+                THEN ({_epoch("'now', 'localtime'")} - s.created_epoch_sum / s.aged_count) / 86400
+           END
+    FROM sales_funnel_stage_weights w
+    LEFT JOIN sales_funnel_summary s ON s.stage = w.stage
+    ORDER BY w.position;
+"""
+
+STAGE_CONVERSION_SQL = """
+    WITH entered AS (
+        SELECT h.entry_id, h.to_stage AS stage, min(h.changed_at) AS entered_at
+        FROM sales_funnel_history h
+        WHERE h.changed_at >= :start AND h.changed_at < :end
+        GROUP BY h.entry_id, h.to_stage
+    ),
+    outcomes AS (
+        SELECT e.stage,
+               max(w_next.stage <> 'Lost' AND w_next.position > w.position) AS advanced,
+               max(w_next.stage = 'Lost') AS lost
+        FROM entered e
+        JOIN sales_funnel_stage_weights w ON w.stage = e.stage
+        LEFT JOIN sales_funnel_history n
+               ON n.entry_id = e.entry_id AND n.changed_at > e.entered_at
+        LEFT JOIN sales_funnel_stage_weights w_next ON w_next.stage = n.to_stage
+        GROUP BY e.entry_id, e.stage
+    )
+    SELECT w.stage,
+           count(o.stage),
+           count(o.stage) FILTER (WHERE o.advanced),
+           count(o.stage) FILTER (WHERE o.lost)
+    FROM sales_funnel_stage_weights w
+    LEFT JOIN outcomes o ON o.stage = w.stage
+    GROUP BY w.stage, w.position
+    ORDER BY w.position;
+"""
+
+# SQLite has no percentile_cont, so the stints are aggregated in Python.
+STAGE_STINTS_SQL = """
+    WITH stints AS (
+        SELECT h.to_stage AS stage,
+               h.changed_at AS entered_at,
+               lead(h.changed_at) OVER (PARTITION BY h.entry_id ORDER BY h.changed_at, h.id) AS left_at
+        FROM sales_funnel_history h
+        WHERE h.entry_id IN (
+            SELECT entry_id FROM sales_funnel_history
+            WHERE changed_at >= :start AND changed_at < :end
+        )
+    )
+    SELECT stage, julianday(left_at) - julianday(entered_at)
+    FROM stints
+    WHERE left_at IS NOT NULL AND entered_at >= :start AND entered_at < :end;
+"""
+
+CLAIM_IDEMPOTENCY_KEY_SQL = f"""
+    INSERT INTO idempotency_keys (key, route, request_hash, expires_at)
+    VALUES (:key, :route, :request_hash, strftime('%Y-%m-%d %H:%M:%f', 'now', '+' || :ttl || ' seconds'))
+    ON CONFLICT (key, route) DO UPDATE
+        SET request_hash = excluded.request_hash, status_code = NULL, response_body = NULL,
+            created_at = {UTC_NOW}, expires_at = excluded.expires_at
+        WHERE idempotency_keys.expires_at <= {UTC_NOW}
+           OR (idempotency_keys.status_code IS NULL
+               AND idempotency_keys.created_at <= strftime('%Y-%m-%d %H:%M:%f', 'now', '-' || :lease || ' seconds'))
+    RETURNING key;
+"""
+
+_WORD = re.compile(r"\w+")
+
+
+def _json(value):
+    return json.dumps(value) if isinstance(value, (dict, list)) else value
+
+
+@functools.lru_cache(maxsize=4096)
+def trigrams(text):
+    """pg_trgm's trigrams: each lower-cased word padded with two spaces in front and one behind."""
+    grams = set()
+    for word in _WORD.findall(text.lower()):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return frozenset(grams)
+
+
+def similarity(a, b):
+    """pg_trgm's similarity(): shared trigrams over all distinct trigrams."""
+    if a is None or b is None:
+        return None
+    a, b = trigrams(a), trigrams(b)
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+
+class _Cursor(sqlite3.Cursor):
+    # Lets the CRM code use `with conn.cursor() as cur:` as with psycopg2.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _Connection(sqlite3.Connection):
+    def cursor(self, factory=_Cursor):
+        return super().cursor(factory)
+
+
+class SQLitePool:
+    """
+    Bounded pool of connections to one SQLite file, with the interface of
+    `db.ConnectionPool`. SQLite connections are cheap, but reusing them keeps
+    the page cache and prepared statements warm.
+    """
+
+    def __init__(self, path, maxconn=10, timeout=30.0, busy_timeout=10.0):
+        self.path = path
+        # Every connection to ":memory:" would be a separate empty database.
+        self.maxconn = 1 if path == ":memory:" else maxconn
+        self.timeout = timeout
+        self.busy_timeout = busy_timeout
+        self._idle = []
+        self._in_use = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False,  # used by one thread at a time through the pool
+            factory=_Connection,
+        )
+        conn.execute("PRAGMA journal_mode = WAL;")
+        # Durable at checkpoints rather than at every commit; safe with WAL.
+        conn.execute("PRAGMA synchronous = NORMAL;")
+        conn.execute("PRAGMA foreign_keys = ON;")
+        conn.execute("PRAGMA temp_store = MEMORY;")
+        conn.create_function("similarity", 2, similarity, deterministic=True)
+        return conn
+
+    def getconn(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise sqlite3.ProgrammingError("connection pool is closed")
+                if self._idle:
+                    self._in_use += 1
+                    return self._idle.pop()
+                if self._in_use < self.maxconn:
+                    self._in_use += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(f"Timed out after {timeout}s waiting for a database connection")
+                self._cond.wait(remaining)
+        try:
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, conn, close=False):
+        if conn.in_transaction and not close:
+            conn.rollback()
+        with self._cond:
+            self._in_use -= 1
+            keep = not (close or self._closed)
+            if keep:
+                self._idle.append(conn)
+            self._cond.notify()
+        if not keep:
+            conn.close()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        conn = self.getconn(timeout)
+        broken = False
+        try:
+            yield conn
+        except sqlite3.DatabaseError as e:
+            broken = not isinstance(e, (sqlite3.IntegrityError, sqlite3.OperationalError))
+            raise
+        finally:
+            self.putconn(conn, close=broken)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for conn in idle:
+            conn.close()
+
+    def stats(self):
+        with self._cond:
+            return {"idle": len(self._idle), "in_use": self._in_use, "max": self.maxconn}
+
+
+class SQLiteCRM:
+    def __init__(self, path=DEFAULT_PATH, pool=None, client_cache=None):
+        self.pool = pool or SQLitePool(path)
+        if client_cache is None:
+            client_cache = LRUCache(
+                maxsize=int(os.environ.get("CRM_CLIENT_CACHE_SIZE", "1024")),
+                ttl=float(os.environ.get("CRM_CLIENT_CACHE_TTL", "30")),
+            )
+        self.client_cache = client_cache
+        self._ensure_schema()
+
+    @classmethod
+    def from_env(cls):
+        return cls(pool=SQLitePool(
+            os.environ.get("CRM_SQLITE_PATH", DEFAULT_PATH),
+            maxconn=int(os.environ.get("CRM_SQLITE_POOL_MAX", "10")),
+        ))
+
+    def _ensure_schema(self):
+        with self.pool.connection() as conn:
+            if conn.execute("PRAGMA user_version;").fetchone()[0] >= SCHEMA_VERSION:
+                return
+            # Every statement is idempotent, so processes racing here are harmless.
+            conn.executescript(f"BEGIN IMMEDIATE; {SCHEMA} PRAGMA user_version = {SCHEMA_VERSION}; COMMIT;")
+
+    def add_client(self, client):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO clients (first_name, last_name, position, email, phone_number, company, notes, last_contact, last_contact_source, ai_insights)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (email) DO NOTHING;
+                """,
+                (client.first_name, client.last_name, client.position, client.email, client.phone_number, client.company, client.notes, client.last_contact, client.last_contact_source, _json(client.ai_insights))
+            )
+            conn.commit()
+        self.client_cache.invalidate(client.email)
+
+    def add_clients_bulk(self, clients, on_conflict="nothing"):
+        """
+        Same contract as `CRM.add_clients_bulk`. The batch is de-duplicated by
+        email in memory (the last occurrence wins) and written with one
+        executemany in a single transaction.
+        """
+        if on_conflict not in ("nothing", "update"):
+            raise ValueError(f"on_conflict must be 'nothing' or 'update', got {on_conflict!r}")
+
+        latest = {}
+        staged = invalid = 0
+        for client in clients:
+            if isinstance(client, dict):
+                row = [client.get(column) for column in BULK_CLIENT_COLUMNS]
+            else:
+                row = [getattr(client, column, None) for column in BULK_CLIENT_COLUMNS]
+            first_name, last_name, _, email = row[:4]
+            if not (first_name and last_name and email):
+                invalid += 1
+                continue
+            staged += 1
+            latest.pop(email, None)
+            latest[email] = [_json(value) for value in row]
+
+        columns = ", ".join(BULK_CLIENT_COLUMNS)
+        if on_conflict == "update":
+            conflict_action = "DO UPDATE SET " + ", ".join(
+                f"{column} = COALESCE(excluded.{column}, clients.{column})"
+                for column in BULK_CLIENT_COLUMNS if column != "email"
+            )
+        else:
+            conflict_action = "DO NOTHING"
+
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("BEGIN IMMEDIATE;")
+            cur.execute(
+                "SELECT count(*) FROM clients WHERE email IN (SELECT value FROM json_each(?));",
+                (json.dumps(list(latest)),),
+            )
+            existing = cur.fetchone()[0]
+            cur.executemany(
+                f"INSERT INTO clients ({columns}) VALUES ({', '.join('?' * len(BULK_CLIENT_COLUMNS))}) "
+                f"ON CONFLICT (email) {conflict_action};",
+                latest.values(),
+            )
+            conn.commit()
+        inserted = len(latest) - existing
+        updated = existing if on_conflict == "update" else 0
+        if inserted or updated:
+            self.client_cache.clear()
+
+        return {
+            "inserted": inserted,
+            "updated": updated,
+            "skipped": staged - inserted - updated + invalid,
+        }
+
+    def get_client(self, email):
+        cached = self.client_cache.get(email, _NOT_CACHED)
+        if cached is not _NOT_CACHED:
+            return cached
+        generation = self.client_cache.generation
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(CLIENT_SELECT + " WHERE email = ?;", (email,))
+            row = cur.fetchone()
+        client = ClientRecord._make(row) if row else None
+        self.client_cache.set_if_unchanged(email, client, generation)
+        return client
+
+    def get_clients(self, emails):
+        result = {}
+        missing = []
+        for email in dict.fromkeys(emails):
+            cached = self.client_cache.get(email, _NOT_CACHED)
+            if cached is _NOT_CACHED:
+                missing.append(email)
+            else:
+                result[email] = cached
+        if missing:
+            generation = self.client_cache.generation
+            with self.pool.connection() as conn, conn.cursor() as cur:
+                cur.execute(
+                    CLIENT_SELECT + " WHERE email IN (SELECT value FROM json_each(?));", (json.dumps(missing),)
+                )
+                found = {client.email: client for client in map(ClientRecord._make, cur)}
+            for email in missing:
+                client = found.get(email)
+                self.client_cache.set_if_unchanged(email, client, generation)
+                result[email] = client
+        return result
+
+    def get_client_version(self, email):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT id, row_version FROM clients WHERE email = ?;", (email,))
+            return cur.fetchone()
+
+    def get_change_versions(self):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT resource, version, changed_at FROM crm_change_counters;")
+            return {resource: (version, changed_at) for resource, version, changed_at in cur.fetchall()}
+
+    def claim_idempotency_key(self, key, route, request_hash, ttl, lease):
+        params = {"key": key, "route": route, "request_hash": request_hash, "ttl": ttl, "lease": lease}
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(CLAIM_IDEMPOTENCY_KEY_SQL, params)
+            claimed = cur.fetchone()
+            stored = None
+            if claimed is None:
+                cur.execute(
+                    f"""
+                    SELECT request_hash, status_code, response_body FROM idempotency_keys
+                    WHERE key = ? AND route = ? AND expires_at > {UTC_NOW};
+                    """,
+                    (key, route),
+                )
+                stored = cur.fetchone()
+            conn.commit()
+        if claimed is not None:
+            return None
+        return stored or (request_hash, None, None)
+
+    def complete_idempotency_key(self, key, route, status_code, response_body):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                "UPDATE idempotency_keys SET status_code = ?, response_body = ? WHERE key = ? AND route = ?;",
+                (status_code, response_body, key, route),
+            )
+            conn.commit()
+
+    def release_idempotency_key(self, key, route):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM idempotency_keys WHERE key = ? AND route = ? AND status_code IS NULL;", (key, route))
+            conn.commit()
+
+    def purge_idempotency_keys(self):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(f"DELETE FROM idempotency_keys WHERE expires_at <= {UTC_NOW};")
+            conn.commit()
+            return cur.rowcount
+
+    def get_all_clients(self):
+        return list(self.iter_clients())
+
+    def iter_clients(self, after_id=None, limit=None, batch_size=1000):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.arraysize = batch_size
+            # LIMIT -1 is SQLite's "no limit".
+            cur.execute(CLIENT_SELECT + " WHERE id > ? ORDER BY id LIMIT ?;", (after_id or 0, -1 if limit is None else limit))
+            while True:
+                rows = cur.fetchmany()
+                if not rows:
+                    return
+                yield from map(ClientRecord._make, rows)
+
+    def search_clients(self, q=None, limit=20, offset=0, insights=None):
+        """
+        Ranked client search with the semantics of `CRM.search_clients`:
+        full-text matches (all words, accents ignored) ranked by bm25, plus
+        names and emails with a pg_trgm similarity of at least 0.3.
+        """
+        conditions = []
+        params = []
+        for key, value in (insights or {}).items():
+            conditions.append("json_extract(c.ai_insights, ?) IS json_extract(?, '$')")
+            params += ["$." + json.dumps(key), json.dumps(value)]
+        if not q and not conditions:
+            return []
+
+        columns = ", ".join(f"c.{column}" for column in CLIENT_COLUMNS)
+        filters = "".join(f" AND {condition}" for condition in conditions)
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            if not q:
+                cur.execute(
+                    f"SELECT {columns} FROM clients c WHERE {' AND '.join(conditions)} ORDER BY c.id LIMIT ? OFFSET ?;",
+                    params + [limit, offset],
+                )
+                return [(ClientRecord._make(row), 0.0) for row in cur.fetchall()]
+
+            ranked = {}
+            words = _WORD.findall(q)
+            if words:
+                cur.execute(
+                    f"""
+                    SELECT {columns}, -bm25(clients_fts, 10.0, 10.0, 5.0, 1.0)
+                    FROM clients_fts JOIN clients c ON c.id = clients_fts.rowid
+                    WHERE clients_fts MATCH ?{filters}
+                    """,
+                    [" ".join(f'"{word}"' for word in words)] + params,
+                )
+                for row in cur.fetchall():
+                    ranked[row[0]] = [ClientRecord._make(row[:-1]), row[-1]]
+
+            if words:
+                # Scored on every row, padded word boundaries included, so a
+                # typo sharing no inner trigram ("Anna" for "Ana") still matches.
+                cur.execute(
+                    f"""
+                    SELECT {columns}, c.score
+                    FROM (
+                        SELECT c.*, max(similarity(c.first_name || ' ' || c.last_name, ?), similarity(c.email, ?)) AS score
+                        FROM clients c
+                        WHERE 1{filters}
+                    ) c
+                    WHERE c.score >= 0.3 OR c.id IN (SELECT value FROM json_each(?))
+                    """,
+                    [q, q] + params + [json.dumps(list(ranked))],
+                )
+                for row in cur.fetchall():
+                    score = row[-1] or 0.0
+                    if row[0] in ranked:
+                        ranked[row[0]][1] += score
+                    elif score >= 0.3:
+                        ranked[row[0]] = [ClientRecord._make(row[:-1]), score]
+
+        results = sorted(ranked.values(), key=lambda item: (-item[1], item[0].id))
+        return [(client, float(rank)) for client, rank in results[offset:offset + limit]]
+
+    def update_client(self, email, data):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            fields = [f"{key} = ?" for key in data]
+            values = [_json(value) for value in data.values()]
+            fields.append("last_contact = ?")
+            values.append(datetime.datetime.now())
+            values.append(email)
+
+            cur.execute(f"UPDATE clients SET {', '.join(fields)} WHERE email = ? RETURNING id;", values)
+            updated = cur.fetchone()
+            row = None
+            if updated:
+                # RETURNING runs before the row_version trigger, so read the row back.
+                cur.execute(CLIENT_SELECT + " WHERE id = ?;", updated)
+                row = cur.fetchone()
+            conn.commit()
+
+        client = ClientRecord._make(row) if row else None
+        # Dropped rather than refreshed: a concurrent update may have committed after this one.
+        self.client_cache.invalidate(email)
+        if client is not None and client.email != email:
+            self.client_cache.invalidate(client.email)
+        return client
+
+    def get_all_sales_funnel_entries(self):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(SALES_FUNNEL_ENTRIES_SQL + ";")
+            return [sales_funnel_entry_to_dict(row) for row in cur.fetchall()]
+
+    def get_sales_funnel_summary(self):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(SALES_FUNNEL_SUMMARY_SQL)
+            rows = cur.fetchall()
+        summary = []
+        for stage, count, cents, probability, age in rows:
+            total = decimal.Decimal(cents).scaleb(-2)
+            probability = decimal.Decimal(probability)
+            summary.append(summary_row_to_dict((stage, count, total, total * probability, probability, age)))
+        return summary
+
+    def get_stage_conversion_rates(self, start, end):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(STAGE_CONVERSION_SQL, {"start": start, "end": end})
+            return [conversion_row_to_dict(row) for row in cur.fetchall()]
+
+    def get_median_time_in_stage(self, start, end):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT stage FROM sales_funnel_stage_weights ORDER BY position;")
+            stints = {stage: [] for stage, in cur.fetchall()}
+            cur.execute(STAGE_STINTS_SQL, {"start": start, "end": end})
+            for stage, days in cur.fetchall():
+                stints.setdefault(stage, []).append(days)
+        return [
+            time_in_stage_row_to_dict((
+                stage, len(days),
+                statistics.median(days) if days else None,
+                statistics.fmean(days) if days else None,
+            ))
+            for stage, days in stints.items()
+        ]
+
+    def get_sales_funnel_entry(self, company_name):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(SALES_FUNNEL_ENTRIES_SQL + " WHERE c.company = ?;", (company_name,))
+            return cur.fetchone()
+
+    def add_sales_funnel_entry(self, data):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            if 'company' in data and 'client_id' not in data:
+                cur.execute("SELECT id FROM clients WHERE company = ? LIMIT 1", (data['company'],))
+                client_result = cur.fetchone()
+                if not client_result:
+                    raise ValueError(f"No client found with company: {data['company']}")
+                client_id = client_result[0]
+            else:
+                client_id = data['client_id']
+
+            cur.execute(
+                """
+                INSERT INTO sales_funnel (client_id, stage, status, notes, estimated_value, close_date)
+                VALUES (?, ?, ?, ?, ?, ?)
+                RETURNING id;
+                """,
+                (client_id, data['stage'], data['status'], data['notes'], data.get('estimated_value'), data.get('close_date'))
+            )
+            entry_id = cur.fetchone()[0]
+            conn.commit()
+        return entry_id
+
+    def update_sales_funnel_entry(self, client_id, data):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            fields = [f"{key} = ?" for key in data]
+            values = list(data.values())
+            fields.append("updated_at = ?")
+            values.append(datetime.datetime.now())
+            values.append(client_id)
+
+            cur.execute(f"UPDATE sales_funnel SET {', '.join(fields)} WHERE client_id = ?;", values)
+            conn.commit()
+
+    def delete_sales_funnel_entry(self, client_id):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM sales_funnel WHERE client_id = ?;", (client_id,))
+            conn.commit()
@@ -0,0 +1,191 @@
+import os
+import select
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+from .metrics import TimedCursor
+
+
+class PoolTimeout(Exception):
+    """No connection could be checked out of the pool within the timeout."""
+
+
+def connection_params_from_env():
+    return dict(
+        dbname=os.environ.get("POSTGRES_DB"),
+        user=os.environ.get("POSTGRES_USER"),
+        password=os.environ.get("POSTGRES_PASSWORD"),
+        host=os.environ.get("POSTGRES_HOST"),
+        port=os.environ.get("POSTGRES_PORT", "5432"),
+    )
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of psycopg2 connections.
+
+    `minconn` connections are opened up front and more are opened lazily up to
+    `maxconn`; `shrink()` closes idle ones beyond `minconn`. A borrower waits
+    at most `timeout` seconds for a free connection. Before a connection is
+    handed out, its socket is checked without a round trip: one the server
+    closed (restart, failover, pg_terminate_backend) has its FATAL message or
+    EOF waiting to be read. Connections that sat idle longer than
+    `check_interval` are also pinged, for peers that vanished silently. Dead
+    ones are transparently replaced; a connection lost while in use also
+    drops the idle ones, which most likely went down with it.
+    """
+
+    def __init__(self, minconn=1, maxconn=10, timeout=30.0, check_interval=30.0, **connect_kwargs):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError(f"Invalid pool size: minconn={minconn}, maxconn={maxconn}")
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.connect_kwargs = connect_kwargs or connection_params_from_env()
+
+        self._idle = []  # [(conn, last_used)]
+        self._in_use = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            minconn=int(os.environ.get("POSTGRES_POOL_MIN", "1")),
+            maxconn=int(os.environ.get("POSTGRES_POOL_MAX", "10")),
+            timeout=float(os.environ.get("POSTGRES_POOL_TIMEOUT", "30")),
+            # Cursors record query time and row counts in marta_core.metrics.
+            cursor_factory=TimedCursor,
+            **connection_params_from_env(),
+        )
+
+    def _connect(self):
+        return psycopg2.connect(**self.connect_kwargs)
+
+    def _is_alive(self, conn, last_used):
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        # An idle connection has nothing to read unless the server hung up.
+        if select.select([conn], [], [], 0)[0]:
+            return False
+        if time.monotonic() - last_used < self.check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise psycopg2.pool.PoolError("connection pool is closed")
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    self._in_use += 1
+                    break
+                if self._in_use < self.maxconn:
+                    conn, last_used = None, None
+                    self._in_use += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(f"Timed out after {timeout}s waiting for a database connection")
+                self._cond.wait(remaining)
+
+        # Network work happens outside the lock so other borrowers are not blocked.
+        try:
+            if conn is not None and not self._is_alive(conn, last_used):
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn, close=False):
+        if not conn.closed and not close:
+            status = conn.get_transaction_status()
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+
+        with self._cond:
+            self._in_use -= 1
+            keep = not (close or conn.closed or self._closed)
+            if keep:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+        if not keep:
+            self._discard(conn)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        conn = self.getconn(timeout)
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.putconn(conn, close=broken)
+            if broken and conn.closed:
+                self._discard_idle()
+
+    def _discard_idle(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def shrink(self):
+        """Close idle connections above `minconn`."""
+        with self._cond:
+            extra = self._idle[:max(0, len(self._idle) - self.minconn)]
+            del self._idle[:len(extra)]
+        for conn, _ in extra:
+            self._discard(conn)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            return {"idle": len(self._idle), "in_use": self._in_use, "max": self.maxconn}
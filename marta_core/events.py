@@ -0,0 +1,265 @@
+"""
+CRM change feed.
+
+Triggers (migration 9) send a NOTIFY on the `crm_changes` channel for every
+client or sales funnel row written, delivered when the transaction commits.
+`ChangeFeed` keeps one LISTEN connection per process on a daemon thread,
+numbers the notifications and fans them out to subscribers, which is what
+GET /events on crm_api and crm_asgi streams as Server-Sent Events.
+
+Events are JSON objects:
+
+    {"resource": "clients", "op": "update", "id": 42, "email": "...", "version": 3}
+    {"resource": "sales_funnel", "op": "insert", "id": 7, "client_id": 42, "version": 1}
+    {"resource": "clients", "op": "insert", "count": 5000}
+
+The last form stands for a statement that wrote more than 100 rows. A
+`{"resource": "*", "op": "resync"}` event means changes may have been missed
+(the listener reconnected, the subscriber fell behind, or the Last-Event-ID
+it resumed from is not known to this process); the consumer should refetch
+whatever it displays.
+
+Listeners added with `add_listener()` are called with every event on the
+listener thread; crm_api and crm_asgi use one to invalidate their client
+cache on writes from other workers, and start the feed when a worker boots.
+Otherwise the listener thread starts on the first `subscribe()`.
+"""
+import asyncio
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import uuid
+from collections import deque
+
+import psycopg2
+
+from .db import connection_params_from_env
+
+CHANNEL = "crm_changes"
+RESYNC = {"resource": "*", "op": "resync"}
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """Bounded queue of (event id, event) pairs, read with `get()`."""
+
+    def __init__(self, feed, maxsize=1000):
+        self.feed = feed
+        # Id of the last event before this subscription's first one; see ChangeFeed.event_id.
+        self.last_event_id = None
+        self._queue = queue.Queue(maxsize)
+
+    def _deliver(self, item):
+        # Runs on the listener thread and must not block it.
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            # The reader is maxsize events behind: replace the backlog with a resync.
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._queue.put_nowait((item[0], RESYNC))
+
+    def get(self, timeout=None):
+        """The next (event id, event), or None after `timeout` seconds without one."""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.feed.unsubscribe(self)
+
+
+class AsyncSubscription(Subscription):
+    """Subscription for asyncio code: `await get()` from the loop it was created on."""
+
+    def __init__(self, feed, maxsize=1000):
+        super().__init__(feed, maxsize)
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize)
+
+    def _deliver(self, item):
+        self._loop.call_soon_threadsafe(self._put, item)
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            self._queue.put_nowait((item[0], RESYNC))
+
+    async def get(self, timeout=None):
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class ChangeFeed:
+    def __init__(self, connect=None, history=1000, reconnect_delay=1.0, max_reconnect_delay=30.0):
+        self._connect = connect or (lambda: psycopg2.connect(**connection_params_from_env()))
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        # Event ids are "<boot id>-<sequence>"; the boot id tells a resuming
+        # client whether its Last-Event-ID came from this listener.
+        self.boot_id = uuid.uuid4().hex[:8]
+        self._seq = 0
+        self._history = deque(maxlen=history)  # (seq, event), for Last-Event-ID replay
+        self._subscribers = set()
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._listening = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def event_id(self, seq):
+        return f"{self.boot_id}-{seq}"
+
+    def start(self):
+        with self._lock:
+            # A thread inherited through fork() is not running in this process.
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._listening.clear()
+            self._thread = threading.Thread(target=self._run, name="crm-change-feed", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def wait_until_listening(self, timeout=5.0):
+        self.start()
+        return self._listening.wait(timeout)
+
+    def subscribe(self, last_event_id=None, subscription_class=Subscription, maxsize=1000, wait=5.0):
+        """
+        Starts the listener if needed and returns a new subscription. With
+        `last_event_id` (an SSE Last-Event-ID) it first receives the events
+        after that one, or a resync if they are no longer known.
+
+        Waits up to `wait` seconds for LISTEN to be in place, so a snapshot
+        the caller reads afterwards cannot miss a change.
+        """
+        self.wait_until_listening(wait)
+        subscription = subscription_class(self, maxsize)
+        with self._lock:
+            subscription.last_event_id = self.event_id(self._seq)
+            self._subscribers.add(subscription)
+            if last_event_id:
+                backlog = self._events_after(last_event_id)
+                if backlog is None:
+                    subscription._deliver((self.event_id(self._seq), RESYNC))
+                else:
+                    subscription.last_event_id = last_event_id
+                for seq, event in backlog or ():
+                    subscription._deliver((self.event_id(seq), event))
+        return subscription
+
+    def add_listener(self, callback):
+        """Calls `callback(event)` on the listener thread for every event, resyncs included; it must not block."""
+        with self._lock:
+            self._listeners.append(callback)
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def _events_after(self, last_event_id):
+        boot_id, _, seq = last_event_id.partition("-")
+        if boot_id != self.boot_id or not seq.isdigit():
+            return None
+        seq = int(seq)
+        oldest = self._history[0][0] if self._history else self._seq + 1
+        if seq > self._seq or seq < oldest - 1:
+            return None
+        return [item for item in self._history if item[0] > seq]
+
+    def publish(self, event):
+        with self._lock:
+            self._seq += 1
+            self._history.append((self._seq, event))
+            item = (self.event_id(self._seq), event)
+            subscribers = list(self._subscribers)
+            listeners = list(self._listeners)
+        for callback in listeners:
+            try:
+                callback(event)
+            except Exception:
+                logger.exception("CRM change feed listener %r failed", callback)
+        for subscription in subscribers:
+            subscription._deliver(item)
+
+    def _run(self):
+        delay = self.reconnect_delay
+        connected_before = False
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = self._connect()
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {CHANNEL};")
+                if connected_before:
+                    # Notifications sent while we were disconnected are lost.
+                    self.publish(RESYNC)
+                connected_before = True
+                delay = self.reconnect_delay
+                self._listening.set()
+                self._listen(conn)
+            except Exception:
+                logger.exception("CRM change feed listener failed; reconnecting in %.0fs", delay)
+                self._stop.wait(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+            finally:
+                self._listening.clear()
+                if conn is not None:
+                    conn.close()
+
+    def _listen(self, conn):
+        while not self._stop.is_set():
+            if select.select([conn], [], [], 5.0)[0]:
+                conn.poll()
+            else:
+                # Idle: a round trip notices a dropped connection.
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1;")
+            while conn.notifies:
+                payload = conn.notifies.pop(0).payload
+                try:
+                    self.publish(json.loads(payload))
+                except ValueError:
+                    logger.warning("Ignoring malformed %s payload: %r", CHANNEL, payload)
+
+
+def sse_event(event_id, event):
+    name = "resync" if event.get("op") == "resync" else "change"
+    return f"id: {event_id}\nevent: {name}\ndata: {json.dumps(event)}\n\n"
+
+
+def sse_message(name, data):
+    """An SSE message without an id, for streams that cannot be resumed."""
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+def sse_heartbeat(event_id):
+    # An id with no data dispatches nothing but moves the browser's
+    # Last-Event-ID forward, so a reconnect resumes from here.
+    return f": keep-alive\nid: {event_id}\n\n"
+
+
+def wants(event, resources):
+    return resources is None or event["resource"] == "*" or event["resource"] in resources
+
+
+change_feed = ChangeFeed()
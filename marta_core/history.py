@@ -0,0 +1,364 @@
+"""
+Conversation history for Marta's agent.
+
+`HistoryStore.get` is the `get_session_history` of the agent's
+RunnableWithMessageHistory. The store keeps at most `max_sessions`
+histories in memory, evicting the least recently used ones and those idle
+for longer than `idle_ttl` seconds. After every turn a history trims itself
+to the last `max_messages` messages and `max_tokens` estimated tokens,
+dropping whole turns from the front. Memory and prompt size therefore stay
+bounded however many sessions and turns are served.
+
+With a backend (`PostgresHistoryBackend`, migration 10, or
+`SQLiteHistoryBackend`) every message is also written to the database. A
+background thread batches the writes. A session that was evicted, or lost
+in a restart, is reloaded from the database on its next turn. Rows older
+than the retention period are purged.
+
+`history_store_from_env()` reads MARTA_HISTORY_BACKEND (memory, postgres or
+sqlite), MARTA_HISTORY_MAX_SESSIONS, MARTA_HISTORY_IDLE_TTL,
+MARTA_HISTORY_MAX_MESSAGES, MARTA_HISTORY_MAX_TOKENS,
+MARTA_HISTORY_SQLITE_PATH and MARTA_HISTORY_RETENTION_DAYS.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import HumanMessage, message_to_dict, messages_from_dict
+
+from .cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+LOAD_MESSAGES_SQL = """
+    SELECT message FROM (
+        SELECT id, message FROM chat_messages
+        WHERE session_id = %s
+        ORDER BY id DESC
+        LIMIT %s
+    ) recent
+    ORDER BY id;
+"""
+
+APPEND_MESSAGES_SQL = """
+    INSERT INTO chat_messages (session_id, message)
+    SELECT session_id, message::jsonb
+    FROM unnest(%s::text[], %s::text[]) WITH ORDINALITY AS batch(session_id, message, n)
+    ORDER BY n;
+"""
+
+DELETE_SESSION_SQL = "DELETE FROM chat_messages WHERE session_id = %s;"
+
+PURGE_MESSAGES_SQL = "DELETE FROM chat_messages WHERE created_at < now() - %s * interval '1 second';"
+
+SQLITE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS chat_messages (
+        id INTEGER PRIMARY KEY,
+        session_id TEXT NOT NULL,
+        message TEXT NOT NULL,
+        created_at REAL NOT NULL DEFAULT (julianday('now'))
+    );
+    CREATE INDEX IF NOT EXISTS chat_messages_session_id_idx ON chat_messages (session_id, id);
+    CREATE INDEX IF NOT EXISTS chat_messages_created_at_idx ON chat_messages (created_at);
+"""
+
+
+def estimate_tokens(message):
+    """Rough token count (4 characters per token) that needs no tokenizer or API call."""
+    content = message.content if isinstance(message.content, str) else json.dumps(message.content)
+    return len(content) // 4 + 4
+
+
+class BoundedChatMessageHistory(BaseChatMessageHistory):
+    """
+    Chat history that keeps at most `max_messages` messages and `max_tokens`
+    tokens (per `token_counter`). None disables a limit. The oldest turns
+    are dropped first, and the history always starts with a human message.
+    With a `writer`, added messages are also persisted through it.
+    """
+
+    def __init__(self, session_id, messages=(), max_messages=20, max_tokens=4000, token_counter=estimate_tokens, writer=None):
+        self.session_id = session_id
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self.token_counter = token_counter
+        self.writer = writer
+        self._messages = []
+        self._tokens = []
+        self.tokens = 0
+        self._lock = threading.Lock()
+        self._append(messages)
+
+    @property
+    def messages(self):
+        with self._lock:
+            return list(self._messages)
+
+    def add_messages(self, messages):
+        messages = list(messages)
+        with self._lock:
+            self._append(messages)
+        if self.writer is not None:
+            self.writer.append(self.session_id, messages)
+
+    def clear(self):
+        with self._lock:
+            self._messages, self._tokens, self.tokens = [], [], 0
+        if self.writer is not None:
+            self.writer.delete(self.session_id)
+
+    def _append(self, messages):
+        for message in messages:
+            tokens = self.token_counter(message)
+            self._messages.append(message)
+            self._tokens.append(tokens)
+            self.tokens += tokens
+        self._trim()
+
+    def _over_limit(self, count, tokens):
+        return (
+            (self.max_messages is not None and count > self.max_messages)
+            or (self.max_tokens is not None and tokens > self.max_tokens)
+        )
+
+    def _trim(self):
+        drop, tokens = 0, self.tokens
+        while drop < len(self._messages) and self._over_limit(len(self._messages) - drop, tokens):
+            tokens -= self._tokens[drop]
+            drop += 1
+        # Cut at a turn boundary: Gemini expects the conversation to open with the user.
+        while drop < len(self._messages) and not isinstance(self._messages[drop], HumanMessage):
+            tokens -= self._tokens[drop]
+            drop += 1
+        if drop:
+            del self._messages[:drop]
+            del self._tokens[:drop]
+            self.tokens = tokens
+
+
+class BatchWriter:
+    """
+    Buffers (session id, message) rows and hands them to `backend.append_many`
+    from a daemon thread, every `flush_interval` seconds or as soon as
+    `batch_size` rows are waiting. Rows a failed flush could not write are
+    retried with the next batch, up to `max_pending` rows; the oldest rows
+    beyond that are dropped. With `retention` (seconds), older rows are purged
+    about once an hour.
+    """
+
+    def __init__(self, backend, batch_size=50, flush_interval=1.0, max_pending=10000, retention=None, purge_interval=3600.0):
+        self.backend = backend
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.retention = retention
+        self.purge_interval = purge_interval
+        self.dropped = 0
+        self._pending = []
+        self._cond = threading.Condition()
+        # Flushes run one at a time so a session's rows are written in order.
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._next_purge = 0.0
+        atexit.register(self.flush)
+
+    def start(self):
+        with self._cond:
+            # A thread inherited through fork() is not running in this process.
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="chat-history-writer", daemon=True)
+            self._thread.start()
+
+    def append(self, session_id, messages):
+        rows = [(session_id, json.dumps(message_to_dict(message))) for message in messages]
+        with self._cond:
+            self._pending.extend(rows)
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+        self.start()
+
+    def delete(self, session_id):
+        self.flush()
+        self.backend.delete(session_id)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._cond:
+                rows, self._pending = self._pending, []
+            if not rows:
+                return
+            try:
+                self.backend.append_many(rows)
+            except Exception:
+                logger.exception("Could not write %d chat messages; retrying with the next batch", len(rows))
+                with self._cond:
+                    self._pending[:0] = rows
+                    overflow = len(self._pending) - self.max_pending
+                    if overflow > 0:
+                        del self._pending[:overflow]
+                        self.dropped += overflow
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._pending) >= self.batch_size, self.flush_interval)
+            self.flush()
+            if self.retention and time.monotonic() >= self._next_purge:
+                self._next_purge = time.monotonic() + self.purge_interval
+                try:
+                    self.backend.purge(self.retention)
+                except Exception:
+                    logger.exception("Could not purge old chat messages")
+
+    def stats(self):
+        with self._cond:
+            return {"pending": len(self._pending), "dropped": self.dropped}
+
+
+class PostgresHistoryBackend:
+    def __init__(self, pool=None):
+        if pool is None:
+            from .db import ConnectionPool, connection_params_from_env
+            from .metrics import TimedCursor
+
+            pool = ConnectionPool(minconn=0, maxconn=2, cursor_factory=TimedCursor, **connection_params_from_env())
+        self.pool = pool
+
+    def load(self, session_id, limit):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(LOAD_MESSAGES_SQL, (session_id, limit))
+            return [row[0] for row in cur.fetchall()]
+
+    def append_many(self, rows):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(APPEND_MESSAGES_SQL, ([row[0] for row in rows], [row[1] for row in rows]))
+            conn.commit()
+
+    def delete(self, session_id):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(DELETE_SESSION_SQL, (session_id,))
+            conn.commit()
+
+    def purge(self, max_age):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(PURGE_MESSAGES_SQL, (max_age,))
+            conn.commit()
+
+
+class SQLiteHistoryBackend:
+    def __init__(self, path=None, pool=None):
+        from .crm_sqlite import DEFAULT_PATH, SQLitePool
+
+        self.pool = pool or SQLitePool(path or DEFAULT_PATH, maxconn=2)
+        with self.pool.connection() as conn:
+            conn.executescript(SQLITE_SCHEMA)
+
+    def load(self, session_id, limit):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT message FROM (
+                    SELECT id, message FROM chat_messages WHERE session_id = ? ORDER BY id DESC LIMIT ?
+                ) ORDER BY id;
+                """,
+                (session_id, limit),
+            )
+            return [json.loads(row[0]) for row in cur.fetchall()]
+
+    def append_many(self, rows):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.executemany("INSERT INTO chat_messages (session_id, message) VALUES (?, ?);", rows)
+            conn.commit()
+
+    def delete(self, session_id):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM chat_messages WHERE session_id = ?;", (session_id,))
+            conn.commit()
+
+    def purge(self, max_age):
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM chat_messages WHERE created_at < julianday('now') - ? / 86400.0;", (max_age,))
+            conn.commit()
+
+
+class HistoryStore:
+    def __init__(self, max_sessions=1000, idle_ttl=3600.0, max_messages=20, max_tokens=4000,
+                 token_counter=estimate_tokens, backend=None, writer=None):
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self.token_counter = token_counter
+        self.backend = backend
+        self.writer = writer or (BatchWriter(backend) if backend is not None else None)
+        self._sessions = LRUCache(maxsize=max_sessions, ttl=idle_ttl)
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            history = self._sessions.get(session_id)
+            if history is not None:
+                # Set again on every turn, so the TTL counts from the last use.
+                self._sessions.set(session_id, history)
+                return history
+
+        # Loading waits on the writer and the database; other sessions must not.
+        loaded = BoundedChatMessageHistory(
+            session_id, self._load(session_id),
+            max_messages=self.max_messages, max_tokens=self.max_tokens,
+            token_counter=self.token_counter, writer=self.writer,
+        )
+        with self._lock:
+            # Two first requests for a session may both load it; the first copy stored wins.
+            history = self._sessions.get(session_id)
+            if history is None:
+                history = loaded
+            self._sessions.set(session_id, history)
+        return history
+
+    def _load(self, session_id):
+        if self.backend is None:
+            return []
+        # The session's latest messages may still be waiting in the writer.
+        self.writer.flush()
+        try:
+            return messages_from_dict(self.backend.load(session_id, self.max_messages or 1000))
+        except Exception:
+            logger.exception("Could not load the chat history of session %r; starting empty", session_id)
+            return []
+
+    def stats(self):
+        stats = self._sessions.stats()
+        if self.writer is not None:
+            stats["writer"] = self.writer.stats()
+        return stats
+
+
+def _optional_int(value):
+    return int(value) if value else None
+
+
+def history_store_from_env():
+    backend_name = os.environ.get("MARTA_HISTORY_BACKEND", "memory")
+    retention = float(os.environ.get("MARTA_HISTORY_RETENTION_DAYS", "30")) * 86400
+    if backend_name == "postgres":
+        backend = PostgresHistoryBackend()
+    elif backend_name == "sqlite":
+        backend = SQLiteHistoryBackend(os.environ.get("MARTA_HISTORY_SQLITE_PATH"))
+    elif backend_name == "memory":
+        backend = None
+    else:
+        raise ValueError(f"MARTA_HISTORY_BACKEND must be 'memory', 'postgres' or 'sqlite', got {backend_name!r}")
+    return HistoryStore(
+        max_sessions=int(os.environ.get("MARTA_HISTORY_MAX_SESSIONS", "1000")),
+        idle_ttl=float(os.environ.get("MARTA_HISTORY_IDLE_TTL", "3600")),
+        max_messages=_optional_int(os.environ.get("MARTA_HISTORY_MAX_MESSAGES", "20")),
+        max_tokens=_optional_int(os.environ.get("MARTA_HISTORY_MAX_TOKENS", "4000")),
+        backend=backend,
+        writer=BatchWriter(backend, retention=retention) if backend is not None else None,
+    )
@@ -0,0 +1,227 @@
+"""
+Prometheus instrumentation shared by the Flask apps.
+
+- `init_app(app, name)` times every request per route and serves `/metrics`
+  in the Prometheus text format.
+- `TimedCursor` (a psycopg2 cursor factory, used by `db.ConnectionPool`) and
+  `instrument_connection` (a proxy for any DB-API connection) record SQL
+  execution time and row counts per statement type.
+- `llm_timer` and `generate_content` record LLM latency and token counts;
+  the LLM_ADMISSION_* series are fed by `marta_core.admission` and the
+  ANSWER_CACHE_* ones by `marta_core.answer_cache`.
+
+Under the pre-fork server set PROMETHEUS_MULTIPROC_DIR so `/metrics`
+aggregates every worker; `marta_core.serve` prepares the directory.
+"""
+import os
+import re
+import time
+from contextlib import contextmanager
+
+import psycopg2.extensions
+from flask import Response, g, request
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Request latency by route.",
+    ["app", "method", "route", "status"],
+)
+DB_QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds", "SQL execution time by statement type.",
+    ["operation"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+DB_ROWS = Counter("db_rows_total", "Rows returned or affected by statement type.", ["operation"])
+LLM_REQUEST_SECONDS = Histogram(
+    "llm_request_duration_seconds", "LLM call latency.",
+    ["source", "model", "outcome"],
+    buckets=(0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0, 120.0),
+)
+LLM_TOKENS = Counter("llm_tokens_total", "LLM tokens by direction.", ["source", "model", "kind"])
+LLM_ADMISSION_IN_FLIGHT = Gauge(
+    "llm_admission_in_flight", "LLM calls holding an admission slot.", ["controller"], multiprocess_mode="livesum",
+)
+LLM_ADMISSION_QUEUE_DEPTH = Gauge(
+    "llm_admission_queue_depth", "Callers waiting for an LLM admission slot.", ["controller"], multiprocess_mode="livesum",
+)
+LLM_ADMISSION_WAIT_SECONDS = Histogram(
+    "llm_admission_wait_seconds", "Time spent queued for an LLM admission slot.",
+    ["controller"],
+    buckets=(0.0, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+LLM_ADMISSION_REJECTED = Counter(
+    "llm_admission_rejected_total", "LLM calls turned away by admission control.", ["controller", "reason"],
+)
+ANSWER_CACHE_LOOKUPS = Counter(
+    "marta_answer_cache_lookups_total", "Semantic answer cache lookups by result (hit_exact, hit_semantic, miss).", ["result"],
+)
+ANSWER_CACHE_SIMILARITY = Histogram(
+    "marta_answer_cache_best_similarity", "Best cosine similarity found per semantic cache lookup.",
+    buckets=(0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.92, 0.94, 0.96, 0.98, 1.0),
+)
+
+_OPERATIONS = {"SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "COPY", "CREATE", "ALTER", "DROP", "TRUNCATE", "ANALYZE"}
+_LEADING_COMMENTS = re.compile(r"^(\s+|--[^\n]*\n|/\*.*?\*/)+", re.S)
+
+
+def sql_operation(query):
+    if isinstance(query, bytes):
+        query = query.decode(errors="replace")
+    elif not isinstance(query, str):
+        # psycopg2.sql.Composed and the like
+        query = str(query)
+    word = _LEADING_COMMENTS.sub("", query[:200]).split(None, 1)
+    operation = word[0].upper() if word else ""
+    return operation if operation in _OPERATIONS else "OTHER"
+
+
+def observe_query(query, seconds, rowcount):
+    operation = sql_operation(query)
+    DB_QUERY_SECONDS.labels(operation).observe(seconds)
+    if rowcount is not None and rowcount > 0:
+        DB_ROWS.labels(operation).inc(rowcount)
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            observe_query(query, time.perf_counter() - start, self.rowcount)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            observe_query(query, time.perf_counter() - start, self.rowcount)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            observe_query(sql, time.perf_counter() - start, self.rowcount)
+
+
+class _InstrumentedCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, query, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._cursor.execute(query, *args, **kwargs)
+        finally:
+            observe_query(query, time.perf_counter() - start, getattr(self._cursor, "rowcount", None))
+
+    def executemany(self, query, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._cursor.executemany(query, *args, **kwargs)
+        finally:
+            observe_query(query, time.perf_counter() - start, getattr(self._cursor, "rowcount", None))
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._cursor.close()
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _InstrumentedConnection:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self, *args, **kwargs):
+        return _InstrumentedCursor(self._conn.cursor(*args, **kwargs))
+
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._conn.__exit__(*exc)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def instrument_connection(conn):
+    """Wraps a DB-API connection (pg8000, psycopg2, ...) so its cursors record query metrics."""
+    return _InstrumentedConnection(conn)
+
+
+class _LLMCall:
+    def __init__(self):
+        self.prompt_tokens = None
+        self.completion_tokens = None
+
+    def tokens(self, prompt_tokens, completion_tokens):
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+
+
+@contextmanager
+def llm_timer(source, model):
+    """Times the LLM call in the block; report usage through the yielded object's `tokens()`."""
+    call = _LLMCall()
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield call
+        outcome = "ok"
+    finally:
+        LLM_REQUEST_SECONDS.labels(source, model, outcome).observe(time.perf_counter() - start)
+        if call.prompt_tokens:
+            LLM_TOKENS.labels(source, model, "prompt").inc(call.prompt_tokens)
+        if call.completion_tokens:
+            LLM_TOKENS.labels(source, model, "completion").inc(call.completion_tokens)
+
+
+def generate_content(model, prompt, source, model_name, **kwargs):
+    """`model.generate_content(prompt)` for a Vertex AI GenerativeModel, timed and token-counted."""
+    with llm_timer(source, model_name) as call:
+        response = model.generate_content(prompt, **kwargs)
+        usage = getattr(response, "usage_metadata", None)
+        if usage is not None:
+            call.tokens(usage.prompt_token_count, usage.candidates_token_count)
+    return response
+
+
+def render_metrics():
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest()
+
+
+def init_app(app, name):
+    @app.before_request
+    def _start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def _observe_request(response):
+        start = g.pop("metrics_start", None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            HTTP_REQUEST_SECONDS.labels(name, request.method, route, str(response.status_code)).observe(
+                time.perf_counter() - start
+            )
+        return response
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return Response(render_metrics(), mimetype=CONTENT_TYPE_LATEST)
+
+    return app
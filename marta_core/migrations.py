@@ -0,0 +1,460 @@
+"""
+Versioned schema migrations for the CRM database.
+
+Run once per deployment, out of band from the web workers:
+
+    python -m marta_core.migrations            # apply pending migrations
+    python -m marta_core.migrations status     # list applied / pending
+
+Each migration runs in its own transaction together with the row recording
+it in `schema_migrations`. Migrations marked `transactional=False` (needed
+for CREATE INDEX CONCURRENTLY) run statement by statement in autocommit
+mode and must therefore be idempotent. A concurrent index build that fails
+leaves an INVALID index behind, which IF NOT EXISTS would then skip; such an
+index is dropped and rebuilt, and the migration is only recorded once every
+index it builds is valid.
+"""
+import re
+import sys
+from collections import namedtuple
+
+import psycopg2
+from dotenv import load_dotenv
+
+from .db import connection_params_from_env
+
+Migration = namedtuple("Migration", "version name statements transactional", defaults=(True,))
+
+# Arbitrary key for pg_advisory_lock so concurrent runners apply migrations one at a time.
+MIGRATION_LOCK_ID = 7_202_501
+
+_CONCURRENT_INDEX = re.compile(r"\s*CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)", re.IGNORECASE)
+
+# NULL when the index does not exist.
+INDEX_IS_VALID_SQL = "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s);"
+
+MIGRATIONS = [
+    Migration(1, "create clients and sales_funnel", [
+        """
+        CREATE TABLE IF NOT EXISTS clients (
+            id SERIAL PRIMARY KEY,
+            first_name VARCHAR(255) NOT NULL,
+            last_name VARCHAR(255) NOT NULL,
+            position VARCHAR(255),
+            email VARCHAR(255) UNIQUE NOT NULL,
+            phone_number VARCHAR(50),
+            company VARCHAR(255),
+            notes TEXT,
+            last_contact TIMESTAMP,
+            last_contact_source VARCHAR(50),
+            ai_insights JSONB
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS sales_funnel (
+            id SERIAL PRIMARY KEY,
+            client_id INTEGER NOT NULL REFERENCES clients(id) ON DELETE CASCADE,
+            stage VARCHAR(255) NOT NULL CHECK (stage IN ('Lead', 'Contacted', 'Proposal', 'Negotiation', 'Won', 'Lost')),
+            status VARCHAR(255) NOT NULL,
+            notes TEXT,
+            estimated_value NUMERIC(10, 2),
+            close_date DATE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        # A client may have several funnel entries.
+        "ALTER TABLE sales_funnel DROP CONSTRAINT IF EXISTS sales_funnel_client_id_key;",
+    ]),
+    Migration(2, "index clients.company and sales_funnel lookups", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS clients_company_idx ON clients (company);",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS sales_funnel_client_id_idx ON sales_funnel (client_id);",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS sales_funnel_stage_idx ON sales_funnel (stage);",
+    ], transactional=False),
+    Migration(3, "trigger-maintained sales_funnel_summary", [
+        """
+        CREATE TABLE sales_funnel_stage_weights (
+            stage VARCHAR(255) PRIMARY KEY,
+            position SMALLINT NOT NULL,
+            probability NUMERIC(4, 3) NOT NULL CHECK (probability BETWEEN 0 AND 1)
+        );
+        """,
+        """
+        INSERT INTO sales_funnel_stage_weights (stage, position, probability) VALUES
+            ('Lead', 1, 0.10), ('Contacted', 2, 0.20), ('Proposal', 3, 0.50),
+            ('Negotiation', 4, 0.75), ('Won', 5, 1.00), ('Lost', 6, 0.00);
+        """,
+        # Running totals per stage. Average age is derived from the sum of
+        # created_at epochs so it never needs a scan of sales_funnel.
+        """
+        CREATE TABLE sales_funnel_summary (
+            stage VARCHAR(255) PRIMARY KEY,
+            entry_count BIGINT NOT NULL DEFAULT 0,
+            total_value NUMERIC NOT NULL DEFAULT 0,
+            aged_count BIGINT NOT NULL DEFAULT 0,
+            created_epoch_sum NUMERIC NOT NULL DEFAULT 0
+        );
+        """,
+        """
+        CREATE FUNCTION sales_funnel_summary_apply(p_stage VARCHAR, p_sign INTEGER, p_value NUMERIC, p_created_at TIMESTAMP)
+        RETURNS void LANGUAGE plpgsql AS $$
+        BEGIN
+            INSERT INTO sales_funnel_summary AS s (stage, entry_count, total_value, aged_count, created_epoch_sum)
+            VALUES (
+                p_stage, p_sign, p_sign * COALESCE(p_value, 0),
+                CASE WHEN p_created_at IS NULL THEN 0 ELSE p_sign END,
+                p_sign * COALESCE(extract(epoch FROM p_created_at), 0)
+            )
+            ON CONFLICT (stage) DO UPDATE SET
+                entry_count = s.entry_count + EXCLUDED.entry_count,
+                total_value = s.total_value + EXCLUDED.total_value,
+                aged_count = s.aged_count + EXCLUDED.aged_count,
+                created_epoch_sum = s.created_epoch_sum + EXCLUDED.created_epoch_sum;
+        END;
+        $$;
+        """,
+        """
+        CREATE FUNCTION sales_funnel_summary_trigger() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'UPDATE'
+               AND NEW.stage IS NOT DISTINCT FROM OLD.stage
+               AND NEW.estimated_value IS NOT DISTINCT FROM OLD.estimated_value
+               AND NEW.created_at IS NOT DISTINCT FROM OLD.created_at THEN
+                RETURN NULL;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                PERFORM sales_funnel_summary_apply(OLD.stage, -1, OLD.estimated_value, OLD.created_at);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM sales_funnel_summary_apply(NEW.stage, 1, NEW.estimated_value, NEW.created_at);
+            END IF;
+            RETURN NULL;
+        END;
+        $$;
+        """,
+        # Block writers while the trigger is installed and the totals backfilled.
+        "LOCK TABLE sales_funnel IN SHARE ROW EXCLUSIVE MODE;",
+        """
+        CREATE TRIGGER sales_funnel_summary_maintain
+        AFTER INSERT OR UPDATE OR DELETE ON sales_funnel
+        FOR EACH ROW EXECUTE FUNCTION sales_funnel_summary_trigger();
+        """,
+        """
+        INSERT INTO sales_funnel_summary (stage, entry_count, total_value, aged_count, created_epoch_sum)
+        SELECT stage, count(*), COALESCE(sum(estimated_value), 0), count(created_at),
+               COALESCE(sum(extract(epoch FROM created_at)), 0)
+        FROM sales_funnel
+        GROUP BY stage;
+        """,
+    ]),
+    Migration(4, "append-only sales_funnel_history", [
+        # entry_id has no foreign key so history survives deleted entries.
+        """
+        CREATE TABLE sales_funnel_history (
+            id BIGSERIAL PRIMARY KEY,
+            entry_id INTEGER NOT NULL,
+            client_id INTEGER NOT NULL,
+            from_stage VARCHAR(255),
+            to_stage VARCHAR(255) NOT NULL,
+            changed_at TIMESTAMP NOT NULL DEFAULT LOCALTIMESTAMP
+        );
+        """,
+        """
+        CREATE FUNCTION sales_funnel_history_trigger() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO sales_funnel_history (entry_id, client_id, from_stage, to_stage)
+                VALUES (NEW.id, NEW.client_id, NULL, NEW.stage);
+            ELSIF NEW.stage IS DISTINCT FROM OLD.stage THEN
+                INSERT INTO sales_funnel_history (entry_id, client_id, from_stage, to_stage)
+                VALUES (NEW.id, NEW.client_id, OLD.stage, NEW.stage);
+            END IF;
+            RETURN NULL;
+        END;
+        $$;
+        """,
+        "LOCK TABLE sales_funnel IN SHARE ROW EXCLUSIVE MODE;",
+        """
+        CREATE TRIGGER sales_funnel_history_record
+        AFTER INSERT OR UPDATE OF stage ON sales_funnel
+        FOR EACH ROW EXECUTE FUNCTION sales_funnel_history_trigger();
+        """,
+        # Seed the current stage of existing entries, oldest first so the
+        # physical order follows changed_at and the BRIN index stays tight.
+        """
+        INSERT INTO sales_funnel_history (entry_id, client_id, from_stage, to_stage, changed_at)
+        SELECT id, client_id, NULL, stage, COALESCE(created_at, LOCALTIMESTAMP)
+        FROM sales_funnel
+        ORDER BY COALESCE(created_at, LOCALTIMESTAMP);
+        """,
+        "CREATE INDEX sales_funnel_history_changed_at_brin ON sales_funnel_history USING brin (changed_at);",
+        "CREATE INDEX sales_funnel_history_entry_idx ON sales_funnel_history (entry_id, changed_at);",
+    ]),
+    Migration(5, "clients full-text search vector", [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm;",
+        # Names and company are indexed without stemming; notes are mostly Spanish.
+        """
+        ALTER TABLE clients ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('simple', coalesce(first_name, '') || ' ' || coalesce(last_name, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(company, '')), 'B') ||
+            setweight(to_tsvector('spanish', coalesce(notes, '')), 'C')
+        ) STORED;
+        """,
+    ]),
+    Migration(6, "clients search indexes", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS clients_search_vector_idx ON clients USING gin (search_vector);",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS clients_name_trgm_idx ON clients USING gin ((first_name || ' ' || last_name) gin_trgm_ops);",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS clients_email_trgm_idx ON clients USING gin (email gin_trgm_ops);",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS clients_ai_insights_idx ON clients USING gin (ai_insights jsonb_path_ops);",
+    ], transactional=False),
+    Migration(7, "row versions and change counters for conditional GET", [
+        "ALTER TABLE clients ADD COLUMN updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP;",
+        "ALTER TABLE clients ADD COLUMN row_version BIGINT NOT NULL DEFAULT 1;",
+        "ALTER TABLE sales_funnel ADD COLUMN row_version BIGINT NOT NULL DEFAULT 1;",
+        """
+        CREATE FUNCTION bump_row_version() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            NEW.row_version := OLD.row_version + 1;
+            NEW.updated_at := CURRENT_TIMESTAMP;
+            RETURN NEW;
+        END;
+        $$;
+        """,
+        """
+        CREATE TRIGGER clients_bump_row_version BEFORE UPDATE ON clients
+        FOR EACH ROW EXECUTE FUNCTION bump_row_version();
+        """,
+        """
+        CREATE TRIGGER sales_funnel_bump_row_version BEFORE UPDATE ON sales_funnel
+        FOR EACH ROW EXECUTE FUNCTION bump_row_version();
+        """,
+        # One row per table, bumped once per writing statement. Being a regular
+        # row it becomes visible together with the data that changed it.
+        """
+        CREATE TABLE crm_change_counters (
+            resource VARCHAR(64) PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 1,
+            changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        """,
+        "INSERT INTO crm_change_counters (resource) VALUES ('clients'), ('sales_funnel');",
+        """
+        CREATE FUNCTION bump_change_counter() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            UPDATE crm_change_counters
+            SET version = version + 1, changed_at = now()
+            WHERE resource = TG_TABLE_NAME;
+            RETURN NULL;
+        END;
+        $$;
+        """,
+        """
+        CREATE TRIGGER clients_bump_change_counter
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON clients
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_change_counter();
+        """,
+        """
+        CREATE TRIGGER sales_funnel_bump_change_counter
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON sales_funnel
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_change_counter();
+        """,
+    ]),
+    Migration(8, "idempotency keys for write endpoints", [
+        # status_code stays NULL while the first request is still executing.
+        """
+        CREATE TABLE idempotency_keys (
+            key VARCHAR(255) NOT NULL,
+            route VARCHAR(255) NOT NULL,
+            request_hash CHAR(64) NOT NULL,
+            status_code INTEGER,
+            response_body TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            expires_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (key, route)
+        );
+        """,
+        "CREATE INDEX idempotency_keys_expires_at_idx ON idempotency_keys (expires_at);",
+    ]),
+    # One NOTIFY per written row, sent on commit, for marta_core.events. A
+    # statement writing more than 100 rows sends a single summary instead
+    # (payloads are capped at 8000 bytes and the queue is shared). Transition
+    # tables allow only one event per trigger, hence three per table.
+    Migration(9, "crm_changes notifications", [
+        """
+        CREATE FUNCTION notify_crm_change() RETURNS trigger LANGUAGE plpgsql AS $$
+        DECLARE
+            changed integer;
+            r record;
+        BEGIN
+            SELECT count(*) INTO changed FROM changed_rows;
+            IF changed > 100 THEN
+                PERFORM pg_notify('crm_changes', json_build_object(
+                    'resource', TG_TABLE_NAME, 'op', lower(TG_OP), 'count', changed)::text);
+                RETURN NULL;
+            END IF;
+            FOR r IN SELECT to_jsonb(c) AS row FROM changed_rows c ORDER BY c.id LOOP
+                PERFORM pg_notify('crm_changes', jsonb_strip_nulls(jsonb_build_object(
+                    'resource', TG_TABLE_NAME, 'op', lower(TG_OP), 'id', r.row->'id',
+                    'email', r.row->'email', 'client_id', r.row->'client_id',
+                    'version', r.row->'row_version'))::text);
+            END LOOP;
+            RETURN NULL;
+        END;
+        $$;
+        """,
+        """
+        CREATE TRIGGER clients_notify_insert AFTER INSERT ON clients
+        REFERENCING NEW TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_crm_change();
+        """,
+        """
+        CREATE TRIGGER clients_notify_update AFTER UPDATE ON clients
+        REFERENCING NEW TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_crm_change();
+        """,
+        """
+        CREATE TRIGGER clients_notify_delete AFTER DELETE ON clients
+        REFERENCING OLD TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_crm_change();
+        """,
+        """
+        CREATE TRIGGER sales_funnel_notify_insert AFTER INSERT ON sales_funnel
+        REFERENCING NEW TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_crm_change();
+        """,
+        """
+        CREATE TRIGGER sales_funnel_notify_update AFTER UPDATE ON sales_funnel
+        REFERENCING NEW TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_crm_change();
+        """,
+        """
+        CREATE TRIGGER sales_funnel_notify_delete AFTER DELETE ON sales_funnel
+        REFERENCING OLD TABLE AS changed_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_crm_change();
+        """,
+    ]),
+    # Marta's conversation history (marta_core.history).
+    Migration(10, "chat_messages", [
+        """
+        CREATE TABLE chat_messages (
+            id BIGSERIAL PRIMARY KEY,
+            session_id VARCHAR(255) NOT NULL,
+            message JSONB NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        """,
+        "CREATE INDEX chat_messages_session_id_idx ON chat_messages (session_id, id);",
+        "CREATE INDEX chat_messages_created_at_idx ON chat_messages (created_at);",
+    ]),
+]
+
+
+def _ensure_version_table(conn):
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+
+
+def applied_versions(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT version FROM schema_migrations;")
+        return {row[0] for row in cur.fetchall()}
+
+
+def _apply(conn, migration):
+    record = ("INSERT INTO schema_migrations (version, name) VALUES (%s, %s);", (migration.version, migration.name))
+    if migration.transactional:
+        conn.autocommit = False
+        try:
+            with conn.cursor() as cur:
+                for statement in migration.statements:
+                    cur.execute(statement)
+                cur.execute(*record)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.autocommit = True
+    else:
+        with conn.cursor() as cur:
+            for statement in migration.statements:
+                index = _CONCURRENT_INDEX.match(statement)
+                if index and _index_is_valid(cur, index.group(1)) is False:
+                    # Left INVALID by an earlier run that failed half way.
+                    cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index.group(1)};")
+                cur.execute(statement)
+                if index and not _index_is_valid(cur, index.group(1)):
+                    raise RuntimeError(f"Index {index.group(1)} is not valid after building it")
+            cur.execute(*record)
+
+
+def _index_is_valid(cur, name):
+    """True or False for an existing index, None if there is none by that name."""
+    cur.execute(INDEX_IS_VALID_SQL, (name,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def migrate(conn=None, target=None, log=print):
+    """Applies pending migrations up to `target` (default: all). Returns the versions applied."""
+    own_conn = conn is None
+    if own_conn:
+        conn = psycopg2.connect(**connection_params_from_env())
+    conn.autocommit = True
+    applied = []
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s);", (MIGRATION_LOCK_ID,))
+        try:
+            _ensure_version_table(conn)
+            done = applied_versions(conn)
+            for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+                if migration.version in done or (target is not None and migration.version > target):
+                    continue
+                log(f"Applying migration {migration.version}: {migration.name}")
+                _apply(conn, migration)
+                applied.append(migration.version)
+        finally:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock(%s);", (MIGRATION_LOCK_ID,))
+    finally:
+        if own_conn:
+            conn.close()
+    return applied
+
+
+def status(conn):
+    conn.autocommit = True
+    _ensure_version_table(conn)
+    done = applied_versions(conn)
+    return [(m.version, m.name, m.version in done) for m in sorted(MIGRATIONS, key=lambda m: m.version)]
+
+
+def main(argv=None):
+    load_dotenv()
+    argv = sys.argv[1:] if argv is None else argv
+    command = argv[0] if argv else "upgrade"
+    if command == "upgrade":
+        applied = migrate(target=int(argv[1]) if len(argv) > 1 else None)
+        print(f"Applied {len(applied)} migration(s)." if applied else "Schema is up to date.")
+    elif command == "status":
+        conn = psycopg2.connect(**connection_params_from_env())
+        try:
+            for version, name, is_applied in status(conn):
+                print(f"{version:>4}  {'applied' if is_applied else 'pending':<8} {name}")
+        finally:
+            conn.close()
+    else:
+        print(f"Unknown command {command!r}. Use 'upgrade [version]' or 'status'.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
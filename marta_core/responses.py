@@ -0,0 +1,128 @@
+"""
+Shared JSON response layer for the Flask apps.
+
+`init_app(app)` swaps Flask's JSON provider for one backed by orjson, so
+every `jsonify` call site gets the faster encoder, and compresses responses
+with zstd or gzip, as negotiated through Accept-Encoding, once they are
+larger than `COMPRESS_MIN_SIZE` bytes.
+
+Settings, read from `app.config`:
+
+    COMPRESS_MIN_SIZE    bytes below which responses go out as is (1024)
+    COMPRESS_GZIP_LEVEL  gzip level (6)
+    COMPRESS_ZSTD_LEVEL  zstd level (3)
+"""
+import decimal
+import gzip
+
+import orjson
+from flask import request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+COMPRESSIBLE_MIMETYPES = {
+    "application/json", "application/javascript", "text/html", "text/plain",
+    "text/css", "text/csv", "text/javascript", "image/svg+xml",
+}
+
+
+def _default(obj):
+    # Decimals stay strings, as with Flask's encoder, so money keeps its precision.
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if hasattr(obj, "isoformat"):
+        return obj.isoformat()
+    if hasattr(obj, "__html__"):
+        return str(obj.__html__())
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps_bytes(obj, indent=False):
+    """Serializes `obj` to UTF-8 JSON bytes; datetimes become ISO 8601 strings."""
+    option = ORJSON_OPTIONS | orjson.OPT_INDENT_2 if indent else ORJSON_OPTIONS
+    return orjson.dumps(obj, default=_default, option=option)
+
+
+def dumps(obj):
+    return dumps_bytes(obj).decode()
+
+
+class ORJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            # Callers asking for stdlib options (sort_keys, indent=4, cls=...) keep the stdlib encoder.
+            return super().dumps(obj, **kwargs)
+        return dumps(obj)
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = self.compact is False or (self.compact is None and self._app.debug)
+        return self._app.response_class(dumps_bytes(obj, indent=indent), mimetype=self.mimetype)
+
+
+def choose_encoding(accept_encodings):
+    """'zstd', 'gzip' or None for a werkzeug Accept object, preferring zstd on equal quality."""
+    candidates = ["zstd", "gzip"] if zstandard is not None else ["gzip"]
+    best = max(candidates, key=lambda encoding: (accept_encodings[encoding], -candidates.index(encoding)))
+    return best if accept_encodings[best] > 0 else None
+
+
+def compress(data, encoding, gzip_level=6, zstd_level=3):
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=zstd_level).compress(data)
+    return gzip.compress(data, compresslevel=gzip_level, mtime=0)
+
+
+def compress_response(response, accept_encodings, min_size=1024, gzip_level=6, zstd_level=3):
+    """Compresses a buffered response body in place when it is worth it; returns the response."""
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or response.status_code < 200
+        or response.status_code in (204, 206, 304)
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESSIBLE_MIMETYPES
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    data = response.get_data()
+    if len(data) < min_size:
+        return response
+    encoding = choose_encoding(accept_encodings)
+    if encoding is None:
+        return response
+    response.set_data(compress(data, encoding, gzip_level, zstd_level))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def init_app(app):
+    app.json = ORJSONProvider(app)
+    app.config.setdefault("COMPRESS_MIN_SIZE", 1024)
+    app.config.setdefault("COMPRESS_GZIP_LEVEL", 6)
+    app.config.setdefault("COMPRESS_ZSTD_LEVEL", 3)
+
+    @app.after_request
+    def _compress(response):
+        return compress_response(
+            response,
+            request.accept_encodings,
+            min_size=app.config["COMPRESS_MIN_SIZE"],
+            gzip_level=app.config["COMPRESS_GZIP_LEVEL"],
+            zstd_level=app.config["COMPRESS_ZSTD_LEVEL"],
+        )
+
+    return app
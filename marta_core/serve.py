@@ -0,0 +1,180 @@
+"""
+Production entry point: runs one of the Flask apps under gunicorn's
+pre-fork server.
+
+    python -m marta_core.serve crm_api --bind 0.0.0.0:5000
+    python -m marta_core.serve webapp --workers 4
+    python -m marta_core.serve dashboard
+
+The app is not preloaded in the master: every worker imports it after the
+fork, so module-level resources (the CRM connection pool, the Vertex AI /
+Gemini client) are created in the process that uses them. The per-app
+`init_*` hooks below then warm up the remaining lazy resources before the
+worker takes its first request.
+
+A worker exits gracefully and is replaced after `--max-requests` requests
+(with jitter so workers do not recycle together), or once its resident
+memory passes `--max-memory-mb`.
+
+Defaults come from the environment: PORT, WEB_CONCURRENCY (cores),
+GUNICORN_THREADS (1), MAX_REQUESTS (1000 for sync workers, 0 = off for
+gthread), MAX_WORKER_MEMORY_MB (0 = off) and GUNICORN_TIMEOUT (120). Set
+PROMETHEUS_MULTIPROC_DIR to have /metrics aggregate all workers; the
+directory is reset at startup.
+
+More than one thread switches to gthread workers, which drop connections
+they had accepted but not started when they recycle, and cut off open
+/events streams; the default sync workers hand them back to the listen
+queue. So gthread workers are not recycled by request count unless
+MAX_REQUESTS or --max-requests asks for it (then put a proxy that retries
+in front); set MAX_WORKER_MEMORY_MB to bound their growth instead.
+
+crm_api always runs gthread workers with at least 16 threads: every open
+/events stream holds one, and crm_api accepts at most EVENTS_MAX_STREAMS
+(8) of them per worker so the remaining threads keep serving CRM requests.
+"""
+import argparse
+import importlib
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+
+from gunicorn.app.base import BaseApplication
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def init_crm_api(module):
+    from marta_core.crm import CRM
+
+    # Check the pool out once so a bad DSN fails at boot, not on a request.
+    with module.crm.pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT 1;")
+    if isinstance(module.crm, CRM):
+        # LISTEN before the first request, so no write by another worker
+        # can leave a stale entry in this worker's client cache.
+        module.change_feed.wait_until_listening()
+
+
+def init_webapp(module):
+    from marta_core import agent, tools
+
+    # Without a saved token this would start the interactive OAuth flow.
+    if os.path.exists(tools.TOKEN_FILE_PATH):
+        tools.get_google_credentials()
+    agent._initialize_agent_components()
+    tools.initialize_datanalisis_retriever()
+
+
+def init_dashboard(module):
+    if os.environ.get("INSTANCE_CONNECTION_NAME"):
+        module.get_cloud_sql_connector()
+
+
+APPS = {
+    # name: (module, python path entry, default port, worker init hook, minimum threads)
+    # crm_api's /events streams each hold a thread for up to a minute, so it
+    # always runs gthread workers with room for them next to CRM requests.
+    "crm_api": ("marta_core.crm_api", project_root, 5000, init_crm_api, 16),
+    "webapp": ("webapp", project_root, 5001, init_webapp, 1),
+    "dashboard": ("simple_dashboard", os.path.join(project_root, "marketing", "VetNeuman", "ad2images"), 8080, init_dashboard, 1),
+}
+
+
+def rss_bytes():
+    """Current resident set size of this process."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # No procfs (macOS): fall back to the peak, reported in bytes there.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class MartaApplication(BaseApplication):
+    def __init__(self, name, options):
+        self.app_name = name
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        module_name, path, _, _, _ = APPS[self.app_name]
+        if path not in sys.path:
+            sys.path.insert(0, path)
+        return importlib.import_module(module_name).app
+
+
+def build_options(name, bind=None, workers=None, threads=None, max_requests=None, max_memory_mb=None, timeout=None):
+    module_name, _, default_port, init_hook, min_threads = APPS[name]
+    threads = max(threads or int(os.environ.get("GUNICORN_THREADS", "1")), min_threads)
+    default_max_requests = "1000" if threads == 1 else "0"
+    max_requests = int(os.environ.get("MAX_REQUESTS", default_max_requests)) if max_requests is None else max_requests
+    max_memory_mb = int(os.environ.get("MAX_WORKER_MEMORY_MB", "0")) if max_memory_mb is None else max_memory_mb
+    max_memory = max_memory_mb * 2**20
+
+    def post_worker_init(worker):
+        init_hook(sys.modules[module_name])
+        worker.log.info("Worker %s initialized %s", worker.pid, name)
+
+    def post_request(worker, req, environ, resp):
+        if max_memory and worker.alive and rss_bytes() > max_memory:
+            worker.log.info("Worker %s is over %s MiB, restarting after this request", worker.pid, max_memory_mb)
+            worker.alive = False
+
+    def on_starting(server):
+        # Each worker writes its metrics to files here; stale ones would be summed in.
+        metrics_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+        if metrics_dir:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+            os.makedirs(metrics_dir)
+
+    def child_exit(server, worker):
+        if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+            from prometheus_client import multiprocess
+
+            multiprocess.mark_process_dead(worker.pid)
+
+    return {
+        "bind": bind or f"0.0.0.0:{os.environ.get('PORT', default_port)}",
+        "workers": workers or int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count())),
+        "worker_class": "gthread" if threads > 1 else "sync",
+        "threads": threads,
+        "max_requests": max_requests,
+        "max_requests_jitter": max_requests // 10,
+        "timeout": timeout or int(os.environ.get("GUNICORN_TIMEOUT", "120")),
+        "graceful_timeout": 30,
+        "preload_app": False,
+        "accesslog": "-",
+        "post_worker_init": post_worker_init,
+        "post_request": post_request,
+        "on_starting": on_starting,
+        "child_exit": child_exit,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a Marta app under gunicorn.")
+    parser.add_argument("app", choices=sorted(APPS))
+    parser.add_argument("--bind")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--threads", type=int)
+    parser.add_argument("--max-requests", type=int)
+    parser.add_argument("--max-memory-mb", type=int)
+    parser.add_argument("--timeout", type=int)
+    args = parser.parse_args(argv)
+
+    options = build_options(
+        args.app, bind=args.bind, workers=args.workers, threads=args.threads,
+        max_requests=args.max_requests, max_memory_mb=args.max_memory_mb, timeout=args.timeout,
+    )
+    MartaApplication(args.app, options).run()
+
+
+if __name__ == "__main__":
+    main()
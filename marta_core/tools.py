@@ -39,7 +39,13 @@ TOKEN_FILE_PATH = 'credentials/token.json'
 CONTEXT_DOCUMENT_PATH = "data/contexto_datanalisis.txt" 
 datanalisis_retriever = None 
 
+# Credenciales cacheadas por proceso; marta_core.serve las carga en cada worker tras el fork.
+_google_credentials = None
+
 def get_google_credentials():
+    global _google_credentials
+    if _google_credentials is not None and _google_credentials.valid:
+        return _google_credentials
     creds = None
     if os.path.exists(TOKEN_FILE_PATH):
         creds = Credentials.from_authorized_user_file(TOKEN_FILE_PATH, ALL_SCOPES)
@@ -56,6 +62,7 @@ def get_google_credentials():
             creds = flow.run_local_server(port=8080)
         with open(TOKEN_FILE_PATH, 'w') as token:
             token.write(creds.to_json())
+    _google_credentials = creds
     return creds
 
 def get_calendar_service():
@@ -1,7 +1,7 @@
 # webapp.py
 
 import os
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify 
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, jsonify 
 import sys
 from datetime import datetime 
 
@@ -10,7 +10,7 @@ if project_root not in sys.path:
     sys.path.insert(0, project_root)
 
 try:
-    from marta_core.agent import ask_marta 
+    from marta_core.agent import ask_marta, ask_marta_stream 
     from marta_core.tools import (
         leer_correos_recientes_gmail, 
         enviar_correo_gmail, 
@@ -20,13 +20,19 @@ try:
         crear_evento_calendario, 
         buscar_informacion_datanalisis 
     )
+    from marta_core.responses import init_app
+    from marta_core import metrics
+    from marta_core.admission import AdmissionRejected, llm_admission
+    from marta_core.events import sse_message
 except ImportError as e:
     print("Error crítico: No se pudieron importar los módulos de marta_core.")
     print(f"Detalle: {e}")
     sys.exit(1)
 
 app = Flask(__name__)
-app.secret_key = os.urandom(24) 
+app.secret_key = os.urandom(24)
+init_app(app)
+metrics.init_app(app, "webapp")
 
 GOOGLE_CLOUD_PROJECT = os.getenv('GOOGLE_CLOUD_PROJECT')
 raw_region_app = os.getenv('GOOGLE_CLOUD_REGION', 'us-central1')
@@ -83,10 +89,12 @@ def suggest_reply(message_id):
     prompt_para_marta = (f"Recibí este correo:\nDe: {correo_original.get('from')}\nAsunto: {correo_original.get('subject')}\nCuerpo:\n{correo_original.get('body')}\n\nRedacta un borrador de respuesta profesional y cortés en español. Considera el contexto de datanalisis.io si es relevante. Devuelve solo el cuerpo del correo para la respuesta.")
     respuesta_sugerida_marta = ""
     try:
-        raw_marta_response = ask_marta(prompt_para_marta)
+        with llm_admission.slot():
+            raw_marta_response = ask_marta(prompt_para_marta, use_cache=False)
         if isinstance(raw_marta_response, str): respuesta_sugerida_marta = raw_marta_response
         elif isinstance(raw_marta_response, dict) and 'output' in raw_marta_response: respuesta_sugerida_marta = raw_marta_response['output']
         else: respuesta_sugerida_marta = "Marta no pudo generar una respuesta."; flash(respuesta_sugerida_marta, "warning")
+    except AdmissionRejected as e: flash(f"Marta está atendiendo demasiadas solicitudes; inténtalo de nuevo en {e.retry_after} segundos.", "warning")
     except Exception as e: flash(f"Error al generar respuesta con Marta: {str(e)}", "danger")
     return redirect(url_for('view_email', message_id=message_id, respuesta_sugerida=respuesta_sugerida_marta))
 
@@ -121,12 +129,13 @@ def send_reply(message_id):
 def chat_interface(): return render_template('chat.html')
 
 @app.route('/api/chat', methods=['POST']) 
+@llm_admission.limit
 def api_send_chat_message():
     user_message = request.json.get('message')
     if not user_message: return jsonify({"error": "No se recibió ningún mensaje."}), 400
     print(f"API: Mensaje recibido para chat: {user_message}")
     try:
-        marta_response = ask_marta(user_message)
+        marta_response = ask_marta(user_message, session_id=request.json.get('session_id', 'default_session'))
         if isinstance(marta_response, str): response_text = marta_response
         elif isinstance(marta_response, dict) and 'output' in marta_response: response_text = marta_response['output']
         else: response_text = "Lo siento, no pude procesar esa respuesta."
@@ -136,6 +145,18 @@ def api_send_chat_message():
         print(f"API Error en send_chat_message: {str(e)}")
         return jsonify({"error": f"Error al procesar el mensaje con Marta: {str(e)}"}), 500
 
+@app.route('/api/chat/stream', methods=['POST'])
+@llm_admission.limit_stream
+def api_stream_chat_message():
+    # Igual que /api/chat, pero responde con Server-Sent Events a medida que Marta trabaja.
+    user_message = request.json.get('message')
+    if not user_message: return jsonify({"error": "No se recibió ningún mensaje."}), 400
+    events = ask_marta_stream(user_message, session_id=request.json.get('session_id', 'default_session'))
+    response = Response((sse_message(event['type'], event) for event in events), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(events.close)  # cancela la corrida si el cliente se desconecta
+    return response
+
 @app.route('/api/emails', methods=['GET'])
 def api_get_emails():
     view_type = request.args.get('view', 'unread')
@@ -158,6 +179,7 @@ def api_get_email_details(message_id):
     except Exception as e: return jsonify({"error": f"Error al obtener detalles del correo: {str(e)}"}), 500
 
 @app.route('/api/email/<message_id>/suggest_reply', methods=['POST']) 
+@llm_admission.limit
 def api_suggest_email_reply(message_id):
     try:
         correo_original = get_email_details_by_id(message_id)
@@ -166,7 +188,7 @@ def api_suggest_email_reply(message_id):
             if correo_original and correo_original.get("error"): error_msg += f" Detalle: {correo_original.get('error')}"
             return jsonify({"error": error_msg}), 404
         prompt_para_marta = (f"Recibí este correo:\nDe: {correo_original.get('from')}\nAsunto: {correo_original.get('subject')}\nCuerpo:\n{correo_original.get('body')}\n\nRedacta un borrador de respuesta profesional y cortés en español. Considera el contexto de datanalisis.io si es relevante. Devuelve solo el cuerpo del correo para la respuesta.")
-        raw_marta_response = ask_marta(prompt_para_marta)
+        raw_marta_response = ask_marta(prompt_para_marta, use_cache=False)
         if isinstance(raw_marta_response, str): respuesta_sugerida = raw_marta_response
         elif isinstance(raw_marta_response, dict) and 'output' in raw_marta_response: respuesta_sugerida = raw_marta_response['output']
         else: respuesta_sugerida = "Marta no pudo generar una respuesta en el formato esperado."